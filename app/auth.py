@@ -1,3 +1,6 @@
+import logging
+import secrets
+from base64 import b64encode
 from datetime import timedelta, datetime
 from fastapi import HTTPException, Depends, status
 from typing import Annotated, Union
@@ -5,27 +8,57 @@ from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from .database import *
 from .crypto import *
-from .model import User
+from .kdf import derive, verify
+from .model import User, UserIdentity
+from .revocation import revocation_index, token_digest
 from .utils import *
+from .vault import decode_vault
 
 SECRET_KEY = os.environ['SECRET_KEY']  # Key to generate token
 ALGORITHM = os.environ['ALGORITHM']  # Algorithm to generate token
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.environ['ACCESS_TOKEN_EXPIRE_MINUTES'])  # Token expiration time
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")  # Token url on API
 
+logger = logging.getLogger(__name__)
 
-def check_user_exists(email: str):
+
+async def check_user_exists(email: str):
     """
     Checks if the given email is already in the database
     :param str email: Email to check
     :return: True if the user exists, False otherwise
     """
     user_data = (email,)
-    current_user = select_request(select_user(), user_data)
+    current_user = await select_request(select_user(), user_data)
     return current_user is not None
 
 
-def get_user_from_db(email: str):
+def user_from_row(row):
+    """
+    Build user from the columns selected by select_user
+    :param tuple row: User's columns
+    :return: User's data
+    """
+
+    vault = decode_vault(row[8], row[12])
+
+    return User(
+        id=row[0],
+        email=row[1],
+        key_hash=row[2],
+        symmetric_key_encrypted=row[3],
+        salt=row[4],
+        has_two_factor_auth=row[5],
+        two_factor_auth=row[6],
+        verified=row[7],
+        vault=vault,
+        token_version=row[9],
+        kdf_algorithm=row[10],
+        kdf_iterations=row[11]
+    )
+
+
+async def get_user_from_db(email: str):
     """
     Get user from database based on email
     :param str email: User's email to get from database
@@ -36,29 +69,15 @@ def get_user_from_db(email: str):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid email")
 
     user_data = (email,)
-    current_user = select_request(select_user(), user_data)
+    current_user = await select_request(select_user(), user_data)
 
     if current_user is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
-    if current_user[-1] is not None:
-        current_user = current_user[:-1] + (bytea_to_text(current_user[-1]),)
-
-    current_user = User(
-        id=current_user[0],
-        email=current_user[1],
-        key_hash=current_user[2],
-        symmetric_key_encrypted=current_user[3],
-        salt=current_user[4],
-        has_two_factor_auth=current_user[5],
-        two_factor_auth=current_user[6],
-        verified=current_user[7],
-        vault=current_user[8]
-    )
 
-    return current_user
+    return user_from_row(current_user)
 
 
-def authenticate_user(email: str, key_hash: str):
+async def authenticate_user(email: str, key_hash: str):
     """
     Authenticate user with email and key hash (password)
     :param str email: User's email
@@ -66,21 +85,44 @@ def authenticate_user(email: str, key_hash: str):
     :return: User's data if credentials are valid
     """
 
-    current_user = get_user_from_db(email)
+    current_user = await get_user_from_db(email)
 
     if not current_user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials")
-    if not verify_master_key_hash(get_byte_from_base64(key_hash), get_byte_from_base64(current_user.salt),
-                                  get_byte_from_base64(current_user.key_hash)):
+    if not await verify(get_byte_from_base64(key_hash), get_byte_from_base64(current_user.salt),
+                        get_byte_from_base64(current_user.key_hash), current_user.kdf_algorithm,
+                        current_user.kdf_iterations):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials")
 
+    # The password is known at this point, the hash is upgraded if the parameters changed since it was generated
+    if needs_rehash(current_user.kdf_algorithm, current_user.kdf_iterations):
+        await rehash_user(current_user, key_hash)
+
     return current_user
 
 
+async def rehash_user(current_user: User, key_hash: str):
+    """
+    Generate the master key hash of the user again with the current parameters
+    A failure is logged but does not prevent the login, the hash will be upgraded at the next one
+    :param User current_user: Authenticated user
+    :param str key_hash: User's key hash (password)
+    :return: None
+    """
+
+    try:
+        salt, h = await derive(get_byte_from_base64(key_hash))
+        await insert_update_delete_request(rehash_update(), (b64encode(h).decode(), b64encode(salt).decode(),
+                                                             KDF_ALGORITHM, PBKDF_NUM_ITERATIONS, current_user.id,
+                                                             current_user.key_hash))
+    except Exception:
+        logger.exception("Error while upgrading the master key hash of a user")
+
+
 def create_access_token(data: dict, expires_delta: Union[timedelta, None] = None):
     """
     Create access token
-    :param dict data: Data to encode in token (user's email)
+    :param dict data: Data to encode in token (user's email and token version)
     :param expires_delta: Token expiration time
     :return: JWT token for user authentication
     """
@@ -89,16 +131,17 @@ def create_access_token(data: dict, expires_delta: Union[timedelta, None] = None
         expire = datetime.utcnow() + expires_delta
     else:
         expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
+    # The identifier makes every token unique, so revoking a token never revokes another session
+    to_encode.update({"exp": expire, "jti": secrets.token_urlsafe(16)})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
 
-async def get_current_user_from_token(token: Annotated[str, Depends(oauth2_scheme)]):
+def decode_token(token: str) -> dict:
     """
-    Get current user from token
+    Decode token and check it contains the email it was issued for
     :param str token: JWT token for user authentication
-    :return: User's data if token is valid
+    :return: Claims of the token
     """
 
     credentials_exception = HTTPException(
@@ -107,7 +150,6 @@ async def get_current_user_from_token(token: Annotated[str, Depends(oauth2_schem
         headers={"WWW-Authenticate": "Bearer"},
     )
 
-    # Decoding token and checking if the content (email) corresponds to a user in the database
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
@@ -115,38 +157,141 @@ async def get_current_user_from_token(token: Annotated[str, Depends(oauth2_schem
             raise credentials_exception
     except JWTError:
         raise credentials_exception
-    current_user = get_user_from_db(username)
+    return payload
+
+
+def get_email_from_token(token: str) -> str:
+    """
+    Decode token and get the email it was issued for
+    :param str token: JWT token for user authentication
+    :return: User's email contained in the token
+    """
+
+    return decode_token(token)["sub"]
+
+
+async def get_current_user_from_token(token: Annotated[str, Depends(oauth2_scheme)]):
+    """
+    Get current user from token
+    :param str token: JWT token for user authentication
+    :return: User's data if token is valid
+    """
+
+    # Decoding token and checking if the content (email) corresponds to a user in the database
+    current_user = await get_user_from_db(get_email_from_token(token))
     if current_user is None:
-        raise credentials_exception
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
     return current_user
 
 
-def is_token_revoked(token: str):
+def check_revocation(revoked: bool):
     """
-    Check if token is revoked in the database
-    :param str token: JWT token for user authentication
+    Raise an error if the token is revoked
+    :param bool revoked: Revocation status of the token
     :return: None
     """
-    if select_request(check_token_revoked(), (token,))[0]:
+
+    if revoked:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token revoked")
 
 
+def check_token_version(payload: dict, token_version: int):
+    """
+    Raise an error if the token was issued before the user's sessions were revoked
+    Tokens issued without version (e.g. in mails) have the initial version
+    :param dict payload: Claims of the token
+    :param int token_version: Current token version of the user
+    :return: None
+    """
+
+    check_revocation(payload.get("ver", 0) != token_version)
+
+
+async def is_token_revoked(token: str):
+    """
+    Check if token is revoked, in the revocation index of the worker or in the database if it is not ready
+    :param str token: JWT token for user authentication
+    :return: None
+    """
+    revoked = revocation_index.is_revoked(token)
+    if revoked is None:
+        revoked = (await select_request(check_token_revoked(), (token_digest(token),)))[0]
+    check_revocation(revoked)
+
+
+async def select_authenticated_user(token: str, req_with_revocation: str, req: str):
+    """
+    Check the revocation of the token and select the user it belongs to
+    The revocation index is used when it is ready, otherwise the revocation is checked by the same request
+    :param str token: JWT token for user authentication
+    :param str req_with_revocation: Request selecting the revocation status followed by the user's columns
+    :param str req: Request selecting the user's columns
+    :return: Claims of the token and user's columns
+    """
+
+    payload = decode_token(token)
+    email = payload["sub"]
+    revoked = revocation_index.is_revoked(token)
+
+    if revoked is None:
+        row = await select_request(req_with_revocation, (token_digest(token), email))
+        revoked, row = row[0], row[1:]
+    else:
+        row = await select_request(req, (email,))
+    check_revocation(revoked)
+
+    if row is None or row[0] is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+
+    return payload, row
+
+
 async def protected_endpoints(token: Annotated[str, Depends(oauth2_scheme)]) -> User:
     """
-    Get current user from token
+    Get current user from token, including the credentials and the vault
+    The revocation of the token and the user are checked in a single request
     :param str token: JWT token for user authentication
     :return: User's data if token is valid
     """
-    is_token_revoked(token)
-    current_user = await get_current_user_from_token(token)
+
+    payload, row = await select_authenticated_user(token, select_user_with_revocation(), select_user())
+    current_user = user_from_row(row)
+    check_token_version(payload, current_user.token_version)
     return current_user
 
 
+async def protected_endpoints_identity(token: Annotated[str, Depends(oauth2_scheme)]) -> UserIdentity:
+    """
+    Get identity of the current user from token, for endpoints that need neither the credentials nor the vault
+    The revocation of the token and the user are checked in a single request
+    :param str token: JWT token for user authentication
+    :return: User's identity if token is valid
+    """
+
+    payload, row = await select_authenticated_user(token, select_user_identity_with_revocation(), select_user_identity())
+    check_token_version(payload, row[4])
+
+    return UserIdentity(
+        id=row[0],
+        email=row[1],
+        has_two_factor_auth=row[2],
+        verified=row[3],
+        token_version=row[4],
+        token_digest=token_digest(token),
+        token_expiration=float(payload.get("exp", 0))
+    )
+
+
 async def protected_endpoints_token(token: Annotated[str, Depends(oauth2_scheme)]) -> str:
     """
     Get current user from token
     :param str token: JWT token for user authentication
     :return: Received token
     """
-    is_token_revoked(token)
+    decode_token(token)
+    await is_token_revoked(token)
     return token
@@ -0,0 +1,189 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Optional
+from .database import *
+from .hibp import get_breach_for_user
+from .mail import send_email
+from .metrics import register_metrics
+from .scheduler import scheduler
+from .templates.mailTemplate import breach_mail
+
+BREACH_MAX_AGE = int(os.environ.get('BREACH_MAX_AGE', 86400))  # Seconds before the breaches of a user are refreshed
+HIBP_REFRESH_PER_MINUTE = float(os.environ.get('HIBP_REFRESH_PER_MINUTE', 10))  # Refreshes under the API key limit
+BREACH_REFRESH_INTERVAL = 60  # Seconds between two batches of refreshes, or before retrying when another worker calls HIBP
+BREACH_SWEEP_INTERVAL = int(os.environ.get('BREACH_SWEEP_INTERVAL', 86400))  # Seconds between two sweeps of the users
+BREACH_SWEEP_CONCURRENCY = int(os.environ.get('BREACH_SWEEP_CONCURRENCY', 4))  # Accounts checked at once by a sweep
+BREACH_SWEEP_BATCH = 100  # Users checked between two checkpoints of the sweep
+BREACH_SWEEP_JOB = "breach_sweep"  # Name of the checkpoint of the sweep
+
+logger = logging.getLogger(__name__)
+
+
+class BreachStats:
+    """
+    Counters of the breach cache
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.refreshed = 0
+        self.swept = 0
+        self.notified = 0
+        self.sweep_failures = 0
+
+    def stats(self) -> dict:
+        """
+        Counters of the breach cache
+        :return: Breaches served from the cache, fetched on a miss and refreshed in the background, accounts swept,
+        notified of new breaches and failing to be swept
+        """
+
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshed": self.refreshed,
+            "swept": self.swept,
+            "notified": self.notified,
+            "sweep_failures": self.sweep_failures,
+        }
+
+
+breach_stats = BreachStats()
+register_metrics("breach_cache", breach_stats.stats)
+
+
+async def refresh_breaches(user_id: int, email: str) -> str:
+    """
+    Fetch the breaches of a user from HIBP and store them
+    :param int user_id: Id of the user
+    :param str email: Email of the user
+    :return: Breaches of the user in a JSON format
+    """
+
+    breaches = json.dumps(await get_breach_for_user(email))
+    await insert_update_delete_request(upsert_breach_cache(), (user_id, breaches))
+    return breaches
+
+
+async def get_cached_breaches(user_id: int, email: str) -> str:
+    """
+    Get the breaches of a user from the cache, fetched from HIBP the first time
+    :param int user_id: Id of the user
+    :param str email: Email of the user
+    :return: Breaches of the user in a JSON format
+    """
+
+    row = await select_request(select_breach_cache(), (user_id,))
+    if row:
+        breach_stats.hits += 1
+        return row[0]
+
+    breach_stats.misses += 1
+    return await refresh_breaches(user_id, email)
+
+
+async def refresh_stale_breaches() -> int:
+    """
+    Refresh the breaches fetched the longest ago, at the rate allowed by the HIBP API key
+    :return: Number of users whose breaches were refreshed
+    """
+
+    rows = await select_many_request(select_stale_breaches(), (BREACH_MAX_AGE, max(1, int(HIBP_REFRESH_PER_MINUTE))))
+    for user_id, email in rows:
+        await refresh_breaches(user_id, email)
+        breach_stats.refreshed += 1
+        await asyncio.sleep(60 / HIBP_REFRESH_PER_MINUTE)
+    return len(rows)
+
+
+def new_breaches(previous: Optional[str], breaches: list) -> list:
+    """
+    Breaches the user was not notified of yet
+    :param str previous: Breaches the user was notified of in a JSON format, None if the user was never swept
+    :param list breaches: Breaches fetched now
+    :return: New breaches, none the first time to not report the old breaches
+    """
+
+    if previous is None:
+        return []
+    seen = {breach["Name"] for breach in json.loads(previous)}
+    return [breach for breach in breaches if breach["Name"] not in seen]
+
+
+async def check_breaches(user_id: int, email: str, previous: Optional[str]):
+    """
+    Fetch the breaches of a user, mail the user about the new ones and store them
+    The breaches notified are kept apart from the cache, which the refresh and the endpoint also write without mailing
+    :param int user_id: Id of the user
+    :param str email: Email of the user
+    :param str previous: Breaches the user was notified of in a JSON format, None if the user was never swept
+    :return: None
+    """
+
+    breaches = await get_breach_for_user(email)
+    new = new_breaches(previous, breaches)
+    if new:
+        # The email links to the website, it does not need the token identifying the user
+        await send_email(email, lambda token: breach_mail(new))
+        breach_stats.notified += 1
+    await insert_update_delete_request(upsert_notified_breaches(), (user_id, json.dumps(breaches), json.dumps(breaches)))
+    breach_stats.swept += 1
+
+
+async def sweep_breaches() -> float:
+    """
+    Check the next batch of verified users of the sweep, at the rate allowed by the HIBP API key
+    The sweep resumes after the last user of the checkpoint, an account failing to be checked is skipped until the
+    next sweep so it cannot hold the sweep back
+    :return: Seconds to wait before the next batch
+    """
+
+    checkpoint = await select_request(select_job_checkpoint(), (BREACH_SWEEP_JOB,))
+    last_id, elapsed = checkpoint if checkpoint else (0, None)
+    # A sweep ended less than an interval ago
+    if last_id == 0 and elapsed is not None and elapsed < BREACH_SWEEP_INTERVAL:
+        return BREACH_SWEEP_INTERVAL - float(elapsed)
+
+    rows = await select_many_request(select_sweep_users(), (last_id, BREACH_SWEEP_BATCH))
+    semaphore = asyncio.Semaphore(BREACH_SWEEP_CONCURRENCY)
+
+    async def check(user_id, email, previous):
+        try:
+            await check_breaches(user_id, email, previous)
+        except Exception:
+            breach_stats.sweep_failures += 1
+            logger.exception("Error while sweeping the breaches of the user %s", user_id)
+        finally:
+            semaphore.release()
+
+    tasks = []
+    try:
+        for row in rows:
+            await semaphore.acquire()
+            tasks.append(asyncio.create_task(check(*row)))
+            await asyncio.sleep(60 / HIBP_REFRESH_PER_MINUTE)
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    await insert_update_delete_request(upsert_job_checkpoint(), (BREACH_SWEEP_JOB, rows[-1][0] if rows else 0))
+    return 0
+
+
+async def refresh_job():
+    """
+    Scheduled job refreshing a batch of the stale breaches
+    The job waits its interval even while breaches are stale, so the sweep sharing its lock runs between two batches
+    :return: None
+    """
+
+    await refresh_stale_breaches()
+
+
+# The refresh and the sweep share the rate limit of the HIBP API key, a single worker runs one of them at a time
+scheduler.add("breach_refresh", refresh_job, BREACH_REFRESH_INTERVAL, lock="hibp_breaches")
+scheduler.add("breach_sweep", sweep_breaches, BREACH_REFRESH_INTERVAL, lock="hibp_breaches")
@@ -0,0 +1,87 @@
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+class LruCache:
+    """
+    Least recently used cache bounded by the total size of its values, each value expiring after a time to live
+    """
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self.bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _remove(self, key: str):
+        """
+        Remove an entry
+        :param str key: Key of the entry
+        :return: None
+        """
+
+        value, _ = self._entries.pop(key)
+        self.bytes -= len(value)
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Get the value of a key, it becomes the most recently used
+        :param str key: Key of the entry
+        :return: Value, None if the key is missing or expired
+        """
+
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] <= time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key: str, value: str, ttl: Optional[float] = None):
+        """
+        Set the value of a key, the least recently used entries are evicted to stay within the size bound
+        :param str key: Key of the entry
+        :param str value: Value of the entry
+        :param float ttl: Time to live of the entry, the one of the cache if None
+        :return: None
+        """
+
+        if key in self._entries:
+            self._remove(key)
+        if len(value) > self.max_bytes:
+            return
+
+        self._entries[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self.bytes += len(value)
+        while self.bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        """
+        Counters of the cache
+        :return: Size of the cache, hits, misses, evictions and expirations
+        """
+
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
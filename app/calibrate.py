@@ -0,0 +1,67 @@
+import argparse
+import statistics
+import time
+from .crypto import KDF_ALGORITHM, KDF_ALGORITHMS, SALT_LEN, derive_key, gen_salt
+
+SAMPLE_ITERATIONS = 100_000  # Iterations of the derivations that are timed
+MINIMUM_ITERATIONS = {
+    "pbkdf2-sha256": 600_000,  # OWASP recommendation
+}
+
+
+def measure(algorithm: str, iterations: int, runs: int) -> float:
+    """
+    Measures the duration of a key derivation on this machine
+    :param str algorithm: Name of the key derivation function
+    :param int iterations: Cost of the derivation
+    :param int runs: Number of derivations timed
+    :return: Median duration in seconds
+    """
+
+    data, salt = gen_salt(32), gen_salt(SALT_LEN)
+    durations = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        derive_key(data, salt, algorithm, iterations)
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+
+def calibrate(algorithm: str, target_ms: float, runs: int) -> int:
+    """
+    Picks the cost of the key derivation taking the target duration on this machine
+    :param str algorithm: Name of the key derivation function
+    :param float target_ms: Target duration of a derivation in milliseconds
+    :param int runs: Number of derivations timed
+    :return: Number of iterations, rounded to ten thousands
+    """
+
+    duration = measure(algorithm, SAMPLE_ITERATIONS, runs)
+    iterations = SAMPLE_ITERATIONS * target_ms / 1000 / duration
+    return max(10_000, round(iterations / 10_000) * 10_000)
+
+
+def main():
+    """
+    Prints the KDF_ITERATIONS value to configure for the target login latency
+    Usage: python -m app.calibrate --target-ms 300
+    :return: None
+    """
+
+    parser = argparse.ArgumentParser(description="Calibrate the cost of the master key derivation")
+    parser.add_argument("--algorithm", default=KDF_ALGORITHM, choices=sorted(KDF_ALGORITHMS))
+    parser.add_argument("--target-ms", type=float, default=300, help="Target duration of a derivation")
+    parser.add_argument("--runs", type=int, default=5, help="Number of derivations timed")
+    args = parser.parse_args()
+
+    iterations = calibrate(args.algorithm, args.target_ms, args.runs)
+    duration = measure(args.algorithm, iterations, 1)
+    print(f"KDF_ITERATIONS={iterations}  # {duration * 1000:.0f} ms per derivation with {args.algorithm}")
+
+    minimum = MINIMUM_ITERATIONS.get(args.algorithm, 0)
+    if iterations < minimum:
+        print(f"Warning: below the recommended minimum of {minimum} iterations for {args.algorithm}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import asyncio
+import os
+from datetime import datetime
+from .database import insert_update_delete_request, select_many_request, delete_unverified_users
+from .metrics import register_metrics
+from .scheduler import scheduler
+
+UNVERIFIED_USER_TTL = int(os.environ.get('UNVERIFIED_USER_TTL', 86400))  # Seconds before an unverified account is deleted
+CLEANUP_INTERVAL = int(os.environ.get('CLEANUP_INTERVAL', 3600))  # Seconds between two cleanups
+CLEANUP_BATCH = int(os.environ.get('CLEANUP_BATCH', 500))  # Unverified accounts deleted per statement
+CLEANUP_PAUSE = float(os.environ.get('CLEANUP_PAUSE', 0.1))  # Seconds between two batches
+
+
+class CleanupStats:
+    """
+    Counters of the cleanup of the unverified accounts
+    """
+
+    def __init__(self):
+        self.deleted = 0
+        self.batches = 0
+        self.last_deleted = 0
+
+    def stats(self) -> dict:
+        """
+        Counters of the cleanup
+        :return: Accounts deleted, statements run and accounts deleted by the last cleanup
+        """
+
+        return {
+            "deleted": self.deleted,
+            "batches": self.batches,
+            "last_deleted": self.last_deleted,
+        }
+
+
+cleanup_stats = CleanupStats()
+register_metrics("account_cleanup", cleanup_stats.stats)
+
+
+async def cleanup_unverified_users() -> int:
+    """
+    Delete the accounts not verified in time, in small batches ordered by creation date so no statement holds
+    locks for long, each batch resuming after the last account of the previous one
+    :return: Number of deleted accounts
+    """
+
+    last_created_at, last_id = datetime.min, 0
+    deleted = 0
+    while True:
+        rows = await select_many_request(delete_unverified_users(),
+                                         (UNVERIFIED_USER_TTL, last_created_at, last_id, CLEANUP_BATCH))
+        cleanup_stats.batches += 1
+        deleted += len(rows)
+        if len(rows) < CLEANUP_BATCH:
+            break
+        last_created_at, last_id = max(rows)
+        await asyncio.sleep(CLEANUP_PAUSE)
+
+    cleanup_stats.deleted += deleted
+    cleanup_stats.last_deleted = deleted
+    return deleted
+
+
+async def cleanup_job():
+    """
+    Scheduled job deleting the unverified accounts
+    :return: None
+    """
+
+    await cleanup_unverified_users()
+
+
+scheduler.add("account_cleanup", cleanup_job, CLEANUP_INTERVAL)
@@ -0,0 +1,345 @@
+import io
+import os
+import zlib
+from typing import Optional
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from .metrics import register_metrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))  # Smallest response body compressed, in bytes
+COMPRESSION_LEVEL = int(os.environ.get('COMPRESSION_LEVEL', 6))  # Level of compression, capped to the maximum of each encoding
+COMPRESSION_MAX_REQUEST_SIZE = int(os.environ.get('COMPRESSION_MAX_REQUEST_SIZE', 32 * 1024 * 1024))  # Largest decompressed request body
+SKIPPED_CONTENT_TYPES = ("text/event-stream",)  # Streams whose events must not wait for a compressed block
+MAX_LEVELS = {"zstd": 22, "br": 11, "gzip": 9}
+
+# Encodings available, by order of preference when the client accepts several with the same quality
+ENCODINGS = [encoding for encoding, available in (("zstd", zstandard), ("br", brotli), ("gzip", zlib)) if available]
+DECOMPRESSION_ERRORS = ((zlib.error,) + ((brotli.error,) if brotli else ()) +
+                        ((zstandard.ZstdError,) if zstandard else ()))
+
+
+class Compressor:
+    """
+    Compression of a response body, sent in one or several chunks
+    """
+
+    def __init__(self, encoding: str, level: int):
+        level = min(level, MAX_LEVELS[encoding])
+        self.encoding = encoding
+        if encoding == "zstd":
+            self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        elif encoding == "br":
+            self._compressor = brotli.Compressor(quality=level)
+        else:
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # gzip container
+
+    def compress(self, data: bytes) -> bytes:
+        """
+        Compress a chunk, part of it may be kept until the next chunk
+        :param bytes data: Chunk of the body
+        :return: Compressed data
+        """
+
+        if self.encoding == "br":
+            return self._compressor.process(data)
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        """
+        Flush the compressed data kept, so the client can decompress the chunks sent without waiting for the next one
+        :return: Compressed data
+        """
+
+        if self.encoding == "zstd":
+            return self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        if self.encoding == "br":
+            return self._compressor.flush()
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        """
+        End the compressed body
+        :return: Last bytes of the compressed body
+        """
+
+        if self.encoding == "br":
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+class RequestBodyError(Exception):
+    """
+    Compressed request body that cannot be accepted
+    """
+
+    def __init__(self, status_code: int, detail: str):
+        self.status_code = status_code
+        self.detail = detail
+
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """
+    Pick the encoding of a response from the Accept-Encoding header of the request
+    :param str accept_encoding: Accept-Encoding header, e.g. "gzip, br;q=0.9"
+    :return: Available encoding with the highest quality, None if no encoding is accepted
+    """
+
+    qualities = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.strip().lower()] = quality
+
+    best, best_quality = None, 0.0
+    for encoding in ENCODINGS:
+        quality = qualities.get(encoding, qualities.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def decompress_body(encoding: str, body: bytes, limit: int) -> bytes:
+    """
+    Decompress a request body, without ever holding more than the limit in memory
+    :param str encoding: Content-Encoding of the request
+    :param bytes body: Compressed body
+    :param int limit: Largest decompressed body accepted, in bytes
+    :return: Decompressed body
+    """
+
+    if encoding not in ENCODINGS:
+        raise RequestBodyError(415, "Unsupported content encoding")
+
+    try:
+        if encoding == "gzip":
+            decompressor = zlib.decompressobj(31)
+            data = decompressor.decompress(body, limit + 1)
+            finished = decompressor.eof
+        elif encoding == "br":
+            decompressor = brotli.Decompressor()
+            data = decompressor.process(body, output_buffer_limit=limit + 1)
+            finished = decompressor.is_finished()
+        else:
+            chunks = bytearray()
+            for chunk in zstandard.ZstdDecompressor().read_to_iter(io.BytesIO(body)):
+                chunks += chunk
+                if len(chunks) > limit:
+                    break
+            data = bytes(chunks)
+            # A truncated frame is only detected when its header has the size of its content
+            content_size = zstandard.frame_content_size(body)
+            finished = content_size == -1 or content_size == len(data)
+    except DECOMPRESSION_ERRORS as e:
+        raise RequestBodyError(400, "Invalid compressed body") from e
+
+    if len(data) > limit:
+        raise RequestBodyError(413, "Request body too large")
+    if not finished:
+        raise RequestBodyError(400, "Invalid compressed body")
+    return data
+
+
+class CompressionStats:
+    """
+    Counters of the compression of the responses and the decompression of the requests
+    """
+
+    def __init__(self):
+        self.responses = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.requests = 0
+        self.rejected = 0
+
+    def stats(self) -> dict:
+        """
+        Counters of the compression
+        :return: Responses compressed with their size before and after, requests decompressed and rejected
+        """
+
+        return {
+            "responses": self.responses,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "requests": self.requests,
+            "rejected": self.rejected,
+        }
+
+
+compression_stats = CompressionStats()
+register_metrics("compression", compression_stats.stats)
+
+
+class CompressionMiddleware:
+    """
+    Compresses the responses with the best encoding accepted by the client (zstd and brotli when installed, gzip),
+    and decompresses the request bodies sent compressed
+    """
+
+    def __init__(self, app: ASGIApp, minimum_size: int = COMPRESSION_MIN_SIZE, level: int = COMPRESSION_LEVEL,
+                 max_request_size: int = COMPRESSION_MAX_REQUEST_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.level = level
+        self.max_request_size = max_request_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        content_encoding = headers.get("content-encoding", "identity").strip().lower()
+        if content_encoding != "identity":
+            try:
+                body = await self.read_body(receive)
+                body = decompress_body(content_encoding, body, self.max_request_size)
+            except RequestBodyError as e:
+                compression_stats.rejected += 1
+                await JSONResponse({"detail": e.detail}, status_code=e.status_code)(scope, receive, send)
+                return
+            compression_stats.requests += 1
+            scope, receive = self.decompressed_request(scope, receive, body)
+
+        encoding = negotiate_encoding(headers.get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await self.app(scope, receive, CompressedResponse(send, encoding, self.minimum_size, self.level).send)
+
+    async def read_body(self, receive: Receive) -> bytes:
+        """
+        Read the compressed body of a request, it is not larger than its decompressed body
+        :param Function receive: Function receiving the messages of the request
+        :return: Compressed body
+        """
+
+        body = bytearray()
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message["type"] != "http.request":
+                raise RequestBodyError(400, "Request body not received")
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if len(body) > self.max_request_size:
+                raise RequestBodyError(413, "Request body too large")
+        return bytes(body)
+
+    @staticmethod
+    def decompressed_request(scope: Scope, receive: Receive, body: bytes) -> tuple[Scope, Receive]:
+        """
+        Scope and receive function of a request whose body was decompressed
+        :param Scope scope: Scope of the request
+        :param Function receive: Function receiving the messages of the request
+        :param bytes body: Decompressed body
+        :return: Scope without the Content-Encoding header and function receiving the decompressed body
+        """
+
+        scope = dict(scope)
+        scope["headers"] = [(name, value) for name, value in scope["headers"]
+                            if name not in (b"content-encoding", b"content-length")]
+        scope["headers"].append((b"content-length", str(len(body)).encode()))
+        sent = False
+
+        async def receive_decompressed() -> Message:
+            nonlocal sent
+            if sent:
+                return await receive()
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        return scope, receive_decompressed
+
+
+class CompressedResponse:
+    """
+    Sending side of a response, compressed unless it is too small, already encoded or an event stream
+    The start of the other responses is held until the first chunk of the body tells whether it is compressed
+    """
+
+    def __init__(self, send: Send, encoding: str, minimum_size: int, level: int):
+        self._send = send
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+        self.level = level
+        self._start: Optional[Message] = None
+        self._compressor: Optional[Compressor] = None
+
+    async def send(self, message: Message):
+        """
+        Send a message of the response, compressing its body
+        :param Message message: Message of the response
+        :return: None
+        """
+
+        if message["type"] == "http.response.start":
+            headers = Headers(raw=message["headers"])
+            if "content-encoding" in headers or headers.get("content-type", "").startswith(SKIPPED_CONTENT_TYPES):
+                # Sent right away, an event stream may not send its first event for a while
+                await self._send(message)
+            else:
+                self._start = message
+            return
+        if message["type"] != "http.response.body":
+            await self._send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self._start is not None:
+            start, self._start = self._start, None
+            headers = MutableHeaders(raw=start["headers"])
+            headers.add_vary_header("Accept-Encoding")
+            if not more_body and len(body) < self.minimum_size:
+                await self._send(start)
+                await self._send(message)
+                return
+
+            # Streamed bodies are compressed chunk by chunk, their length is not known
+            self._compressor = Compressor(self.encoding, self.level)
+            headers["Content-Encoding"] = self.encoding
+            del headers["Content-Length"]
+            data = self._compress(body, more_body)
+            if not more_body:
+                headers["Content-Length"] = str(len(data))
+            await self._send(start)
+            await self._send({"type": "http.response.body", "body": data, "more_body": more_body})
+            return
+
+        if self._compressor is None:
+            await self._send(message)
+            return
+        await self._send({"type": "http.response.body", "body": self._compress(body, more_body), "more_body": more_body})
+
+    def _compress(self, body: bytes, more_body: bool) -> bytes:
+        """
+        Compress a chunk of the body
+        :param bytes body: Chunk of the body
+        :param bool more_body: False for the last chunk
+        :return: Compressed chunk
+        """
+
+        data = self._compressor.compress(body) + (self._compressor.flush() if more_body else self._compressor.finish())
+        compression_stats.responses += not more_body
+        compression_stats.bytes_in += len(body)
+        compression_stats.bytes_out += len(data)
+        return data
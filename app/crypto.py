@@ -1,10 +1,13 @@
+import hmac
+import os
 from Crypto.Protocol.KDF import PBKDF2
 from Crypto.Hash import SHA256
 from Crypto.Random import get_random_bytes
 from base64 import b64decode
 from binascii import Error as BinasciiError
 
-PBKDF_NUM_ITERATIONS = 600_000
+PBKDF_NUM_ITERATIONS = int(os.environ.get('KDF_ITERATIONS', 600_000))  # Iterations used for the new hashes
+KDF_ALGORITHM = "pbkdf2-sha256"  # Algorithm used for the new hashes
 SALT_LEN = 16
 
 
@@ -31,29 +34,67 @@ def pbkdf2_sha256(data: bytes, salt: bytes, iterations: int) -> bytes:
     return h
 
 
-def generate_master_key_hash(master_password_hash: bytes) -> tuple[bytes, bytes]:
+# Key derivation functions, by the name stored with each user's hash
+KDF_ALGORITHMS = {
+    "pbkdf2-sha256": pbkdf2_sha256,
+}
+
+
+def derive_key(data: bytes, salt: bytes, algorithm: str, iterations: int) -> bytes:
+    """
+    Generates a hash of the given data with the given key derivation function
+    :param bytes data: Data to hash
+    :param bytes salt: Salt of the derivation
+    :param str algorithm: Name of the key derivation function
+    :param int iterations: Cost of the derivation
+    :return: Hash of the given data
+    """
+
+    if algorithm not in KDF_ALGORITHMS:
+        raise ValueError(f"Unknown key derivation algorithm {algorithm}")
+    return KDF_ALGORITHMS[algorithm](data, salt, iterations)
+
+
+def generate_master_key_hash(master_password_hash: bytes, algorithm: str = KDF_ALGORITHM,
+                             iterations: int = PBKDF_NUM_ITERATIONS) -> tuple[bytes, bytes]:
     """
     Generates a salt and a hash of the given master password hash (derivation)
     :param bytes master_password_hash: Hash of the master password
+    :param str algorithm: Name of the key derivation function
+    :param int iterations: Cost of the derivation
     :return: Tuple of salt and hash of the master password hash
     """
 
     salt = gen_salt(SALT_LEN)
-    h = pbkdf2_sha256(master_password_hash, salt, PBKDF_NUM_ITERATIONS)
+    h = derive_key(master_password_hash, salt, algorithm, iterations)
     return salt, h
 
 
-def verify_master_key_hash(received_hash: bytes, salt: bytes, current_master_key_hash: bytes) -> bool:
+def verify_master_key_hash(received_hash: bytes, salt: bytes, current_master_key_hash: bytes,
+                           algorithm: str = KDF_ALGORITHM, iterations: int = PBKDF_NUM_ITERATIONS) -> bool:
     """
     Verifies the given hash processed with the given salt corresponds to the current master key hash
     :param bytes received_hash: Hash received from the client
     :param bytes salt: Salt used to generate the master key hash
     :param bytes current_master_key_hash: Master key hash to compare with
+    :param str algorithm: Name of the key derivation function used to generate the master key hash
+    :param int iterations: Cost of the derivation used to generate the master key hash
     :return: True if the hashes match, False otherwise
     """
 
-    h = pbkdf2_sha256(received_hash, salt, PBKDF_NUM_ITERATIONS)
-    return h == current_master_key_hash
+    h = derive_key(received_hash, salt, algorithm, iterations)
+    return hmac.compare_digest(h, current_master_key_hash)
+
+
+def needs_rehash(algorithm: str, iterations: int) -> bool:
+    """
+    Checks if a master key hash was generated with other parameters than the current ones
+    :param str algorithm: Name of the key derivation function used to generate the master key hash
+    :param int iterations: Cost of the derivation used to generate the master key hash
+    :return: True if the master key hash should be generated again, False otherwise
+    """
+
+    return algorithm != KDF_ALGORITHM or iterations != PBKDF_NUM_ITERATIONS
 
 
 def get_byte_from_base64(s: str) -> bytes:
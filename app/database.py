@@ -1,7 +1,8 @@
 import os
-import psycopg2.pool
+import psycopg
+from psycopg_pool import AsyncConnectionPool
 from urllib import parse
-from contextlib import contextmanager
+from contextlib import asynccontextmanager
 
 database_url = os.environ['DATABASE_URL']  # Database URL for connection
 
@@ -13,65 +14,112 @@ password = parse_result.password
 host = parse_result.hostname
 port = parse_result.port
 
-# Creating database pool
-dbpool = psycopg2.pool.ThreadedConnectionPool(dbname=dbname,
-                                              user=user,
-                                              password=password,
-                                              host=host,
-                                              port=port,
-                                              minconn=1,
-                                              maxconn=20)
+# Connection parameters, shared by the pool and the dedicated connections
+connection_kwargs = {"dbname": dbname,
+                     "user": user,
+                     "password": password,
+                     "host": host,
+                     "port": port}
 
+# Creating database pool, opened when the API starts
+dbpool = AsyncConnectionPool(kwargs=connection_kwargs,
+                             min_size=1,
+                             max_size=20,
+                             open=False)
 
-@contextmanager
-def db_cursor():
+
+async def open_database():
+    """
+    Open the database pool
+    :return: None
+    """
+
+    await dbpool.open(wait=True)
+
+
+async def close_database():
+    """
+    Close the database pool
+    :return: None
+    """
+
+    await dbpool.close()
+
+
+@asynccontextmanager
+async def db_cursor():
     """
-    Context manager for database cursor
+    Context manager for database cursor, the transaction is committed on exit or rolled back on error
     :return: Database cursor
     """
 
-    conn = dbpool.getconn()
-    try:
-        with conn.cursor() as cur:
+    async with dbpool.connection() as conn:
+        async with conn.cursor() as cur:
             yield cur
-            conn.commit()
-    except Exception:
-        conn.rollback()
-        raise
-    finally:
-        dbpool.putconn(conn)
 
 
-def create_database():
+@asynccontextmanager
+async def advisory_lock(key):
+    """
+    Context manager taking a session advisory lock without waiting, released on exit
+    The lock is held on a dedicated connection, a long job does not keep a connection of the pool, and closing the
+    connection on exit releases the lock whatever happened to the session
+    :param int key: Key of the lock
+    :return: True if the lock was taken, False if another session holds it
+    """
+
+    conn = await psycopg.AsyncConnection.connect(autocommit=True, keepalives=1, keepalives_idle=30, **connection_kwargs)
+    async with conn:
+        locked, = await (await conn.execute(try_advisory_lock(), (key,))).fetchone()
+        yield locked
+
+
+async def create_database():
     """
     Create database
     :return: None
     """
-    with db_cursor() as cur:
-        cur.execute(database())
+    async with db_cursor() as cur:
+        await cur.execute(database())
 
 
-def select_request(req, values):
+async def select_request(req, values):
     """
     Execute select request
     :param str req: Select request to execute
     :param tuples values: Values to insert in the request
-    :return: Result of the request
+    :return: First row of the result of the request
+    """
+    async with db_cursor() as cur:
+        await cur.execute(req, values)
+        return await cur.fetchone()
+
+
+async def select_many_request(req, values, size=None):
+    """
+    Execute select request returning several rows
+    :param str req: Select request to execute
+    :param tuples values: Values to insert in the request
+    :param int size: Maximum number of rows to fetch, all rows if None
+    :return: Rows of the result of the request
     """
-    with db_cursor() as cur:
-        cur.execute(req, values)
-        return cur.fetchone()
+    async with db_cursor() as cur:
+        await cur.execute(req, values)
+        if size is None:
+            return await cur.fetchall()
+        return await cur.fetchmany(size)
 
 
-def insert_update_delete_request(req, values):
+async def insert_update_delete_request(req, values):
     """
     Execute insert, update or delete request
     :param str req: Request to execute
     :param tuples values: Values to insert in the request
-    :return: None
+    :return: Number of rows affected by the request
     """
-    with db_cursor() as cur:
-        cur.execute(req, values)
+    async with db_cursor() as cur:
+        await cur.execute(req, values)
+        return cur.rowcount
 
 
 def database():
@@ -99,15 +147,124 @@ def database():
         verified BOOLEAN DEFAULT FALSE,
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
         vault bytea,
+        tokenVersion INTEGER NOT NULL DEFAULT 0,
+        kdfAlgorithm VARCHAR(32) NOT NULL DEFAULT 'pbkdf2-sha256',
+        kdfIterations INTEGER NOT NULL DEFAULT 600000,
+        vaultFormat SMALLINT NOT NULL DEFAULT 0,
+        vaultRevision BIGINT NOT NULL DEFAULT 0,
+        vaultHash BYTEA,
+        itemsRevision BIGINT NOT NULL DEFAULT 0,
+        itemsPurgedRevision BIGINT NOT NULL DEFAULT 0,
         PRIMARY KEY (userId)
      );
+     CREATE INDEX user_unverified_created_at ON "User" (created_at) WHERE verified = FALSE;
     
     DROP TABLE IF EXISTS "RevokedToken" CASCADE;
      CREATE TABLE "RevokedToken"
      (
-        token VARCHAR(2048) UNIQUE,
-        PRIMARY KEY (token)
+        tokenDigest BYTEA NOT NULL,
+        expiresAt TIMESTAMPTZ NOT NULL,
+        PRIMARY KEY (tokenDigest)
+     );
+     CREATE INDEX revoked_token_expires_at ON "RevokedToken" (expiresAt);
+
+    DROP TABLE IF EXISTS "RefreshToken" CASCADE;
+     CREATE TABLE "RefreshToken"
+     (
+        tokenHash BYTEA NOT NULL,
+        userId INTEGER NOT NULL REFERENCES "User" (userId) ON DELETE CASCADE,
+        familyId UUID NOT NULL,
+        tokenVersion INTEGER NOT NULL,
+        used BOOLEAN NOT NULL DEFAULT FALSE,
+        expiresAt TIMESTAMPTZ NOT NULL,
+        PRIMARY KEY (tokenHash)
+     );
+     CREATE INDEX refresh_token_family ON "RefreshToken" (familyId);
+     CREATE INDEX refresh_token_expires_at ON "RefreshToken" (expiresAt);
+
+    DROP TABLE IF EXISTS "RateLimitBucket" CASCADE;
+     CREATE UNLOGGED TABLE "RateLimitBucket"
+     (
+        bucketKey VARCHAR(320) NOT NULL,
+        tokens DOUBLE PRECISION NOT NULL,
+        allowed BOOLEAN NOT NULL,
+        updatedAt TIMESTAMPTZ NOT NULL,
+        PRIMARY KEY (bucketKey)
+     );
+     CREATE INDEX rate_limit_bucket_updated_at ON "RateLimitBucket" (updatedAt);
+
+    DROP TABLE IF EXISTS "HibpRangeCache" CASCADE;
+     CREATE UNLOGGED TABLE "HibpRangeCache"
+     (
+        prefix CHAR(5) NOT NULL,
+        body TEXT NOT NULL,
+        fetchedAt TIMESTAMPTZ NOT NULL,
+        PRIMARY KEY (prefix)
+     );
+     CREATE INDEX hibp_range_cache_fetched_at ON "HibpRangeCache" (fetchedAt);
+
+    DROP TABLE IF EXISTS "BreachCache" CASCADE;
+     CREATE TABLE "BreachCache"
+     (
+        userId INTEGER NOT NULL REFERENCES "User" (userId) ON DELETE CASCADE,
+        breaches JSONB NOT NULL,
+        fetchedAt TIMESTAMPTZ NOT NULL,
+        notifiedBreaches JSONB,
+        PRIMARY KEY (userId)
+     );
+     CREATE INDEX breach_cache_fetched_at ON "BreachCache" (fetchedAt);
+
+    DROP TABLE IF EXISTS "JobCheckpoint" CASCADE;
+     CREATE TABLE "JobCheckpoint"
+     (
+        jobName VARCHAR(64) NOT NULL,
+        lastId INTEGER NOT NULL,
+        updatedAt TIMESTAMPTZ NOT NULL,
+        PRIMARY KEY (jobName)
+     );
+
+    DROP TABLE IF EXISTS "JobSchedule" CASCADE;
+     CREATE TABLE "JobSchedule"
+     (
+        jobName VARCHAR(64) NOT NULL,
+        nextRunAt TIMESTAMPTZ NOT NULL,
+        PRIMARY KEY (jobName)
+     );
+
+    DROP TABLE IF EXISTS "MailQueue" CASCADE;
+     CREATE TABLE "MailQueue"
+     (
+        mailId BIGSERIAL,
+        recipient VARCHAR(256) NOT NULL,
+        subject TEXT NOT NULL,
+        body TEXT NOT NULL,
+        bodyText TEXT,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        nextAttemptAt TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+        lastError TEXT,
+        createdAt TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        dedupeKey VARCHAR(320),
+        dedupeUntil TIMESTAMPTZ,
+        sentAt TIMESTAMPTZ,
+        PRIMARY KEY (mailId)
      );
+     CREATE INDEX mail_queue_next_attempt_at ON "MailQueue" (nextAttemptAt) WHERE nextAttemptAt IS NOT NULL;
+     CREATE INDEX mail_queue_dedupe_key ON "MailQueue" (dedupeKey) WHERE dedupeKey IS NOT NULL;
+
+    DROP TABLE IF EXISTS "VaultItem" CASCADE;
+     CREATE TABLE "VaultItem"
+     (
+        userId INTEGER NOT NULL REFERENCES "User" (userId) ON DELETE CASCADE,
+        itemId VARCHAR(64) NOT NULL,
+        data BYTEA,
+        itemFormat SMALLINT NOT NULL DEFAULT 1,
+        revision BIGINT NOT NULL,
+        deleted BOOLEAN NOT NULL DEFAULT FALSE,
+        updatedAt TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (userId, itemId)
+     );
+     CREATE INDEX vault_item_revision ON "VaultItem" (userId, revision, itemId);
+     CREATE INDEX vault_item_tombstone ON "VaultItem" (updatedAt) WHERE deleted;
      """
 
 
@@ -117,7 +274,36 @@ def select_user():
     :return: Request
     """
 
-    return """SELECT userid, email, keyhash, symmetrickeyencrypted, salt, hastwofactorauth, twofactorauth, verified, vault  FROM duckpass."User" WHERE email = %s"""
+    return """SELECT userid, email, keyhash, symmetrickeyencrypted, salt, hastwofactorauth, twofactorauth, verified, vault, tokenversion, kdfalgorithm, kdfiterations, vaultformat FROM duckpass."User" WHERE email = %s"""
+
+
+def select_user_with_revocation():
+    """
+    Request to check if a token digest is revoked and select the user it belongs to, in a single round trip
+    The row is always returned, user's columns are NULL if the user does not exist
+    :return: Request
+    """
+
+    return """SELECT EXISTS(SELECT 1 FROM duckpass."RevokedToken" WHERE tokenDigest = %s), U.userid, U.email, U.keyhash, U.symmetrickeyencrypted, U.salt, U.hastwofactorauth, U.twofactorauth, U.verified, U.vault, U.tokenversion, U.kdfalgorithm, U.kdfiterations, U.vaultformat FROM (VALUES (1)) AS T LEFT JOIN duckpass."User" U ON U.email = %s"""
+
+
+def select_user_identity_with_revocation():
+    """
+    Request to check if a token digest is revoked and select the identity of the user it belongs to (without the vault)
+    The row is always returned, user's columns are NULL if the user does not exist
+    :return: Request
+    """
+
+    return """SELECT EXISTS(SELECT 1 FROM duckpass."RevokedToken" WHERE tokenDigest = %s), U.userid, U.email, U.hastwofactorauth, U.verified, U.tokenversion FROM (VALUES (1)) AS T LEFT JOIN duckpass."User" U ON U.email = %s"""
+
+
+def select_user_identity():
+    """
+    Request to select the identity of a user (without the vault)
+    :return: Request
+    """
+
+    return """SELECT userid, email, hastwofactorauth, verified, tokenversion FROM duckpass."User" WHERE email = %s"""
 
 
 def insert_user():
@@ -126,7 +312,7 @@ def insert_user():
     :return: Request
     """
 
-    return """INSERT INTO duckpass."User" (email, keyHash, symmetricKeyEncrypted, salt) VALUES (%s, %s, %s, %s)"""
+    return """INSERT INTO duckpass."User" (email, keyHash, symmetricKeyEncrypted, salt, kdfAlgorithm, kdfIterations) VALUES (%s, %s, %s, %s, %s, %s)"""
 
 
 def update_two_factor_auth():
@@ -149,29 +335,56 @@ def update_verification():
 
 def vault_update():
     """
-    Request to update vault
+    Request to update vault and increase its revision, if its revision is one of the given ones or none are given
     :return: Request
     """
 
-    return """UPDATE duckpass."User" SET vault = %s WHERE email = %s"""
+    return """UPDATE duckpass."User" SET vault = %s, vaultFormat = %s, vaultHash = %s, vaultRevision = vaultRevision + 1 WHERE email = %s AND (%s::BIGINT[] IS NULL OR vaultRevision = ANY(%s)) RETURNING vaultRevision, vaultHash"""
 
 
 def add_revoked_token():
     """
-    Request to add revoked token
+    Request to add revoked token digest with the expiration timestamp of the token
     :return: Request
     """
 
-    return """INSERT INTO duckpass."RevokedToken" (token) VALUES (%s)"""
+    return """INSERT INTO duckpass."RevokedToken" (tokenDigest, expiresAt) VALUES (%s, to_timestamp(%s)) ON CONFLICT DO NOTHING"""
 
 
 def check_token_revoked():
     """
-    Request to check if token is revoked
+    Request to check if token digest is revoked
     :return: Request
     """
 
-    return """SELECT EXISTS(SELECT 1 FROM duckpass."RevokedToken" WHERE token = %s)"""
+    return """SELECT EXISTS(SELECT 1 FROM duckpass."RevokedToken" WHERE tokenDigest = %s)"""
+
+
+def select_revoked_tokens():
+    """
+    Request to select the digest and expiration timestamp of all unexpired revoked tokens
+    :return: Request
+    """
+
+    return """SELECT tokenDigest, extract(EPOCH FROM expiresAt) FROM duckpass."RevokedToken" WHERE expiresAt > CURRENT_TIMESTAMP"""
+
+
+def purge_revoked_tokens():
+    """
+    Request to delete a batch of expired revoked tokens
+    :return: Request
+    """
+
+    return """DELETE FROM duckpass."RevokedToken" WHERE tokenDigest IN (SELECT tokenDigest FROM duckpass."RevokedToken" WHERE expiresAt <= CURRENT_TIMESTAMP LIMIT %s)"""
+
+
+def notify_token_revoked():
+    """
+    Request to notify all the workers that a token is revoked
+    :return: Request
+    """
+
+    return """SELECT pg_notify('token_revoked', %s)"""
 
 
 def delete_user():
@@ -194,8 +407,467 @@ def update_user_email():
 
 def password_update():
     """
-    Request to update password
+    Request to update password, the sessions opened with the previous password are revoked
+    The vault is updated if its revision is one of the given ones or none are given
+    :return: Request
+    """
+
+    return """UPDATE duckpass."User" SET keyHash = %s, symmetricKeyEncrypted = %s, salt = %s, kdfAlgorithm = %s, kdfIterations = %s, vault = %s, vaultFormat = %s, vaultHash = %s, vaultRevision = vaultRevision + 1, tokenVersion = tokenVersion + 1 WHERE email = %s AND (%s::BIGINT[] IS NULL OR vaultRevision = ANY(%s)) RETURNING vaultRevision, vaultHash, tokenVersion"""
+
+
+def rehash_update():
+    """
+    Request to replace the master key hash of a user with the same password hashed with other parameters
+    The hash is only replaced if the password was not changed in the meantime
+    :return: Request
+    """
+
+    return """UPDATE duckpass."User" SET keyHash = %s, salt = %s, kdfAlgorithm = %s, kdfIterations = %s WHERE userid = %s AND keyHash = %s"""
+
+
+def revoke_user_tokens():
+    """
+    Request to revoke all the sessions of a user
+    :return: Request
+    """
+
+    return """UPDATE duckpass."User" SET tokenVersion = tokenVersion + 1 WHERE userid = %s RETURNING tokenVersion"""
+
+
+def insert_refresh_token():
+    """
+    Request to insert a refresh token
+    :return: Request
+    """
+
+    return """INSERT INTO duckpass."RefreshToken" (tokenHash, userId, familyId, tokenVersion, expiresAt) VALUES (%s, %s, %s, %s, %s)"""
+
+
+def rotate_refresh_token():
+    """
+    Request to mark an unused refresh token as used and insert the next token of its family, in a single round trip
+    The next token is only inserted if the user's sessions were not revoked since the refresh token was issued
+    :return: Request
+    """
+
+    return """WITH used AS (
+                  UPDATE duckpass."RefreshToken" R SET used = TRUE
+                  FROM duckpass."User" U
+                  WHERE R.tokenHash = %s AND NOT R.used AND R.expiresAt > CURRENT_TIMESTAMP AND U.userId = R.userId
+                  RETURNING R.userId, R.familyId, R.tokenVersion AS refreshVersion, U.tokenVersion, U.email
+              ), inserted AS (
+                  INSERT INTO duckpass."RefreshToken" (tokenHash, userId, familyId, tokenVersion, expiresAt)
+                  SELECT %s, userId, familyId, tokenVersion, %s FROM used WHERE refreshVersion = tokenVersion
+              )
+              SELECT email, tokenVersion, refreshVersion FROM used"""
+
+
+def delete_refresh_token_family():
+    """
+    Request to delete all the refresh tokens of the family of the given token
+    :return: Request
+    """
+
+    return """DELETE FROM duckpass."RefreshToken" WHERE familyId IN (SELECT familyId FROM duckpass."RefreshToken" WHERE tokenHash = %s)"""
+
+
+def delete_used_refresh_token_family():
+    """
+    Request to delete all the refresh tokens of the family of the given token if it was already used
+    :return: Request
+    """
+
+    return """DELETE FROM duckpass."RefreshToken" WHERE familyId IN (SELECT familyId FROM duckpass."RefreshToken" WHERE tokenHash = %s AND used)"""
+
+
+def purge_refresh_tokens():
+    """
+    Request to delete a batch of expired refresh tokens
+    :return: Request
+    """
+
+    return """DELETE FROM duckpass."RefreshToken" WHERE tokenHash IN (SELECT tokenHash FROM duckpass."RefreshToken" WHERE expiresAt <= CURRENT_TIMESTAMP LIMIT %s)"""
+
+
+def take_rate_limit_token():
+    """
+    Request to refill a token bucket for the elapsed time and take a token if one is available
+    :return: Request
+    """
+
+    return """INSERT INTO duckpass."RateLimitBucket" AS B (bucketKey, tokens, allowed, updatedAt)
+              VALUES (%(key)s, %(capacity)s - 1, TRUE, clock_timestamp())
+              ON CONFLICT (bucketKey) DO UPDATE SET
+                  tokens = CASE WHEN LEAST(%(capacity)s, B.tokens + EXTRACT(EPOCH FROM clock_timestamp() - B.updatedAt) * %(rate)s) >= 1
+                                THEN LEAST(%(capacity)s, B.tokens + EXTRACT(EPOCH FROM clock_timestamp() - B.updatedAt) * %(rate)s) - 1
+                                ELSE LEAST(%(capacity)s, B.tokens + EXTRACT(EPOCH FROM clock_timestamp() - B.updatedAt) * %(rate)s) END,
+                  allowed = LEAST(%(capacity)s, B.tokens + EXTRACT(EPOCH FROM clock_timestamp() - B.updatedAt) * %(rate)s) >= 1,
+                  updatedAt = clock_timestamp()
+              RETURNING allowed, tokens"""
+
+
+def purge_rate_limit_buckets():
+    """
+    Request to delete a batch of token buckets idle for an hour, they are full again
+    :return: Request
+    """
+
+    return """DELETE FROM duckpass."RateLimitBucket" WHERE bucketKey IN (SELECT bucketKey FROM duckpass."RateLimitBucket" WHERE updatedAt < CURRENT_TIMESTAMP - INTERVAL '1 hour' LIMIT %s)"""
+
+
+def select_hibp_range():
+    """
+    Request to select a cached Pwned Passwords range response younger than the given number of seconds, with its age
+    :return: Request
+    """
+
+    return """SELECT body, EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - fetchedAt)::float FROM duckpass."HibpRangeCache" WHERE prefix = %s AND fetchedAt > CURRENT_TIMESTAMP - make_interval(secs => %s)"""
+
+
+def upsert_hibp_range():
+    """
+    Request to store a Pwned Passwords range response
+    :return: Request
+    """
+
+    return """INSERT INTO duckpass."HibpRangeCache" (prefix, body, fetchedAt) VALUES (%s, %s, CURRENT_TIMESTAMP) ON CONFLICT (prefix) DO UPDATE SET body = EXCLUDED.body, fetchedAt = EXCLUDED.fetchedAt"""
+
+
+def purge_hibp_ranges():
+    """
+    Request to delete a batch of Pwned Passwords range responses older than the given number of seconds
+    :return: Request
+    """
+
+    return """DELETE FROM duckpass."HibpRangeCache" WHERE prefix IN (SELECT prefix FROM duckpass."HibpRangeCache" WHERE fetchedAt <= CURRENT_TIMESTAMP - make_interval(secs => %s) LIMIT %s)"""
+
+
+def select_breach_cache():
+    """
+    Request to select the cached breaches of a user
+    :return: Request
+    """
+
+    return """SELECT breaches::text FROM duckpass."BreachCache" WHERE userId = %s"""
+
+
+def upsert_breach_cache():
+    """
+    Request to store the breaches of a user
+    :return: Request
+    """
+
+    return """INSERT INTO duckpass."BreachCache" (userId, breaches, fetchedAt) VALUES (%s, %s::jsonb, CURRENT_TIMESTAMP) ON CONFLICT (userId) DO UPDATE SET breaches = EXCLUDED.breaches, fetchedAt = EXCLUDED.fetchedAt"""
+
+
+def delete_breach_cache():
+    """
+    Request to delete the cached breaches of a user
+    :return: Request
+    """
+
+    return """DELETE FROM duckpass."BreachCache" WHERE userId = %s"""
+
+
+def upsert_notified_breaches():
+    """
+    Request to store the breaches of a user along with the breaches the user was notified of
+    :return: Request
+    """
+
+    return """INSERT INTO duckpass."BreachCache" (userId, breaches, fetchedAt, notifiedBreaches) VALUES (%s, %s::jsonb, CURRENT_TIMESTAMP, %s::jsonb) ON CONFLICT (userId) DO UPDATE SET breaches = EXCLUDED.breaches, fetchedAt = EXCLUDED.fetchedAt, notifiedBreaches = EXCLUDED.notifiedBreaches"""
+
+
+def select_stale_breaches():
+    """
+    Request to select the users whose breaches were fetched more than the given number of seconds ago, oldest first
+    :return: Request
+    """
+
+    return """SELECT U.userId, U.email FROM duckpass."BreachCache" B JOIN duckpass."User" U ON U.userId = B.userId WHERE B.fetchedAt <= CURRENT_TIMESTAMP - make_interval(secs => %s) ORDER BY B.fetchedAt LIMIT %s"""
+
+
+def try_advisory_lock():
+    """
+    Request to take a session advisory lock without waiting
+    :return: Request
+    """
+
+    return """SELECT pg_try_advisory_lock(%s)"""
+
+
+def select_sweep_users():
+    """
+    Request to select the next batch of verified users after the given id, with the breaches they were notified of
+    :return: Request
+    """
+
+    return """SELECT U.userId, U.email, B.notifiedBreaches::text FROM duckpass."User" U LEFT JOIN duckpass."BreachCache" B ON B.userId = U.userId WHERE U.verified = TRUE AND U.userId > %s ORDER BY U.userId LIMIT %s"""
+
+
+def select_job_checkpoint():
+    """
+    Request to select the last id processed by a job and the seconds elapsed since
+    :return: Request
+    """
+
+    return """SELECT lastId, EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - updatedAt) FROM duckpass."JobCheckpoint" WHERE jobName = %s"""
+
+
+def upsert_job_checkpoint():
+    """
+    Request to store the last id processed by a job
+    :return: Request
+    """
+
+    return """INSERT INTO duckpass."JobCheckpoint" (jobName, lastId, updatedAt) VALUES (%s, %s, CURRENT_TIMESTAMP) ON CONFLICT (jobName) DO UPDATE SET lastId = EXCLUDED.lastId, updatedAt = EXCLUDED.updatedAt"""
+
+
+def select_job_schedule():
+    """
+    Request to select the seconds before the next run of a job, negative if it is due
+    :return: Request
+    """
+
+    return """SELECT EXTRACT(EPOCH FROM nextRunAt - CURRENT_TIMESTAMP) FROM duckpass."JobSchedule" WHERE jobName = %s"""
+
+
+def upsert_job_schedule():
+    """
+    Request to store the time of the next run of a job, in seconds from now
+    :return: Request
+    """
+
+    return """INSERT INTO duckpass."JobSchedule" (jobName, nextRunAt) VALUES (%s, CURRENT_TIMESTAMP + %s * INTERVAL '1 second') ON CONFLICT (jobName) DO UPDATE SET nextRunAt = EXCLUDED.nextRunAt"""
+
+
+def insert_mail():
+    """
+    Request to queue an email, deduplicated by its key for the given number of seconds if it has one
+    :return: Request
+    """
+
+    return """INSERT INTO duckpass."MailQueue" (recipient, subject, body, bodyText, dedupeKey, dedupeUntil) VALUES (%s, %s, %s, %s, %s, CURRENT_TIMESTAMP + make_interval(secs => %s))"""
+
+
+def lock_mail_dedupe_key():
+    """
+    Request to serialize the transactions queuing an email with the same deduplication key
+    :return: Request
+    """
+
+    return """SELECT pg_advisory_xact_lock(hashtext(%s))"""
+
+
+def select_deduplicated_mail():
+    """
+    Request to check if an email with the given deduplication key is pending or was sent during its window
+    :return: Request
+    """
+
+    return """SELECT 1 FROM duckpass."MailQueue" WHERE dedupeKey = %s AND dedupeUntil > CURRENT_TIMESTAMP AND (nextAttemptAt IS NOT NULL OR sentAt IS NOT NULL)"""
+
+
+def notify_mail_queued():
+    """
+    Request to wake the workers up when an email is queued, the notification is sent on commit
+    :return: Request
+    """
+
+    return """SELECT pg_notify('mail_queued', '')"""
+
+
+def claim_mails():
+    """
+    Request to claim the emails due, hidden from the other workers for the given number of seconds
+    :return: Request
+    """
+
+    return """UPDATE duckpass."MailQueue" SET nextAttemptAt = CURRENT_TIMESTAMP + make_interval(secs => %s) WHERE mailId IN (SELECT mailId FROM duckpass."MailQueue" WHERE nextAttemptAt <= CURRENT_TIMESTAMP ORDER BY nextAttemptAt LIMIT %s FOR UPDATE SKIP LOCKED) RETURNING mailId, recipient, subject, body, bodyText, attempts"""
+
+
+def retry_mail():
+    """
+    Request to schedule the next attempt of an email in the given number of seconds, never if it is null
+    :return: Request
+    """
+
+    return """UPDATE duckpass."MailQueue" SET attempts = %s, nextAttemptAt = CURRENT_TIMESTAMP + make_interval(secs => %s), lastError = %s WHERE mailId = %s"""
+
+
+def delete_mails():
+    """
+    Request to delete the sent emails, except the ones still in their deduplication window
+    :return: Request
+    """
+
+    return """DELETE FROM duckpass."MailQueue" WHERE mailId = ANY(%s) AND (dedupeUntil IS NULL OR dedupeUntil <= CURRENT_TIMESTAMP)"""
+
+
+def mark_mails_sent():
+    """
+    Request to mark the sent emails still in their deduplication window, their content is dropped
+    :return: Request
+    """
+
+    return """UPDATE duckpass."MailQueue" SET sentAt = CURRENT_TIMESTAMP, nextAttemptAt = NULL, body = '', bodyText = NULL WHERE mailId = ANY(%s) AND dedupeUntil > CURRENT_TIMESTAMP"""
+
+
+def purge_sent_mails():
+    """
+    Request to delete the sent emails whose deduplication window is over
+    :return: Request
+    """
+
+    return """DELETE FROM duckpass."MailQueue" WHERE sentAt IS NOT NULL AND dedupeUntil <= CURRENT_TIMESTAMP"""
+
+
+def purge_abandoned_mails():
+    """
+    Request to delete the abandoned emails queued more than the given number of days ago
+    :return: Request
+    """
+
+    return """DELETE FROM duckpass."MailQueue" WHERE nextAttemptAt IS NULL AND sentAt IS NULL AND createdAt < CURRENT_TIMESTAMP - make_interval(days => %s)"""
+
+
+def count_queued_mails():
+    """
+    Request to count the emails waiting to be sent
+    :return: Request
+    """
+
+    return """SELECT COUNT(*) FROM duckpass."MailQueue" WHERE nextAttemptAt IS NOT NULL"""
+
+
+def delete_unverified_users():
+    """
+    Request to delete a batch of accounts not verified for the given number of seconds, after the given creation date
+    and id
+    :return: Request
+    """
+
+    return """WITH batch AS (SELECT userId FROM duckpass."User" WHERE verified = FALSE AND created_at <= CURRENT_TIMESTAMP - make_interval(secs => %s) AND (created_at, userId) > (%s, %s) ORDER BY created_at, userId LIMIT %s) DELETE FROM duckpass."User" U USING batch B WHERE U.userId = B.userId AND U.verified = FALSE RETURNING U.created_at, U.userId"""
+
+
+def select_text_vaults():
+    """
+    Request to select the next batch of vaults stored in the given format after the given user id
+    :return: Request
+    """
+
+    return """SELECT userId, vault FROM duckpass."User" WHERE vaultFormat = %s AND vault IS NOT NULL AND userId > %s ORDER BY userId LIMIT %s"""
+
+
+def convert_vault():
+    """
+    Request to store a vault in a new format, if it was not updated since it was read
+    :return: Request
+    """
+
+    return """UPDATE duckpass."User" SET vault = %s, vaultFormat = %s WHERE userId = %s AND vaultFormat = %s AND vault = %s"""
+
+
+def select_user_profile():
+    """
+    Request to select the data of a user sent to the client, the vault is read only if the first parameter is true
+    and its revision is not one of the given ones
+    :return: Request
+    """
+
+    return """SELECT symmetricKeyEncrypted, CASE WHEN %s AND vaultRevision <> ALL(%s::BIGINT[]) THEN vault END, vaultFormat, vaultRevision, vaultHash FROM duckpass."User" WHERE userId = %s"""
+
+
+def select_vault():
+    """
+    Request to select whether a user has a vault, the stored vault if its revision is not one of the given ones,
+    its format, revision and hash
+    :return: Request
+    """
+
+    return """SELECT vault IS NOT NULL, CASE WHEN vaultRevision <> ALL(%s::BIGINT[]) THEN vault END, vaultFormat, vaultRevision, vaultHash FROM duckpass."User" WHERE userId = %s"""
+
+
+def increase_items_revision():
+    """
+    Request to increase the revision of the items of a user's vault, the row stays locked until the end of the transaction
+    :return: Request
+    """
+
+    return """UPDATE duckpass."User" SET itemsRevision = itemsRevision + 1 WHERE userId = %s RETURNING itemsRevision"""
+
+
+def select_items_revision():
+    """
+    Request to select the revision of the items of a user's vault, and the last revision of its purged tombstones
+    :return: Request
+    """
+
+    return """SELECT itemsRevision, itemsPurgedRevision FROM duckpass."User" WHERE userId = %s"""
+
+
+def select_vault_item_ids():
+    """
+    Request to select the ids of the items of a user's vault, without the tombstones
+    :return: Request
+    """
+
+    return """SELECT itemId FROM duckpass."VaultItem" WHERE userId = %s AND NOT deleted"""
+
+
+def select_vault_item_revisions():
+    """
+    Request to select the revisions of the given items of a user's vault
+    :return: Request
+    """
+
+    return """SELECT itemId, revision FROM duckpass."VaultItem" WHERE userId = %s AND itemId = ANY(%s)"""
+
+
+def upsert_vault_item():
+    """
+    Request to insert or update an item of a user's vault
+    :return: Request
+    """
+
+    return """INSERT INTO duckpass."VaultItem" (userId, itemId, data, itemFormat, revision, deleted) VALUES (%s, %s, %s, %s, %s, FALSE) ON CONFLICT (userId, itemId) DO UPDATE SET data = EXCLUDED.data, itemFormat = EXCLUDED.itemFormat, revision = EXCLUDED.revision, deleted = FALSE, updatedAt = CURRENT_TIMESTAMP"""
+
+
+def delete_vault_items():
+    """
+    Request to replace the given items of a user's vault with tombstones, kept for the clients not synced yet
+    :return: Request
+    """
+
+    return """UPDATE duckpass."VaultItem" SET data = NULL, revision = %s, deleted = TRUE, updatedAt = CURRENT_TIMESTAMP WHERE userId = %s AND itemId = ANY(%s)"""
+
+
+def purge_vault_item_tombstones():
+    """
+    Request to delete a batch of tombstones older than the given number of days
+    The users keep the last revision purged, the clients synced before it must sync all the items again
+    :return: Request
+    """
+
+    return """WITH purged AS (DELETE FROM duckpass."VaultItem" WHERE (userId, itemId) IN (SELECT userId, itemId FROM duckpass."VaultItem" WHERE deleted AND updatedAt < CURRENT_TIMESTAMP - make_interval(days => %s) LIMIT %s) RETURNING userId, revision),
+              users AS (UPDATE duckpass."User" U SET itemsPurgedRevision = GREATEST(U.itemsPurgedRevision, P.revision) FROM (SELECT userId, MAX(revision) AS revision FROM purged GROUP BY userId) P WHERE U.userId = P.userId)
+              SELECT COUNT(*) FROM purged"""
+
+
+def select_vault_item_changes():
+    """
+    Request to select the items of a user's vault changed after the given revision, or in it after the given item id,
+    up to a revision, in the order of the changes
+    :return: Request
+    """
+
+    return """SELECT itemId, data, itemFormat, revision, deleted FROM duckpass."VaultItem" WHERE userId = %s AND (revision > %s OR revision = %s AND itemId > %s) AND revision <= %s ORDER BY revision, itemId LIMIT %s"""
+
+
+def notify_vault_changed():
+    """
+    Request to notify all the workers that a user's vault changed, the notification is sent on commit
     :return: Request
     """
 
-    return """UPDATE duckpass."User" SET keyHash = %s, symmetricKeyEncrypted = %s, salt = %s, vault = %s WHERE email = %s"""
+    return """SELECT pg_notify('vault_changed', %s)"""
@@ -0,0 +1,158 @@
+import asyncio
+import json
+import os
+from typing import Optional
+from .database import notify_vault_changed
+from .listener import listener
+from .metrics import register_metrics
+from .revocation import revocation_index
+
+VAULT_CHANNEL = "vault_changed"  # Channel of the notifications sent when a vault changes
+VAULT_EVENTS_QUEUE = int(os.environ.get('VAULT_EVENTS_QUEUE', 16))  # Events kept for a client reading them slowly
+
+
+class VaultEventHub:
+    """
+    Subscribers of the worker waiting for the changes of their vault, each with its own queue of events
+    The events come from the notifications sent by the vault write paths of every worker, received by the shared
+    notification listener. Events may be missed while the listener is disconnected, so a "resync" event is sent to
+    every subscriber when it reconnects. A subscriber whose token is revoked receives None, ending its stream.
+    """
+
+    def __init__(self, queue_size: int):
+        self._queue_size = queue_size
+        self._subscribers: dict[int, set[asyncio.Queue]] = {}
+        self._tokens: dict[asyncio.Queue, tuple[bytes, int]] = {}  # Digest and version of the token of each queue
+        self._digests: dict[bytes, set[asyncio.Queue]] = {}
+
+        self.events = 0
+        self.dropped = 0
+        self.closed = 0
+
+    def subscribe(self, user_id: int, digest: bytes = b"", token_version: int = 0) -> asyncio.Queue:
+        """
+        Subscribe to the changes of a user's vault
+        :param int user_id: Id of the user
+        :param bytes digest: Digest of the token of the subscriber
+        :param int token_version: Version of the token of the subscriber
+        :return: Queue receiving the events
+        """
+
+        queue = asyncio.Queue(self._queue_size)
+        self._subscribers.setdefault(user_id, set()).add(queue)
+        self._tokens[queue] = (digest, token_version)
+        self._digests.setdefault(digest, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, user_id: int, queue: asyncio.Queue):
+        """
+        Stop sending the changes of a user's vault to a queue
+        :param int user_id: Id of the user
+        :param Queue queue: Queue of the subscriber
+        :return: None
+        """
+
+        queues = self._subscribers.get(user_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[user_id]
+
+        digest, _ = self._tokens.pop(queue, (None, 0))
+        queues = self._digests.get(digest)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self._digests[digest]
+
+    def publish(self, queue: asyncio.Queue, event: Optional[dict]):
+        """
+        Send an event to a subscriber, the oldest event is dropped if the subscriber does not keep up
+        :param Queue queue: Queue of the subscriber
+        :param dict event: Event, None to end the stream
+        :return: None
+        """
+
+        if queue.full():
+            queue.get_nowait()
+            self.dropped += 1
+        queue.put_nowait(event)
+        self.events += 1
+
+    def close(self, queue: asyncio.Queue):
+        """
+        End the stream of a subscriber whose token is no longer valid
+        :param Queue queue: Queue of the subscriber
+        :return: None
+        """
+
+        self.publish(queue, None)
+        self.closed += 1
+
+    def on_notification(self, payload: str):
+        """
+        Send a change notification to the subscribers of the user
+        A "revoked" event ends the streams opened with a token older than its version instead
+        :param str payload: JSON event, with the id of the user
+        :return: None
+        """
+
+        event = json.loads(payload)
+        for queue in list(self._subscribers.get(event.pop("user"), ())):
+            if event["type"] != "revoked":
+                self.publish(queue, event)
+            elif self._tokens[queue][1] < event["version"]:
+                self.close(queue)
+
+    def on_token_revoked(self, digest: bytes):
+        """
+        End the streams opened with a revoked token
+        :param bytes digest: Digest of the token
+        :return: None
+        """
+
+        for queue in list(self._digests.get(digest, ())):
+            self.close(queue)
+
+    async def on_connect(self):
+        """
+        Ask the subscribers to fetch their vault, its changes may have been missed while the listener was disconnected
+        :return: None
+        """
+
+        for queues in list(self._subscribers.values()):
+            for queue in list(queues):
+                self.publish(queue, {"type": "resync"})
+
+    def stats(self) -> dict:
+        """
+        Counters of the subscribers
+        :return: Subscribers, users having subscribers, events sent, events dropped and streams closed on revocation
+        """
+
+        return {
+            "subscribers": sum(len(queues) for queues in self._subscribers.values()),
+            "users": len(self._subscribers),
+            "events": self.events,
+            "dropped": self.dropped,
+            "closed": self.closed,
+        }
+
+
+async def notify_vault_change(cur, user_id: int, event: dict):
+    """
+    Notify all the workers that a user's vault changed, with the cursor of the transaction changing it
+    The notification is sent when the transaction commits
+    :param cur: Database cursor
+    :param int user_id: Id of the user
+    :param dict event: Event sent to the subscribers, with its type
+    :return: None
+    """
+
+    await cur.execute(notify_vault_changed(), (json.dumps({"user": user_id, **event}),))
+
+
+vault_events = VaultEventHub(VAULT_EVENTS_QUEUE)
+listener.subscribe(VAULT_CHANNEL, vault_events.on_notification, on_connect=vault_events.on_connect)
+revocation_index.add_listener(vault_events.on_token_revoked)
+register_metrics("vault_events", vault_events.stats)
@@ -1,8 +1,276 @@
-import hibpwned
+import asyncio
+import logging
 import os
+import random
+import httpx
+import psycopg
+from fastapi import HTTPException, status
+from typing import AsyncIterator, Awaitable, Callable, Optional
+from urllib.parse import quote
+from .cache import LruCache
+from .database import insert_update_delete_request, select_request, select_hibp_range, upsert_hibp_range, \
+    purge_hibp_ranges
+from .metrics import register_metrics
+from .pwned_dataset import PwnedDataset
 
 API_KEY = os.environ.get("HIBP_API_KEY")
 USER_AGENT = os.environ.get("USER_AGENT")
+HIBP_API_URL = os.environ.get("HIBP_API_URL", "https://haveibeenpwned.com/api/v3")  # Breaches API
+HIBP_PASSWORDS_URL = os.environ.get("HIBP_PASSWORDS_URL", "https://api.pwnedpasswords.com")  # Pwned Passwords API
+HIBP_TIMEOUT = float(os.environ.get("HIBP_TIMEOUT", 5))  # Seconds before a request to HIBP is abandoned
+HIBP_MAX_RETRIES = int(os.environ.get("HIBP_MAX_RETRIES", 2))  # Retries of a failed or throttled request
+HIBP_MAX_CONNECTIONS = int(os.environ.get("HIBP_MAX_CONNECTIONS", 20))  # Connections kept open to HIBP
+HIBP_BACKOFF = 0.5  # Seconds before the first retry, doubled at each retry
+HIBP_MAX_BACKOFF = 10  # Maximum seconds before a retry
+HIBP_RANGE_CACHE_TTL = float(os.environ.get("HIBP_RANGE_CACHE_TTL", 86400))  # Seconds a range response is cached
+HIBP_RANGE_CACHE_BYTES = int(os.environ.get("HIBP_RANGE_CACHE_BYTES", 64 * 1024 * 1024))  # Memory of the cache
+HIBP_RANGE_SHARED_CACHE = os.environ.get("HIBP_RANGE_SHARED_CACHE", "false").lower() == "true"  # Cache in the database
+HIBP_PASSWORDS_DATASET = os.environ.get("HIBP_PASSWORDS_DATASET")  # Local dataset answering the range queries
+HIBP_BATCH_CONCURRENCY = int(os.environ.get("HIBP_BATCH_CONCURRENCY", 8))  # Ranges of a batch fetched at once
+HIBP_BATCH_MAX_PREFIXES = int(os.environ.get("HIBP_BATCH_MAX_PREFIXES", 1000))  # Prefixes accepted in a batch
+HIBP_RANGE_PURGE_EVERY = 1000  # Shared cache stores between two purges of the expired responses
+
+logger = logging.getLogger(__name__)
+
+
+class HibpClient:
+    """
+    Asynchronous client of the HIBP APIs, the connections are kept alive and shared by all the requests
+    Failed requests (network errors, throttling, server errors) are retried with an exponential backoff
+    """
+
+    def __init__(self, api_url: str, passwords_url: str, transport: httpx.AsyncBaseTransport = None):
+        self.api_url = api_url.rstrip("/")
+        self.passwords_url = passwords_url.rstrip("/")
+        self._transport = transport
+        self._client = None
+
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+
+    def _get_client(self) -> httpx.AsyncClient:
+        """
+        Get the HTTP client, it is created at first use
+        :return: HTTP client
+        """
+
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=HIBP_TIMEOUT,
+                limits=httpx.Limits(max_connections=HIBP_MAX_CONNECTIONS,
+                                    max_keepalive_connections=HIBP_MAX_CONNECTIONS),
+                headers={"User-Agent": USER_AGENT or "DuckPass"},
+                transport=self._transport,
+            )
+        return self._client
+
+    def _unavailable(self):
+        """
+        Raise the error returned when HIBP cannot be reached
+        :return: None
+        """
+
+        self.failures += 1
+        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail="HIBP service unavailable")
+
+    async def get(self, url: str, headers: dict = None) -> httpx.Response:
+        """
+        Send a GET request, retried on network errors, throttling and server errors
+        :param str url: URL to get
+        :param dict headers: Headers of the request
+        :return: Response of HIBP
+        """
+
+        for attempt in range(HIBP_MAX_RETRIES + 1):
+            self.requests += 1
+            delay = min(HIBP_MAX_BACKOFF, HIBP_BACKOFF * 2 ** attempt) * (1 + random.random() / 2)
+            try:
+                response = await self._get_client().get(url, headers=headers)
+            except httpx.TransportError:
+                response = None
+            else:
+                if response.status_code != 429 and response.status_code < 500:
+                    return response
+                # HIBP tells how long to wait when it throttles
+                retry_after = response.headers.get("Retry-After")
+                if retry_after and retry_after.isdigit():
+                    delay = int(retry_after)
+
+            if attempt == HIBP_MAX_RETRIES or delay > HIBP_MAX_BACKOFF:
+                break
+            self.retries += 1
+            await asyncio.sleep(delay)
+
+        self._unavailable()
+
+    async def breached_account(self, email: str) -> list:
+        """
+        Get the breaches an account appears in
+        :param str email: Email of the account
+        :return: Breaches of the account, with all their attributes
+        """
+
+        response = await self.get(f"{self.api_url}/breachedaccount/{quote(email)}?truncateResponse=false",
+                                  headers={"hibp-api-key": API_KEY or ""})
+        if response.status_code == 404:
+            return []
+        if response.status_code != 200:
+            self._unavailable()
+        return response.json()
+
+    async def password_range(self, hash_begin: str) -> str:
+        """
+        Get the suffixes of the pwned password hashes starting with the given prefix
+        :param str hash_begin: First 5 characters of the SHA-1 hash of the password
+        :return: Suffixes of the hashes and their number of occurrences, one per line
+        """
+
+        response = await self.get(f"{self.passwords_url}/range/{quote(hash_begin[:5])}")
+        if response.status_code != 200:
+            self._unavailable()
+        return response.text
+
+    async def close(self):
+        """
+        Close the connections
+        :return: None
+        """
+
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> dict:
+        """
+        Counters of the client
+        :return: Requests sent, retried and failed
+        """
+
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "failures": self.failures,
+        }
+
+
+class RangeCache:
+    """
+    Cache of the Pwned Passwords range responses by prefix, kept in the memory of the worker and optionally in the
+    database to share them with the other workers
+    Concurrent misses for the same prefix wait for a single fetch
+    """
+
+    def __init__(self, max_bytes: int, ttl: float, shared: bool):
+        self.local = LruCache(max_bytes, ttl)
+        self.ttl = ttl
+        self.shared = shared
+        self._pending: dict[str, asyncio.Future] = {}
+
+        self.shared_hits = 0
+        self.shared_errors = 0
+        self.fetches = 0
+        self.coalesced = 0
+        self._stores = 0
+
+    async def _get_shared(self, prefix: str):
+        """
+        Get a response from the database, errors are ignored to fall back on HIBP
+        :param str prefix: Prefix of the range
+        :return: Response and its age in seconds, None if it is missing or expired
+        """
+
+        try:
+            return await select_request(select_hibp_range(), (prefix, self.ttl))
+        except psycopg.Error:
+            self.shared_errors += 1
+            return None
+
+    async def _set_shared(self, prefix: str, body: str):
+        """
+        Store a response in the database, errors are ignored
+        :param str prefix: Prefix of the range
+        :param str body: Response
+        :return: None
+        """
+
+        try:
+            self._stores += 1
+            if self._stores % HIBP_RANGE_PURGE_EVERY == 0:
+                await insert_update_delete_request(purge_hibp_ranges(), (self.ttl, HIBP_RANGE_PURGE_EVERY))
+            await insert_update_delete_request(upsert_hibp_range(), (prefix, body))
+        except psycopg.Error:
+            self.shared_errors += 1
+
+    async def _load(self, prefix: str, fetch: Callable[[str], Awaitable[str]]) -> str:
+        """
+        Load a response missing in memory, from the database or from HIBP
+        :param str prefix: Prefix of the range
+        :param fetch: Function getting the response from HIBP
+        :return: Response
+        """
+
+        row = await self._get_shared(prefix) if self.shared else None
+        if row is not None:
+            # Kept in memory for the rest of its time to live only, not older than a response fetched by this worker
+            body, age = row
+            self.shared_hits += 1
+            self.local.set(prefix, body, max(self.ttl - age, 0))
+            return body
+
+        self.fetches += 1
+        body = await fetch(prefix)
+        if self.shared:
+            await self._set_shared(prefix, body)
+        self.local.set(prefix, body)
+        return body
+
+    async def get(self, prefix: str, fetch: Callable[[str], Awaitable[str]]) -> str:
+        """
+        Get the response of a range
+        :param str prefix: Prefix of the range
+        :param fetch: Function getting the response from HIBP on a miss
+        :return: Response
+        """
+
+        prefix = prefix[:5].upper()
+        body = self.local.get(prefix)
+        if body is not None:
+            return body
+
+        pending = self._pending.get(prefix)
+        if pending is not None:
+            self.coalesced += 1
+            return await asyncio.shield(pending)
+
+        pending = asyncio.ensure_future(self._load(prefix, fetch))
+        self._pending[prefix] = pending
+        pending.add_done_callback(lambda _: self._pending.pop(prefix, None))
+        return await asyncio.shield(pending)
+
+    def stats(self) -> dict:
+        """
+        Counters of the cache
+        :return: Counters of the memory tier, hits of the shared tier, fetches from HIBP and coalesced misses
+        """
+
+        return {
+            **self.local.stats(),
+            "shared": self.shared,
+            "shared_hits": self.shared_hits,
+            "shared_errors": self.shared_errors,
+            "fetches": self.fetches,
+            "coalesced": self.coalesced,
+        }
+
+
+hibp_client = HibpClient(HIBP_API_URL, HIBP_PASSWORDS_URL)
+register_metrics("hibp", hibp_client.stats)
+range_cache = RangeCache(HIBP_RANGE_CACHE_BYTES, HIBP_RANGE_CACHE_TTL, HIBP_RANGE_SHARED_CACHE)
+register_metrics("hibp_range_cache", range_cache.stats)
+password_dataset = PwnedDataset(HIBP_PASSWORDS_DATASET) if HIBP_PASSWORDS_DATASET else None
+if password_dataset is not None:
+    register_metrics("pwned_dataset", password_dataset.stats)
 
 
 async def get_breach_for_user(email):
@@ -11,10 +279,7 @@ async def get_breach_for_user(email):
     :param str email: Email of the user
     """
 
-    hibp = hibpwned.Pwned(email, USER_AGENT, API_KEY)
-    all_my_breaches = hibp.search_all_breaches()
-    if all_my_breaches == 404:
-        return []
+    all_my_breaches = await hibp_client.breached_account(email)
     return [{'Name': breach['Name'], 'Domain': breach['Domain'], 'BreachDate': breach['BreachDate'], 'DataClasses': breach['DataClasses']} for breach in all_my_breaches]
 
 
@@ -25,7 +290,38 @@ async def get_breach_for_password(email, hash_begin):
     :param str hash_begin: Beginning of the hash of the password
     """
 
-    hibp = hibpwned.Pwned(email, USER_AGENT, API_KEY)
-    hashes = hibp.search_hashes(hash_begin)
+    if password_dataset is not None:
+        return password_dataset.password_range(hash_begin)
+    hashes = await range_cache.get(hash_begin, hibp_client.password_range)
     return hashes
 
+
+async def get_breaches_for_passwords(email, hash_begins) -> AsyncIterator[tuple[str, Optional[str], Optional[str]]]:
+    """
+    Function to get the breaches for many passwords, a bounded number of ranges is fetched at once
+    :param str email: Email of the user
+    :param list hash_begins: Beginnings of the hashes of the passwords, without duplicates
+    :return: Beginning of the hash, its breaches and the error that occurred, in the order the ranges are fetched
+    """
+
+    semaphore = asyncio.Semaphore(HIBP_BATCH_CONCURRENCY)
+
+    async def lookup(hash_begin):
+        async with semaphore:
+            try:
+                return hash_begin, await get_breach_for_password(email, hash_begin), None
+            except HTTPException as exc:
+                return hash_begin, None, exc.detail
+            except Exception:
+                # The other ranges of the batch are still sent
+                logger.exception("Error while fetching the range %s", hash_begin)
+                return hash_begin, None, "Unexpected error"
+
+    tasks = [asyncio.ensure_future(lookup(hash_begin)) for hash_begin in hash_begins]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        # The client may disconnect before the end of the batch
+        for task in tasks:
+            task.cancel()
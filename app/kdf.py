@@ -0,0 +1,166 @@
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from fastapi import HTTPException, status
+from .crypto import KDF_ALGORITHM, PBKDF_NUM_ITERATIONS, generate_master_key_hash, verify_master_key_hash
+from .metrics import register_metrics
+
+KDF_POOL_SIZE = int(os.environ.get('KDF_POOL_SIZE', os.cpu_count() or 1))  # Number of processes deriving keys
+KDF_MAX_QUEUE = int(os.environ.get('KDF_MAX_QUEUE', 64))  # Maximum number of derivations waiting for a process
+KDF_QUEUE_TIMEOUT = float(os.environ.get('KDF_QUEUE_TIMEOUT', 5))  # Seconds a derivation may wait for a process
+
+
+class KdfExecutor:
+    """
+    Runs the key derivations in a pool of processes, so they neither block the event loop nor
+    compete with it for the GIL. Derivations waiting for a free process are bounded in number and
+    in time, the caller gets a 503 error when the pool is saturated.
+    """
+
+    def __init__(self, pool_size: int, max_queue: int, queue_timeout: float):
+        self.pool_size = pool_size
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._pool = None
+        self._slots = asyncio.Semaphore(pool_size)
+
+        self.waiting = 0
+        self.running = 0
+        self.completed = 0
+        self.failures = 0
+        self.rejected = 0
+        self.wait_seconds = 0.0
+        self.run_seconds = 0.0
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        """
+        Get the process pool, it is created at first use
+        :return: Process pool
+        """
+
+        if self._pool is None:
+            # Spawned processes only import app.crypto, instead of a fork of the running server
+            self._pool = ProcessPoolExecutor(max_workers=self.pool_size,
+                                             mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    def _reject(self):
+        """
+        Reject a derivation because the pool is saturated
+        :return: None
+        """
+
+        self.rejected += 1
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Server busy, please retry later",
+                            headers={"Retry-After": "1"})
+
+    async def run(self, fn, *args):
+        """
+        Run the given function in the process pool once a process is available
+        :param Function fn: Function to run, must be importable by the processes
+        :param args: Arguments of the function
+        :return: Result of the function
+        """
+
+        if self.waiting >= self.max_queue:
+            self._reject()
+
+        queued_at = time.perf_counter()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._reject()
+        finally:
+            self.waiting -= 1
+
+        started_at = time.perf_counter()
+        self.wait_seconds += started_at - queued_at
+        self.running += 1
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self._get_pool(), fn, *args)
+        except BrokenProcessPool:
+            # A process died, the next derivation will start a new pool
+            self.failures += 1
+            self._pool = None
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail="Server busy, please retry later",
+                                headers={"Retry-After": "1"})
+        except Exception:
+            self.failures += 1
+            raise
+        finally:
+            self.running -= 1
+            self._slots.release()
+
+        # Only the derivations that completed count in the run time, a failure may return early
+        self.completed += 1
+        self.run_seconds += time.perf_counter() - started_at
+        return result
+
+    def shutdown(self):
+        """
+        Stop the processes of the pool
+        :return: None
+        """
+
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+
+    def stats(self) -> dict:
+        """
+        Counters of the executor
+        :return: Queue depth, running derivations, completed, failed and rejected derivations and latency counters
+        """
+
+        started = self.completed + self.failures
+        return {
+            "pool_size": self.pool_size,
+            "queue_depth": self.waiting,
+            "running": self.running,
+            "completed": self.completed,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "wait_seconds_total": self.wait_seconds,
+            "run_seconds_total": self.run_seconds,
+            "average_wait_seconds": self.wait_seconds / started if started else 0.0,
+            "average_run_seconds": self.run_seconds / self.completed if self.completed else 0.0,
+        }
+
+
+kdf_executor = KdfExecutor(KDF_POOL_SIZE, KDF_MAX_QUEUE, KDF_QUEUE_TIMEOUT)
+register_metrics("kdf", kdf_executor.stats)
+
+
+async def derive(master_password_hash: bytes, algorithm: str = KDF_ALGORITHM,
+                 iterations: int = PBKDF_NUM_ITERATIONS) -> tuple[bytes, bytes]:
+    """
+    Generates a salt and a hash of the given master password hash without blocking the event loop
+    :param bytes master_password_hash: Hash of the master password
+    :param str algorithm: Name of the key derivation function
+    :param int iterations: Cost of the derivation
+    :return: Tuple of salt and hash of the master password hash
+    """
+
+    return await kdf_executor.run(generate_master_key_hash, master_password_hash, algorithm, iterations)
+
+
+async def verify(received_hash: bytes, salt: bytes, current_master_key_hash: bytes, algorithm: str = KDF_ALGORITHM,
+                 iterations: int = PBKDF_NUM_ITERATIONS) -> bool:
+    """
+    Verifies the given hash corresponds to the current master key hash without blocking the event loop
+    :param bytes received_hash: Hash received from the client
+    :param bytes salt: Salt used to generate the master key hash
+    :param bytes current_master_key_hash: Master key hash to compare with
+    :param str algorithm: Name of the key derivation function used to generate the master key hash
+    :param int iterations: Cost of the derivation used to generate the master key hash
+    :return: True if the hashes match, False otherwise
+    """
+
+    return await kdf_executor.run(verify_master_key_hash, received_hash, salt, current_master_key_hash,
+                                  algorithm, iterations)
@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import psycopg
+from psycopg import sql
+from typing import Awaitable, Callable
+from .database import connection_kwargs
+
+logger = logging.getLogger(__name__)
+
+LISTENER_RECONNECT_DELAY = 5  # Seconds to wait before reconnecting the listener
+
+
+class NotificationListener:
+    """
+    Dedicated connection of the worker listening to PostgreSQL notifications (LISTEN/NOTIFY)
+    Each channel has a handler called with the payload of the notifications, and callbacks called
+    each time the connection is (re)established or lost, so subscribers can resynchronize their state.
+    """
+
+    def __init__(self):
+        self._handlers: dict[str, Callable[[str], None]] = {}
+        self._on_connect: list[Callable[[], Awaitable[None]]] = []
+        self._on_disconnect: list[Callable[[], None]] = []
+        self._task = None
+        self.connected = False
+
+    def subscribe(self, channel: str, handler: Callable[[str], None],
+                  on_connect: Callable[[], Awaitable[None]] = None, on_disconnect: Callable[[], None] = None):
+        """
+        Subscribe to a notification channel, must be called before the listener starts
+        :param str channel: Name of the channel
+        :param Function handler: Function called with the payload of each notification
+        :param Function on_connect: Coroutine function called once the channel is listened to
+        :param Function on_disconnect: Function called when the connection is lost
+        :return: None
+        """
+
+        self._handlers[channel] = handler
+        if on_connect:
+            self._on_connect.append(on_connect)
+        if on_disconnect:
+            self._on_disconnect.append(on_disconnect)
+
+    def start(self):
+        """
+        Start listening in a background task
+        :return: None
+        """
+
+        if self._task is None and self._handlers:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+        Stop listening and close the connection
+        :return: None
+        """
+
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _listen(self):
+        """
+        Open the connection, listen to the channels and dispatch the notifications until the connection is lost
+        :return: None
+        """
+
+        conn = await psycopg.AsyncConnection.connect(autocommit=True, keepalives=1, keepalives_idle=30,
+                                                     **connection_kwargs)
+        async with conn:
+            for channel in self._handlers:
+                await conn.execute(sql.SQL("LISTEN {}").format(sql.Identifier(channel)))
+
+            # Notifications sent while the callbacks run are queued on the connection, so nothing is missed
+            for callback in self._on_connect:
+                await callback()
+            self.connected = True
+
+            async for notify in conn.notifies():
+                try:
+                    self._handlers[notify.channel](notify.payload)
+                except Exception:
+                    logger.exception("Error while handling notification on %s", notify.channel)
+
+    async def _run(self):
+        """
+        Listen forever, reconnecting when the connection is lost
+        :return: None
+        """
+
+        while True:
+            try:
+                await self._listen()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Notification listener disconnected")
+            finally:
+                self.connected = False
+                for callback in self._on_disconnect:
+                    callback()
+            await asyncio.sleep(LISTENER_RECONNECT_DELAY)
+
+
+listener = NotificationListener()
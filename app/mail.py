@@ -1,25 +1,44 @@
+import asyncio
+import logging
+import random
+import time
+import aiosmtplib
+from email.message import EmailMessage
 from typing import Callable
-from fastapi_mail import ConnectionConfig, FastMail, MessageSchema
 from .auth import *
+from .listener import listener
+from .metrics import register_metrics
 
-conf = ConnectionConfig(
-    MAIL_USERNAME=os.environ.get('EMAIL_USERNAME'),
-    MAIL_PASSWORD=os.environ.get('EMAIL_PASSWORD'),
-    MAIL_FROM=os.environ.get('EMAIL_FROM'),
-    MAIL_PORT=int(os.environ.get('EMAIL_PORT')),
-    MAIL_SERVER=os.environ.get('EMAIL_HOST'),
-    MAIL_STARTTLS=True,
-    MAIL_SSL_TLS=False,
-    USE_CREDENTIALS=True
-)
+EMAIL_HOST = os.environ.get('EMAIL_HOST')  # SMTP server
+EMAIL_PORT = int(os.environ.get('EMAIL_PORT'))  # SMTP port
+EMAIL_USERNAME = os.environ.get('EMAIL_USERNAME')  # SMTP user
+EMAIL_PASSWORD = os.environ.get('EMAIL_PASSWORD')  # SMTP password
+EMAIL_FROM = os.environ.get('EMAIL_FROM')  # Sender of the emails
+EMAIL_STARTTLS = os.environ.get('EMAIL_STARTTLS', 'true').lower() == 'true'  # Upgrade the connection with STARTTLS
+EMAIL_SSL_TLS = os.environ.get('EMAIL_SSL_TLS', 'false').lower() == 'true'  # Connect with implicit TLS
+EMAIL_USE_CREDENTIALS = os.environ.get('EMAIL_USE_CREDENTIALS', 'true').lower() == 'true'  # Login to the server
+MAIL_WORKERS = int(os.environ.get('MAIL_WORKERS', 1))  # Tasks sending the queued emails per worker
+MAIL_BATCH_SIZE = int(os.environ.get('MAIL_BATCH_SIZE', 20))  # Emails claimed from the queue at once
+MAIL_MAX_ATTEMPTS = int(os.environ.get('MAIL_MAX_ATTEMPTS', 8))  # Attempts before an email is abandoned
+MAIL_ABANDONED_RETENTION = int(os.environ.get('MAIL_ABANDONED_RETENTION', 30))  # Days the abandoned emails are kept
+MAIL_POLL_INTERVAL = 5  # Seconds between two checks of the queue without notification
+MAIL_LEASE = 300  # Seconds a claimed email is hidden from the other workers, sent again after a crash
+MAIL_BACKOFF = 30  # Seconds before the first retry, doubled at each retry
+MAIL_MAX_BACKOFF = 3600  # Maximum seconds before a retry
+MAIL_IDLE_TIMEOUT = 60  # Seconds an unused SMTP connection is kept open
+MAIL_TIMEOUT = 10  # Seconds before an SMTP command is abandoned
+MAIL_PURGE_EVERY = 100  # Checks of the queue between two purges of the sent and abandoned emails
+MAIL_CHANNEL = "mail_queued"  # Notification channel waking the workers up
 
+logger = logging.getLogger(__name__)
 
-async def send_email(mail: str, mail_template: Callable[[str], tuple]):
+
+def render_email(mail: str, mail_template: Callable[[str], tuple]) -> tuple:
     """
-    Sends an email to the given mail address with the given template
+    Renders the template of an email for the given mail address
     :param str mail: Mail address to send the email to
-    :param Function mail_template: Function that returns a tuple with the subject and the template
-    :return: None
+    :param Function mail_template: Function that returns a tuple with the subject, the HTML and the plain text
+    :return: Subject, HTML body and plain text body of the email
     """
 
     # Create token to identify the user in the email
@@ -28,14 +47,273 @@ async def send_email(mail: str, mail_template: Callable[[str], tuple]):
         data={"sub": mail}, expires_delta=access_token_expires
     )
 
-    subject, template = mail_template(access_token)
+    return mail_template(access_token)
+
+
+async def enqueue_email(cur, mail: str, mail_template: Callable[[str], tuple], dedupe_key: str = None,
+                        dedupe_window: float = None) -> bool:
+    """
+    Queues an email in the transaction of the given cursor, it is sent once the transaction is committed
+    An email with a deduplication key is not queued again while the previous one is pending or was sent in its window
+    :param cur: Database cursor
+    :param str mail: Mail address to send the email to
+    :param Function mail_template: Function that returns a tuple with the subject, the HTML and the plain text
+    :param str dedupe_key: Key of the deduplicated emails
+    :param float dedupe_window: Seconds during which an email with the same key is not queued again
+    :return: True if the email was queued, False if it is a duplicate
+    """
+
+    if dedupe_key:
+        await cur.execute(lock_mail_dedupe_key(), (dedupe_key,))
+        await cur.execute(select_deduplicated_mail(), (dedupe_key,))
+        if await cur.fetchone():
+            return False
+
+    subject, html, text = render_email(mail, mail_template)
+    await cur.execute(insert_mail(), (mail, subject, html, text, dedupe_key, dedupe_window if dedupe_key else None))
+    await cur.execute(notify_mail_queued())
+    return True
+
+
+async def send_email(mail: str, mail_template: Callable[[str], tuple]):
+    """
+    Sends an email to the given mail address with the given template, through the mail queue
+    :param str mail: Mail address to send the email to
+    :param Function mail_template: Function that returns a tuple with the subject, the HTML and the plain text
+    :return: None
+    """
+
+    async with db_cursor() as cur:
+        await enqueue_email(cur, mail, mail_template)
+
+
+class SmtpConnection:
+    """
+    Connection to the SMTP server kept open and authenticated between the emails
+    """
+
+    def __init__(self, hostname: str, port: int, start_tls: bool, use_tls: bool, username: str = None,
+                 password: str = None):
+        self._smtp = aiosmtplib.SMTP(hostname=hostname, port=port, start_tls=start_tls, use_tls=use_tls,
+                                     username=username, password=password, timeout=MAIL_TIMEOUT)
+        self._last_used = 0.0
+        self.connections = 0
+
+    async def _connect(self):
+        """
+        Open the connection if it is closed, a STARTTLS upgrade and the login happen at connection
+        :return: None
+        """
+
+        if not self._smtp.is_connected:
+            await self._smtp.connect()
+            self.connections += 1
+
+    async def send(self, message: EmailMessage):
+        """
+        Send an email, the connection is opened again once if the server closed it
+        :param EmailMessage message: Email to send
+        :return: None
+        """
+
+        await self._connect()
+        try:
+            await self._smtp.send_message(message)
+        except aiosmtplib.SMTPServerDisconnected:
+            self._smtp.close()
+            await self._connect()
+            await self._smtp.send_message(message)
+        self._last_used = time.monotonic()
+
+    async def close_idle(self):
+        """
+        Close the connection if it was not used recently, before the server drops it
+        :return: None
+        """
+
+        if self._smtp.is_connected and time.monotonic() - self._last_used > MAIL_IDLE_TIMEOUT:
+            await self.close()
+
+    async def close(self):
+        """
+        Close the connection
+        :return: None
+        """
+
+        if self._smtp.is_connected:
+            try:
+                await self._smtp.quit()
+            except aiosmtplib.SMTPException:
+                self._smtp.close()
+
+
+def smtp_connection() -> SmtpConnection:
+    """
+    Create a connection to the configured SMTP server
+    :return: SMTP connection
+    """
+
+    return SmtpConnection(EMAIL_HOST, EMAIL_PORT, EMAIL_STARTTLS, EMAIL_SSL_TLS,
+                          EMAIL_USERNAME if EMAIL_USE_CREDENTIALS else None,
+                          EMAIL_PASSWORD if EMAIL_USE_CREDENTIALS else None)
+
+
+def mail_message(recipient: str, subject: str, body: str, body_text: str = None) -> EmailMessage:
+    """
+    Build an email
+    :param str recipient: Mail address to send the email to
+    :param str subject: Subject of the email
+    :param str body: HTML body of the email
+    :param str body_text: Plain text alternative of the body
+    :return: Email
+    """
+
+    message = EmailMessage()
+    message["From"] = EMAIL_FROM
+    message["To"] = recipient
+    message["Subject"] = subject
+    if body_text:
+        message.set_content(body_text)
+        message.add_alternative(body, subtype="html")
+    else:
+        message.set_content(body, subtype="html")
+    return message
+
+
+class MailQueue:
+    """
+    Sends the emails of the queue table, each task of the worker keeps its own SMTP connection
+    Failed emails are retried with an exponential backoff, then abandoned after MAIL_MAX_ATTEMPTS
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._tasks = []
+        self._wakeup = asyncio.Event()
+
+        self.sent = 0
+        self.failures = 0
+        self.abandoned = 0
+        self.depth = 0
+
+    def on_notification(self, payload: str):
+        """
+        Wake the tasks up when an email is queued
+        :param str payload: Payload of the notification, unused
+        :return: None
+        """
+
+        self._wakeup.set()
+
+    async def process_batch(self, connection: SmtpConnection) -> int:
+        """
+        Claim a batch of emails due and send them
+        :param SmtpConnection connection: Connection to the SMTP server
+        :return: Number of emails claimed
+        """
+
+        rows = await select_many_request(claim_mails(), (MAIL_LEASE, MAIL_BATCH_SIZE))
+        await self.send_batch(connection, rows)
+        return len(rows)
+
+    async def send_batch(self, connection: SmtpConnection, rows: list):
+        """
+        Send claimed emails, the sent ones are deleted and the failed ones scheduled again
+        The sent emails are recorded even if the batch is interrupted, so they are not sent again after the lease
+        :param SmtpConnection connection: Connection to the SMTP server
+        :param list rows: Claimed emails (id, recipient, subject, body, plain text body, attempts)
+        :return: None
+        """
+
+        sent = []
+        try:
+            for mail_id, recipient, subject, body, body_text, attempts in rows:
+                try:
+                    await connection.send(mail_message(recipient, subject, body, body_text))
+                    sent.append(mail_id)
+                except Exception as exc:
+                    self.failures += 1
+                    attempts += 1
+                    if attempts >= MAIL_MAX_ATTEMPTS:
+                        self.abandoned += 1
+                        logger.error("Abandoning email %s to %s: %s", mail_id, recipient, exc)
+                        delay = None
+                    else:
+                        delay = min(MAIL_MAX_BACKOFF, MAIL_BACKOFF * 2 ** (attempts - 1)) * (1 + random.random() / 2)
+                    await insert_update_delete_request(retry_mail(), (attempts, delay, str(exc) or type(exc).__name__, mail_id))
+        finally:
+            if sent:
+                async with db_cursor() as cur:
+                    await cur.execute(delete_mails(), (sent,))
+                    await cur.execute(mark_mails_sent(), (sent,))
+                self.sent += len(sent)
+
+    async def _run(self):
+        """
+        Send the emails of the queue, until cancelled
+        :return: None
+        """
+
+        connection = smtp_connection()
+        checks = 0
+        try:
+            while True:
+                self._wakeup.clear()
+                try:
+                    if await self.process_batch(connection) == MAIL_BATCH_SIZE:
+                        continue
+                    checks += 1
+                    if checks % MAIL_PURGE_EVERY == 0:
+                        await insert_update_delete_request(purge_sent_mails(), ())
+                        await insert_update_delete_request(purge_abandoned_mails(), (MAIL_ABANDONED_RETENTION,))
+                    self.depth, = await select_request(count_queued_mails(), ())
+                    await connection.close_idle()
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    logger.exception("Error while sending the queued emails")
+
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), MAIL_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            await connection.close()
+
+    def start(self):
+        """
+        Start the tasks sending the emails
+        :return: None
+        """
+
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """
+        Stop the tasks, the emails being sent are sent again by the next worker after the lease
+        :return: None
+        """
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self) -> dict:
+        """
+        Counters of the queue
+        :return: Emails waiting, sent, failed attempts and abandoned emails
+        """
+
+        return {
+            "depth": self.depth,
+            "sent": self.sent,
+            "failures": self.failures,
+            "abandoned": self.abandoned,
+        }
 
-    message = MessageSchema(
-        subject=subject,
-        recipients=[mail],  # List of recipients, as many as you can pass
-        body=template,
-        subtype="html"
-    )
 
-    fm = FastMail(conf)
-    await fm.send_message(message)
+mail_queue = MailQueue(MAIL_WORKERS)
+listener.subscribe(MAIL_CHANNEL, mail_queue.on_notification)
+register_metrics("mail_queue", mail_queue.stats)
@@ -1,7 +1,14 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from . import breaches, cleanup  # Modules adding their jobs to the scheduler
+from .compression import CompressionMiddleware
+from .database import open_database, close_database
 from .hibp import *
-from .routers import auth, hibp, twoFactor, user
+from .kdf import kdf_executor
+from .listener import listener
+from .mail import mail_queue
+from .routers import auth, hibp, metrics, twoFactor, user, vaultItems
+from .scheduler import scheduler
 
 SITE = os.environ.get('SITE')
 
@@ -23,8 +30,43 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress the responses and accept the compressed requests, zstd and brotli are used when installed
+app.add_middleware(CompressionMiddleware)
+
 # Routers of the API endpoints
 app.include_router(user.router)
+app.include_router(vaultItems.router)
 app.include_router(auth.router)
 app.include_router(twoFactor.router)
 app.include_router(hibp.router)
+app.include_router(metrics.router)
+
+
+@app.on_event("startup")
+async def startup():
+    """
+    Prepare the resources of the API when the server starts
+    :return: None
+    """
+
+    await open_database()
+    listener.start()
+    mail_queue.start()
+    scheduler.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    """
+    Release the resources of the API when the server stops
+    :return: None
+    """
+
+    await scheduler.stop()
+    await mail_queue.stop()
+    kdf_executor.shutdown()
+    await listener.stop()
+    await hibp_client.close()
+    if password_dataset is not None:
+        password_dataset.close()
+    await close_database()
@@ -0,0 +1,23 @@
+from typing import Callable
+
+_providers: dict[str, Callable[[], dict]] = {}
+
+
+def register_metrics(name: str, provider: Callable[[], dict]):
+    """
+    Registers a provider of counters exported under the given name
+    :param str name: Name of the subsystem exporting the counters
+    :param Function provider: Function that returns a dictionary of counters
+    :return: None
+    """
+
+    _providers[name] = provider
+
+
+def collect_metrics() -> dict:
+    """
+    Collects the counters of every registered subsystem
+    :return: Dictionary of counters grouped by subsystem name
+    """
+
+    return {name: provider() for name, provider in _providers.items()}
@@ -15,7 +15,24 @@ class User(BaseModel):
     has_two_factor_auth: bool
     two_factor_auth: str
     verified: bool
-    vault: Optional[bytes]
+    vault: Optional[str]
+    token_version: int
+    kdf_algorithm: str
+    kdf_iterations: int
+
+
+class UserIdentity(BaseModel):
+    """
+    Represents the identity of an authenticated user, without the credentials and the vault
+    """
+
+    id: int
+    email: str
+    has_two_factor_auth: bool
+    verified: bool
+    token_version: int
+    token_digest: bytes = b""
+    token_expiration: float = 0
 
 
 class UserGet(BaseModel):
@@ -47,9 +64,34 @@ class Token(BaseModel):
     """
 
     access_token: str
+    refresh_token: Optional[str] = None
     token_type: str
 
 
+class RefreshTokenParams(BaseModel):
+    """
+    Represents the refresh token sent by the client to refresh or close its session
+    """
+
+    refresh_token: str
+
+
+class HashPrefixes(BaseModel):
+    """
+    Represents the beginnings of the password hashes of a vault to check against the breaches
+    """
+
+    prefixes: list[str]
+
+
+class VerificationParams(BaseModel):
+    """
+    Represents the email of the account whose confirmation email is sent again
+    """
+
+    email: str
+
+
 class AuthKey(BaseModel):
     """
     Represents the two-factor authentication information needed to be sent to the client
@@ -77,6 +119,38 @@ class Vault(BaseModel):
     vault: str
 
 
+class VaultItem(BaseModel):
+    """
+    Represents an encrypted item of a vault, identified by an id generated by the client
+    The revision is the one of its last change, sent by the client it is the revision it modified
+    """
+
+    id: str
+    data: Optional[str] = None
+    revision: Optional[int] = None
+    deleted: bool = False
+
+
+class VaultItemsBatch(BaseModel):
+    """
+    Represents the items of a vault changed by a client, the deleted ones included
+    """
+
+    items: list[VaultItem]
+
+
+class VaultItemChanges(BaseModel):
+    """
+    Represents the items of a vault changed since a revision, and the revision the client is synced to with them
+    When more items follow, the last item sent is the one to ask the next items after, the revision may have more items
+    """
+
+    revision: int
+    items: list[VaultItem]
+    more: bool
+    after: Optional[str] = None
+
+
 class SecureEndpointParams(BaseModel):
     """
     Represents the params each protected function receives when a user authenticates with a JWT token
@@ -0,0 +1,133 @@
+import argparse
+import binascii
+import mmap
+import struct
+import sys
+from array import array
+
+MAGIC = b"DPPWND01"  # Format of the dataset file
+HEADER = struct.Struct("<8sQ")  # Magic, number of records
+RECORD = struct.Struct("<18sI")  # Last 18 bytes of the SHA-1 hash, number of occurrences
+PREFIXES = 16 ** 5  # Ranges of the Pwned Passwords API, one per 5 hexadecimal characters
+INDEX_OFFSET = HEADER.size  # Index of the first record of each range, followed by the number of records
+RECORDS_OFFSET = INDEX_OFFSET + 8 * (PREFIXES + 1)
+MAX_COUNT = 2 ** 32 - 1
+WRITE_BUFFER = 1024 * 1024  # Bytes written to the dataset file at once
+
+
+class PwnedDataset:
+    """
+    Pwned Passwords dataset downloaded locally, answering the range queries without calling HIBP
+    The file is memory-mapped: a lookup reads two offsets of the index then the records of the range
+    """
+
+    def __init__(self, path: str):
+        with open(path, "rb") as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.records = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or len(self._map) != RECORDS_OFFSET + self.records * RECORD.size:
+            self._map.close()
+            raise ValueError(f"{path} is not a Pwned Passwords dataset, build it with python -m app.pwned_dataset")
+        self.lookups = 0
+
+    def password_range(self, hash_begin: str) -> str:
+        """
+        Get the suffixes of the pwned password hashes starting with the given prefix
+        :param str hash_begin: First 5 characters of the SHA-1 hash of the password
+        :return: Suffixes of the hashes and their number of occurrences, one per line like the Pwned Passwords API
+        """
+
+        self.lookups += 1
+        prefix = int(hash_begin[:5], 16)
+        start, end = struct.unpack_from("<2Q", self._map, INDEX_OFFSET + 8 * prefix)
+        records = self._map[RECORDS_OFFSET + start * RECORD.size:RECORDS_OFFSET + end * RECORD.size]
+        # The first hexadecimal character of the stored bytes is the last one of the prefix
+        return "\r\n".join(f"{suffix.hex()[1:].upper()}:{count}" for suffix, count in RECORD.iter_unpack(records))
+
+    def close(self):
+        """
+        Unmap the file
+        :return: None
+        """
+
+        self._map.close()
+
+    def stats(self) -> dict:
+        """
+        Counters of the dataset
+        :return: Number of hashes and lookups
+        """
+
+        return {
+            "records": self.records,
+            "lookups": self.lookups,
+        }
+
+
+def import_dataset(source: str, destination: str) -> int:
+    """
+    Convert the text dump of Pwned Passwords ordered by hash (HASH:COUNT lines) into a dataset file
+    The dump is streamed, only the index of the ranges is kept in memory
+    :param str source: Path of the text dump
+    :param str destination: Path of the dataset file
+    :return: Number of hashes imported
+    """
+
+    counts = array("Q", bytes(8 * (PREFIXES + 1)))
+    records = 0
+    previous = b""
+
+    with open(source, "rb") as dump, open(destination, "wb", buffering=WRITE_BUFFER) as dataset:
+        dataset.write(bytes(RECORDS_OFFSET))
+        for number, line in enumerate(dump, 1):
+            line = line.strip()
+            if not line:
+                continue
+            hash_hex, _, count = line.partition(b":")
+            try:
+                digest = binascii.unhexlify(hash_hex)
+                count = int(count)
+            except (binascii.Error, ValueError):
+                raise ValueError(f"Line {number}: expected a SHA-1 hash and a count")
+            if len(digest) != 20:
+                raise ValueError(f"Line {number}: expected a SHA-1 hash and a count")
+            if digest <= previous:
+                raise ValueError(f"Line {number}: the dump must be ordered by hash")
+            previous = digest
+
+            dataset.write(RECORD.pack(digest[2:], min(count, MAX_COUNT)))
+            counts[int.from_bytes(digest[:3], "big") >> 4] += 1
+            records += 1
+
+        # Offsets of the ranges from the number of records of the previous ones
+        offset = 0
+        for prefix in range(PREFIXES + 1):
+            counts[prefix], offset = offset, offset + counts[prefix]
+        if sys.byteorder == "big":
+            counts.byteswap()
+
+        dataset.seek(0)
+        dataset.write(HEADER.pack(MAGIC, records))
+        dataset.write(counts.tobytes())
+
+    return records
+
+
+def main():
+    """
+    Builds the dataset file served when HIBP_PASSWORDS_DATASET is set
+    Usage: python -m app.pwned_dataset pwnedpasswords.txt pwnedpasswords.bin
+    :return: None
+    """
+
+    parser = argparse.ArgumentParser(description="Import the Pwned Passwords dump ordered by hash")
+    parser.add_argument("source", help="Text dump, one HASH:COUNT per line")
+    parser.add_argument("destination", help="Dataset file to create")
+    args = parser.parse_args()
+
+    records = import_dataset(args.source, args.destination)
+    print(f"{records} hashes imported into {args.destination}")
+
+
+if __name__ == "__main__":
+    main()
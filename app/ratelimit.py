@@ -0,0 +1,186 @@
+import hashlib
+import math
+import os
+import time
+from fastapi import HTTPException, Request, status
+from .database import insert_update_delete_request, select_request, take_rate_limit_token, purge_rate_limit_buckets
+from .metrics import register_metrics
+
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')  # memory (per worker) or postgres (shared)
+RATE_LIMIT_IP_BURST = int(os.environ.get('RATE_LIMIT_IP_BURST', 10))  # Requests a client IP can send at once
+RATE_LIMIT_IP_PER_MINUTE = float(os.environ.get('RATE_LIMIT_IP_PER_MINUTE', 30))  # Sustained requests per client IP
+RATE_LIMIT_EMAIL_BURST = int(os.environ.get('RATE_LIMIT_EMAIL_BURST', 5))  # Requests for an email at once
+RATE_LIMIT_EMAIL_PER_MINUTE = float(os.environ.get('RATE_LIMIT_EMAIL_PER_MINUTE', 10))  # Sustained requests per email
+TRUST_PROXY_HEADERS = os.environ.get('TRUST_PROXY_HEADERS', 'false').lower() == 'true'  # Behind a reverse proxy
+RATE_LIMIT_PURGE_EVERY = 1000  # Requests between two purges of the idle buckets
+RATE_LIMIT_KEY_LENGTH = 64  # Longest value kept as is in a bucket key, longer ones are hashed
+
+
+class MemoryBackend:
+    """
+    Token buckets stored in the memory of the worker
+    """
+
+    def __init__(self):
+        self._buckets: dict[str, tuple[float, float, int, float]] = {}
+        self._requests = 0
+
+    def _purge(self, now: float):
+        """
+        Drop the buckets that are full again, they behave like missing buckets
+        :param float now: Current timestamp
+        :return: None
+        """
+
+        self._buckets = {key: bucket for key, bucket in self._buckets.items()
+                         if bucket[0] + (now - bucket[1]) * bucket[3] < bucket[2]}
+
+    async def take(self, key: str, capacity: int, rate: float) -> float:
+        """
+        Take a token from a bucket
+        :param str key: Key of the bucket
+        :param int capacity: Capacity of the bucket
+        :param float rate: Tokens added per second
+        :return: 0 if a token was taken, otherwise seconds until a token is available
+        """
+
+        now = time.monotonic()
+        self._requests += 1
+        if self._requests % RATE_LIMIT_PURGE_EVERY == 0:
+            self._purge(now)
+
+        tokens, updated_at, _, _ = self._buckets.get(key, (capacity, now, capacity, rate))
+        tokens = min(capacity, tokens + (now - updated_at) * rate)
+
+        # The parameters are kept with the bucket, the purge handles the buckets of every kind
+        if tokens >= 1:
+            self._buckets[key] = (tokens - 1, now, capacity, rate)
+            return 0
+        self._buckets[key] = (tokens, now, capacity, rate)
+        return (1 - tokens) / rate
+
+
+class PostgresBackend:
+    """
+    Token buckets stored in the database, shared by all the workers
+    """
+
+    def __init__(self):
+        self._requests = 0
+
+    async def take(self, key: str, capacity: int, rate: float) -> float:
+        """
+        Take a token from a bucket
+        :param str key: Key of the bucket
+        :param int capacity: Capacity of the bucket
+        :param float rate: Tokens added per second
+        :return: 0 if a token was taken, otherwise seconds until a token is available
+        """
+
+        self._requests += 1
+        if self._requests % RATE_LIMIT_PURGE_EVERY == 0:
+            await insert_update_delete_request(purge_rate_limit_buckets(), (RATE_LIMIT_PURGE_EVERY,))
+
+        allowed, tokens = await select_request(take_rate_limit_token(),
+                                               {"key": key, "capacity": capacity, "rate": rate})
+        return 0 if allowed else (1 - tokens) / rate
+
+
+class RateLimiter:
+    """
+    Limits the requests per client IP and per email on the endpoints running a key derivation
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.allowed = 0
+        self.rejected_ip = 0
+        self.rejected_email = 0
+
+    def _reject(self, retry_after: float):
+        """
+        Reject a request exceeding the limits
+        :param float retry_after: Seconds until the client can retry
+        :return: None
+        """
+
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                            detail="Too many requests, please retry later",
+                            headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+    async def check(self, request: Request, email: str):
+        """
+        Take a token from the buckets of the client IP and of the email
+        :param Request request: Received request
+        :param str email: Email the request is about
+        :return: None
+        """
+
+        retry_after = await self.backend.take(bucket_key("ip", client_ip(request)), RATE_LIMIT_IP_BURST,
+                                              RATE_LIMIT_IP_PER_MINUTE / 60)
+        if retry_after:
+            self.rejected_ip += 1
+            self._reject(retry_after)
+
+        if email:
+            retry_after = await self.backend.take(bucket_key("email", email.strip().lower()), RATE_LIMIT_EMAIL_BURST,
+                                                  RATE_LIMIT_EMAIL_PER_MINUTE / 60)
+            if retry_after:
+                self.rejected_email += 1
+                self._reject(retry_after)
+
+        self.allowed += 1
+
+    def stats(self) -> dict:
+        """
+        Counters of the limiter
+        :return: Allowed and rejected requests
+        """
+
+        return {
+            "backend": type(self.backend).__name__,
+            "allowed": self.allowed,
+            "rejected_ip": self.rejected_ip,
+            "rejected_email": self.rejected_email,
+        }
+
+
+def bucket_key(kind: str, value: str) -> str:
+    """
+    Key of a bucket, the values are not validated yet so the long ones are hashed to fit the database column
+    :param str kind: Kind of the bucket, e.g. "ip"
+    :param str value: Value limited, e.g. the client IP
+    :return: Key of the bucket
+    """
+
+    if len(value) > RATE_LIMIT_KEY_LENGTH:
+        value = hashlib.sha256(value.encode()).hexdigest()
+    return f"{kind}:{value}"
+
+
+def client_ip(request: Request) -> str:
+    """
+    IP address of the client, the last address added by the reverse proxy if its headers are trusted
+    :param Request request: Received request
+    :return: IP address of the client
+    """
+
+    forwarded_for = request.headers.get("x-forwarded-for")
+    if TRUST_PROXY_HEADERS and forwarded_for:
+        return forwarded_for.split(",")[-1].strip()
+    return request.client.host if request.client else "unknown"
+
+
+rate_limiter = RateLimiter(PostgresBackend() if RATE_LIMIT_BACKEND == 'postgres' else MemoryBackend())
+register_metrics("rate_limit", rate_limiter.stats)
+
+
+async def check_rate_limit(request: Request, email: str):
+    """
+    Check the request does not exceed the limits of its client IP and email, before any key derivation
+    :param Request request: Received request
+    :param str email: Email the request is about
+    :return: None
+    """
+
+    await rate_limiter.check(request, email)
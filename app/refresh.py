@@ -0,0 +1,134 @@
+import asyncio
+import hashlib
+import logging
+import os
+import secrets
+import uuid
+from datetime import datetime, timedelta, timezone
+from fastapi import HTTPException, status
+from .auth import ACCESS_TOKEN_EXPIRE_MINUTES, create_access_token
+from .database import *
+from .model import User
+from .scheduler import scheduler
+
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.environ.get('REFRESH_TOKEN_EXPIRE_DAYS', 30))  # Refresh token expiration time
+REFRESH_PURGE_INTERVAL = int(os.environ.get('REFRESH_PURGE_INTERVAL', 3600))  # Seconds between two purges
+REFRESH_PURGE_BATCH = 1000  # Expired refresh tokens deleted per batch
+
+logger = logging.getLogger(__name__)
+
+
+def refresh_token_hash(token: str) -> bytes:
+    """
+    Hash of a refresh token, only the hash is stored in the database
+    :param str token: Refresh token
+    :return: SHA-256 digest of the token
+    """
+
+    return hashlib.sha256(token.encode()).digest()
+
+
+def refresh_token_expiration() -> datetime:
+    """
+    Expiration of a refresh token issued now
+    :return: Expiration timestamp
+    """
+
+    return datetime.now(timezone.utc) + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+
+
+def session_tokens(email: str, token_version: int, refresh_token: str) -> dict:
+    """
+    Tokens returned to the client when a session is opened or refreshed
+    :param str email: User's email
+    :param int token_version: User's token version
+    :param str refresh_token: Refresh token of the session
+    :return: Access token, refresh token and token type
+    """
+
+    access_token = create_access_token(
+        data={"sub": email, "ver": token_version}, expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    )
+    return {"access_token": access_token, "refresh_token": refresh_token, "token_type": "bearer"}
+
+
+async def open_session(current_user: User) -> dict:
+    """
+    Open a session for an authenticated user, with a refresh token starting a new family
+    :param User current_user: Authenticated user
+    :return: Access token, refresh token and token type
+    """
+
+    refresh_token = secrets.token_urlsafe(32)
+    await insert_update_delete_request(insert_refresh_token(), (refresh_token_hash(refresh_token), current_user.id,
+                                                                uuid.uuid4(), current_user.token_version,
+                                                                refresh_token_expiration()))
+    return session_tokens(current_user.email, current_user.token_version, refresh_token)
+
+
+async def refresh_session(refresh_token: str) -> dict:
+    """
+    Refresh a session, the refresh token is exchanged for a new one of the same family
+    A refresh token used twice reveals it was stolen, its whole family is then revoked
+    :param str refresh_token: Refresh token of the session
+    :return: Access token, refresh token and token type
+    """
+
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+
+    token_hash = refresh_token_hash(refresh_token)
+    next_refresh_token = secrets.token_urlsafe(32)
+    row = await select_request(rotate_refresh_token(), (token_hash, refresh_token_hash(next_refresh_token),
+                                                        refresh_token_expiration()))
+
+    if row is None:
+        if await insert_update_delete_request(delete_used_refresh_token_family(), (token_hash,)):
+            logger.warning("Refresh token reused, its family was revoked")
+        raise credentials_exception
+
+    email, token_version, refresh_version = row
+    if token_version != refresh_version:
+        raise credentials_exception
+
+    return session_tokens(email, token_version, next_refresh_token)
+
+
+async def revoke_refresh_token(refresh_token: str):
+    """
+    Revoke a refresh token and all the tokens of its family
+    :param str refresh_token: Refresh token of the session
+    :return: None
+    """
+
+    await insert_update_delete_request(delete_refresh_token_family(), (refresh_token_hash(refresh_token),))
+
+
+async def purge_expired_refresh_tokens() -> int:
+    """
+    Delete the expired refresh tokens in batches, so no statement holds locks for long
+    :return: Number of deleted tokens
+    """
+
+    deleted = 0
+    while True:
+        count = await insert_update_delete_request(purge_refresh_tokens(), (REFRESH_PURGE_BATCH,))
+        deleted += count
+        if count < REFRESH_PURGE_BATCH:
+            return deleted
+        await asyncio.sleep(0)
+
+
+async def purge_job():
+    """
+    Scheduled job purging the expired refresh tokens
+    :return: None
+    """
+
+    await purge_expired_refresh_tokens()
+
+
+scheduler.add("refresh_token_purge", purge_job, REFRESH_PURGE_INTERVAL)
@@ -0,0 +1,277 @@
+import asyncio
+import hashlib
+import math
+import os
+import time
+from typing import Callable, Optional
+from jose import jwt, JWTError
+from .database import (add_revoked_token, insert_update_delete_request, notify_token_revoked, purge_revoked_tokens,
+                       select_many_request, select_revoked_tokens)
+from .listener import listener
+from .metrics import register_metrics
+from .scheduler import scheduler
+
+REVOCATION_CHANNEL = "token_revoked"  # Channel of the notifications sent when a token is revoked
+REVOCATION_BLOOM_CAPACITY = int(os.environ.get('REVOCATION_BLOOM_CAPACITY', 100_000))  # Initial filter capacity
+REVOCATION_BLOOM_ERROR_RATE = 0.01  # False positive rate of the filter at capacity
+REVOCATION_PRUNE_INTERVAL = 600  # Seconds between two removals of the expired tokens from the index
+REVOCATION_PURGE_INTERVAL = int(os.environ.get('REVOCATION_PURGE_INTERVAL', 3600))  # Seconds between two purges
+REVOCATION_PURGE_BATCH = int(os.environ.get('REVOCATION_PURGE_BATCH', 1000))  # Expired tokens deleted per batch
+
+
+def token_digest(token: str) -> bytes:
+    """
+    Fixed-size digest identifying a token
+    :param str token: JWT token
+    :return: SHA-256 digest of the token
+    """
+
+    return hashlib.sha256(token.encode()).digest()
+
+
+def token_expiration(token: str) -> float:
+    """
+    Expiration timestamp of a token, its signature is not verified
+    :param str token: JWT token
+    :return: Expiration timestamp, 0 if the token has no valid expiration
+    """
+
+    try:
+        return float(jwt.get_unverified_claims(token).get("exp", 0))
+    except (JWTError, TypeError, ValueError):
+        return 0
+
+
+class BloomFilter:
+    """
+    Bloom filter over SHA-256 digests, the bit positions are taken from the digest itself
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = min(8, max(1, round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, digest: bytes):
+        """
+        Bit positions of a digest
+        :param bytes digest: SHA-256 digest
+        :return: Generator of the positions
+        """
+
+        for i in range(self.hashes):
+            yield int.from_bytes(digest[i * 4:i * 4 + 4], "big") % self.size
+
+    def add(self, digest: bytes):
+        """
+        Add a digest to the filter
+        :param bytes digest: SHA-256 digest
+        :return: None
+        """
+
+        for position in self._positions(digest):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, digest: bytes) -> bool:
+        """
+        Check if a digest may be in the filter
+        :param bytes digest: SHA-256 digest
+        :return: False if the digest is not in the filter, True if it may be
+        """
+
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(digest))
+
+
+class RevocationIndex:
+    """
+    In-memory index of the unexpired revoked tokens of the worker
+    It is loaded from the database when the notification listener connects, then kept up to date by the
+    notifications sent on revocation. While the listener is disconnected, the index is not ready and the
+    revocation must be checked in the database.
+    """
+
+    def __init__(self, capacity: int):
+        self.ready = False
+        self._capacity = capacity
+        self._bloom = BloomFilter(capacity, REVOCATION_BLOOM_ERROR_RATE)
+        self._revoked: dict[bytes, float] = {}
+        self._pruned_at = time.time()
+        self._listeners: list[Callable[[bytes], None]] = []
+
+        self.lookups = 0
+        self.bloom_negatives = 0
+        self.fallbacks = 0
+        self.reloads = 0
+        self.purged = 0
+
+    def _rebuild(self):
+        """
+        Rebuild the filter from the exact set, growing it if the set exceeds its capacity
+        :return: None
+        """
+
+        while len(self._revoked) > self._capacity:
+            self._capacity *= 2
+        self._bloom = BloomFilter(self._capacity, REVOCATION_BLOOM_ERROR_RATE)
+        for digest in self._revoked:
+            self._bloom.add(digest)
+
+    def prune(self):
+        """
+        Remove the expired tokens, they are rejected by the token validation anyway
+        :return: None
+        """
+
+        now = time.time()
+        self._revoked = {digest: exp for digest, exp in self._revoked.items() if exp > now}
+        self._pruned_at = now
+        self._rebuild()
+
+    def add(self, digest: bytes, exp: float):
+        """
+        Add a revoked token to the index
+        :param bytes digest: Digest of the token
+        :param float exp: Expiration timestamp of the token
+        :return: None
+        """
+
+        if exp <= time.time():
+            return
+        self._revoked[digest] = exp
+        if len(self._revoked) > self._capacity or time.time() - self._pruned_at > REVOCATION_PRUNE_INTERVAL:
+            self.prune()
+        else:
+            self._bloom.add(digest)
+
+    def is_revoked(self, token: str) -> Optional[bool]:
+        """
+        Check if a token is revoked without querying the database
+        :param str token: JWT token
+        :return: True if revoked, False if not, None if the index is not ready
+        """
+
+        if not self.ready:
+            self.fallbacks += 1
+            return None
+
+        self.lookups += 1
+        digest = token_digest(token)
+        if digest not in self._bloom:
+            self.bloom_negatives += 1
+            return False
+        return digest in self._revoked
+
+    async def load(self):
+        """
+        Load the revoked tokens from the database, called each time the listener connects
+        :return: None
+        """
+
+        rows = await select_many_request(select_revoked_tokens(), ())
+        self._revoked = {bytes(digest): float(exp) for digest, exp in rows}
+        self.prune()
+        self.reloads += 1
+        self.ready = True
+
+    def add_listener(self, listener: Callable[[bytes], None]):
+        """
+        Add a function called with the digest of each token revoked, e.g. to close the streams opened with it
+        :param Function listener: Function called with the digest of the token
+        :return: None
+        """
+
+        self._listeners.append(listener)
+
+    def on_notification(self, payload: str):
+        """
+        Add the token of a revocation notification
+        :param str payload: Hexadecimal digest and expiration of the token, separated by a colon
+        :return: None
+        """
+
+        digest, exp = payload.split(":")
+        digest = bytes.fromhex(digest)
+        self.add(digest, float(exp))
+        for listener in self._listeners:
+            listener(digest)
+
+    def on_disconnect(self):
+        """
+        Revocations may be missed while the listener is disconnected
+        :return: None
+        """
+
+        self.ready = False
+
+    def stats(self) -> dict:
+        """
+        Counters of the index
+        :return: Size of the index and lookup counters
+        """
+
+        return {
+            "ready": self.ready,
+            "revoked_tokens": len(self._revoked),
+            "bloom_capacity": self._capacity,
+            "lookups": self.lookups,
+            "bloom_negatives": self.bloom_negatives,
+            "database_fallbacks": self.fallbacks,
+            "reloads": self.reloads,
+            "purged_tokens": self.purged,
+        }
+
+
+def revocation_payload(token: str) -> str:
+    """
+    Payload of the notification sent when a token is revoked
+    :param str token: Revoked JWT token
+    :return: Hexadecimal digest and expiration of the token, separated by a colon
+    """
+
+    return f"{token_digest(token).hex()}:{token_expiration(token)}"
+
+
+async def revoke_token(cur, token: str):
+    """
+    Store the revocation of a token and notify all the workers, with the cursor of the current transaction
+    :param cur: Database cursor
+    :param str token: JWT token to revoke
+    :return: None
+    """
+
+    await cur.execute(add_revoked_token(), (token_digest(token), token_expiration(token)))
+    await cur.execute(notify_token_revoked(), (revocation_payload(token),))
+
+
+async def purge_expired_tokens() -> int:
+    """
+    Delete the expired revoked tokens in batches, so no statement holds locks for long
+    :return: Number of deleted tokens
+    """
+
+    deleted = 0
+    while True:
+        count = await insert_update_delete_request(purge_revoked_tokens(), (REVOCATION_PURGE_BATCH,))
+        deleted += count
+        if count < REVOCATION_PURGE_BATCH:
+            break
+        await asyncio.sleep(0)
+    revocation_index.purged += deleted
+    return deleted
+
+
+async def purge_job():
+    """
+    Scheduled job purging the expired revoked tokens
+    :return: None
+    """
+
+    await purge_expired_tokens()
+
+
+revocation_index = RevocationIndex(REVOCATION_BLOOM_CAPACITY)
+listener.subscribe(REVOCATION_CHANNEL, revocation_index.on_notification,
+                   on_connect=revocation_index.load, on_disconnect=revocation_index.on_disconnect)
+register_metrics("revocation", revocation_index.stats)
+scheduler.add("revocation_purge", purge_job, REVOCATION_PURGE_INTERVAL)
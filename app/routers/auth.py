@@ -1,7 +1,9 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Request
 from fastapi.security import OAuth2PasswordRequestForm
 from ..mail import *
 from ..model import *
+from ..ratelimit import check_rate_limit
+from ..refresh import open_session, refresh_session
 
 router = APIRouter(
     tags=["Authentication"]
@@ -10,14 +12,17 @@ router = APIRouter(
 
 @router.post("/token", response_model=Token)
 async def get_access_token(
+        request: Request,
         form_data: Annotated[OAuth2PasswordRequestForm, Depends()]
 ):
     """
     Get access token
+    :param Request request: Received request
     :param str form_data: username and password
-    :return: access token
+    :return: access token and refresh token
     """
-    current_user = authenticate_user(form_data.username, form_data.password)
+    await check_rate_limit(request, form_data.username)
+    current_user = await authenticate_user(form_data.username, form_data.password)
 
     if not current_user.verified:
         raise HTTPException(
@@ -27,14 +32,23 @@ async def get_access_token(
         )
 
     if not current_user.has_two_factor_auth:
-        access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-        access_token = create_access_token(
-            data={"sub": current_user.email}, expires_delta=access_token_expires
-        )
-        return {"access_token": access_token, "token_type": "bearer"}
+        return await open_session(current_user)
 
     raise HTTPException(
         status_code=status.HTTP_200_OK,
         detail="Two-factor authentication is enabled",
         headers={"WWW-Authenticate": "Bearer"},
     )
+
+
+@router.post("/token/refresh", response_model=Token)
+async def refresh_access_token(
+        refresh: RefreshTokenParams
+):
+    """
+    Get a new access token without the master password, the refresh token is exchanged for a new one
+    :param RefreshTokenParams refresh: Refresh token received with the previous access token
+    :return: access token and refresh token
+    """
+
+    return await refresh_session(refresh.refresh_token)
@@ -1,6 +1,7 @@
 from fastapi import APIRouter
 import json
-from starlette.responses import Response
+from starlette.responses import Response, StreamingResponse
+from ..breaches import get_cached_breaches
 from ..hibp import *
 from ..mail import *
 from ..model import *
@@ -12,20 +13,20 @@ router = APIRouter(
 
 @router.get("/hibp_breaches")
 async def get_hibp_breaches(
-    current_user: Annotated[SecureEndpointParams, Depends(protected_endpoints)],
+    current_user: Annotated[UserIdentity, Depends(protected_endpoints_identity)],
 ):
     """
-    Endpoint to get breach for a user for a given domain
+    Endpoint to get breach for a user for a given domain, served from the breaches cached for the user
     :return: Content with the breaches of the user in a JSON format
     """
 
-    json_data = await get_breach_for_user(current_user.email)
-    return Response(content=json.dumps(json_data), media_type="application/json")
+    json_data = await get_cached_breaches(current_user.id, current_user.email)
+    return Response(content=json_data, media_type="application/json")
 
 
 @router.get("/hibp_password")
 async def get_hibp_breaches_password(
-    current_user: Annotated[SecureEndpointParams, Depends(protected_endpoints)],
+    current_user: Annotated[UserIdentity, Depends(protected_endpoints_identity)],
     hash_begin: str
 ):
     """
@@ -37,5 +38,36 @@ async def get_hibp_breaches_password(
     if not is_valid_email(current_user.email):
         raise HTTPException(status_code=400, detail="Invalid email address")
 
-    breached_hashes = await get_breach_for_password(current_user.email, hash_begin.upper())
+    if not is_valid_hash_prefix(hash_begin[:5]):
+        raise HTTPException(status_code=400, detail="Invalid hash prefix")
+
+    breached_hashes = await get_breach_for_password(current_user.email, hash_begin[:5].upper())
     return breached_hashes
+
+
+@router.post("/hibp_password_batch")
+async def get_hibp_breaches_passwords(
+    current_user: Annotated[UserIdentity, Depends(protected_endpoints_identity)],
+    hash_prefixes: HashPrefixes
+):
+    """
+    Endpoint to get the breaches for many passwords of a user at once
+    :param HashPrefixes hash_prefixes: Beginnings of the hashes of the passwords
+    :return: One JSON line per distinct prefix (prefix, hashes or error), sent as soon as its range is fetched
+    """
+
+    if not is_valid_email(current_user.email):
+        raise HTTPException(status_code=400, detail="Invalid email address")
+
+    prefixes = list(dict.fromkeys(prefix[:5].upper() for prefix in hash_prefixes.prefixes))
+    if len(prefixes) > HIBP_BATCH_MAX_PREFIXES:
+        raise HTTPException(status_code=400, detail="Too many hash prefixes")
+    if not all(is_valid_hash_prefix(prefix) for prefix in prefixes):
+        raise HTTPException(status_code=400, detail="Invalid hash prefix")
+
+    async def results():
+        async for prefix, hashes, error in get_breaches_for_passwords(current_user.email, prefixes):
+            result = {"prefix": prefix, "hashes": hashes} if error is None else {"prefix": prefix, "error": error}
+            yield json.dumps(result) + "\n"
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
@@ -0,0 +1,27 @@
+import hmac
+import os
+from typing import Annotated, Union
+from fastapi import APIRouter, Header, HTTPException, status
+from ..metrics import collect_metrics
+
+router = APIRouter(
+    tags=["Metrics"]
+)
+
+METRICS_KEY = os.environ.get('METRICS_KEY')  # Key required to read the metrics, endpoint disabled if not set
+
+
+@router.get("/metrics")
+async def get_metrics(
+    x_metrics_key: Annotated[Union[str, None], Header()] = None
+):
+    """
+    Endpoint to get the internal counters of the API (KDF executor, caches, queues, ...)
+    :param str x_metrics_key: Key allowing to read the metrics
+    :return: Counters of each subsystem in a JSON format
+    """
+
+    if not METRICS_KEY or not x_metrics_key or not hmac.compare_digest(x_metrics_key, METRICS_KEY):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+
+    return collect_metrics()
@@ -1,7 +1,9 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Request
 from ..twoFactorAuth import *
 from ..mail import *
 from ..model import *
+from ..ratelimit import check_rate_limit
+from ..refresh import open_session
 
 router = APIRouter(
     tags=["Two Factor Authentication"]
@@ -10,7 +12,7 @@ router = APIRouter(
 
 @router.get("/generate_auth_key", response_model=AuthKey)
 async def generate_auth_key(
-        current_user: Annotated[SecureEndpointParams, Depends(protected_endpoints)]
+        current_user: Annotated[UserIdentity, Depends(protected_endpoints_identity)]
 ):
     """
     Endpoint to generate authenticator key for two-factor authentication
@@ -27,7 +29,7 @@ async def generate_auth_key(
 
 @router.post("/enable_two_factor_auth")
 async def enable_two_factor_auth(
-    current_user: Annotated[SecureEndpointParams, Depends(protected_endpoints)],
+    current_user: Annotated[UserIdentity, Depends(protected_endpoints_identity)],
     auth_key: str,
     totp_code: str
 ):
@@ -45,21 +47,25 @@ async def enable_two_factor_auth(
     if not verify_code(auth_key, totp_code):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid code")
 
-    insert_update_delete_request(update_two_factor_auth(), (auth_key, True, current_user.email))
+    await insert_update_delete_request(update_two_factor_auth(), (auth_key, True, current_user.email))
     return {"message": "Two-factor authentication enabled successfully"}
 
 
-@router.post("/check_two_factor_auth")
+@router.post("/check_two_factor_auth", response_model=Token)
 async def check_two_factor_auth(
+    request: Request,
     two_factor_auth_params: TwoFactorAuthConnectionParams
 ):
     """
     Endpoint to check two-factor authentication
+    :param Request request: Received request
     :param TwoFactorAuthConnectionParams two_factor_auth_params: Two-factor authentication parameters (username, key_hash, totp_code)
-    :return: Access token
+    :return: Access token and refresh token
     """
 
-    current_user = authenticate_user(two_factor_auth_params.email, two_factor_auth_params.key_hash)
+    await check_rate_limit(request, two_factor_auth_params.email)
+
+    current_user = await authenticate_user(two_factor_auth_params.email, two_factor_auth_params.key_hash)
 
     if not current_user.verified:
         raise HTTPException(
@@ -72,17 +78,13 @@ async def check_two_factor_auth(
     if not verify_code(current_user.two_factor_auth, two_factor_auth_params.totp_code):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid code")
 
-    # Generate access token
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={"sub": current_user.email}, expires_delta=access_token_expires
-    )
-    return {"access_token": access_token, "token_type": "bearer"}
+    # Generate access token and refresh token
+    return await open_session(current_user)
 
 
 @router.post("/disable_two_factor_auth")
 async def disable_two_factor_auth(
-        current_user: Annotated[SecureEndpointParams, Depends(protected_endpoints)]
+        current_user: Annotated[UserIdentity, Depends(protected_endpoints_identity)]
 ):
     """
     Endpoint to disable two-factor authentication
@@ -93,5 +95,5 @@ async def disable_two_factor_auth(
     if not current_user.has_two_factor_auth:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Two-factor authentication is not enabled")
 
-    insert_update_delete_request(update_two_factor_auth(), ("0", False, current_user.email))
+    await insert_update_delete_request(update_two_factor_auth(), ("0", False, current_user.email))
     return {"message": "Two-factor authentication disabled successfully"}
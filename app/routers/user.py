@@ -1,49 +1,91 @@
-from fastapi import APIRouter
-from starlette.responses import RedirectResponse
+import asyncio
+import functools
+import json
+import time
+from fastapi import APIRouter, Header, Request
+from starlette.responses import RedirectResponse, Response, StreamingResponse
 from base64 import b64encode
+from ..events import notify_vault_change, vault_events
 from ..mail import *
 from ..crypto import *
 from ..templates.mailTemplate import *
 from ..model import *
+from ..ratelimit import check_rate_limit
+from ..refresh import revoke_refresh_token
+from ..revocation import revocation_index, revocation_payload, revoke_token
 from ..utils import is_valid_email
+from ..vault import decode_vault, encode_vault, etag_revisions, vault_etag, vault_hash
+from .vaultItems import check_vault_items, reencrypt_vault_items
 
 router = APIRouter(
     tags=["User"]
 )
 
 SITE = os.environ.get('SITE')
+VERIFICATION_DEDUPE_WINDOW = int(os.environ.get('VERIFICATION_DEDUPE_WINDOW', 600))  # Seconds between two confirmations
+VAULT_CHUNK_SIZE = int(os.environ.get('VAULT_CHUNK_SIZE', 65536))  # Bytes per chunk of a chunked vault download
+VAULT_EVENTS_KEEPALIVE = int(os.environ.get('VAULT_EVENTS_KEEPALIVE', 25))  # Seconds between two keepalives of the event streams
 
 
 @router.post("/register")
 async def create_new_user(
+        request: Request,
         user_auth: UserAuth
 ):
     """
     Create new user and send confirmation email
+    :param Request request: Received request
     :param UserAuth user_auth: User's authentication data (email, password, password confirmation)
     :return: Confirmation message and send email
     """
+    await check_rate_limit(request, user_auth.email)
     if not is_valid_email(user_auth.email):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid email")
 
-    if check_user_exists(user_auth.email):
+    if await check_user_exists(user_auth.email):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User already exists")
 
     if not user_auth.key_hash == user_auth.key_hash_conf:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Passwords do not match")
 
     # Hash the received password hash and generate a salt
-    salt, h = generate_master_key_hash(get_byte_from_base64(user_auth.key_hash))
+    salt, h = await derive(get_byte_from_base64(user_auth.key_hash))
 
-    user_data = (user_auth.email, b64encode(h).decode(), user_auth.symmetric_key_encrypted, b64encode(salt).decode())
-    insert_update_delete_request(insert_user(), user_data)
-
-    # Send confirmation email
-    await send_email(user_auth.email, confirmation_mail)
+    user_data = (user_auth.email, b64encode(h).decode(), user_auth.symmetric_key_encrypted, b64encode(salt).decode(), KDF_ALGORITHM, PBKDF_NUM_ITERATIONS)
+    # The user and its confirmation email are stored in the same transaction, the email is sent by the mail queue
+    async with db_cursor() as cur:
+        await cur.execute(insert_user(), user_data)
+        await enqueue_email(cur, user_auth.email, functools.partial(
+            confirmation_mail, locale=preferred_locale(request.headers.get("accept-language"))),
+            dedupe_key=f"verification:{user_auth.email}", dedupe_window=VERIFICATION_DEDUPE_WINDOW)
 
     return {"message": "User created successfully"}
 
 
+@router.post("/resend_verification")
+async def resend_verification(
+        request: Request,
+        params: VerificationParams
+):
+    """
+    Send the confirmation email again, through the mail queue
+    An email sent or waiting to be sent during the last VERIFICATION_DEDUPE_WINDOW seconds is not sent again
+    :param Request request: Received request
+    :param VerificationParams params: Email of the account
+    :return: Confirmation message, the same whether the account exists or not
+    """
+    await check_rate_limit(request, params.email)
+
+    row = await select_request(select_user_identity(), (params.email,))
+    if row and not row[3]:
+        async with db_cursor() as cur:
+            await enqueue_email(cur, params.email, functools.partial(
+                confirmation_mail, locale=preferred_locale(request.headers.get("accept-language"))),
+                dedupe_key=f"verification:{params.email}", dedupe_window=VERIFICATION_DEDUPE_WINDOW)
+
+    return {"message": "Verification email sent if the account is not verified"}
+
+
 @router.get("/verify")
 async def email_verification(token: str):
     """
@@ -55,7 +97,7 @@ async def email_verification(token: str):
     current_user = await get_current_user_from_token(token)
 
     if current_user and not current_user.verified:
-        insert_update_delete_request(update_verification(), (current_user.email,))
+        await insert_update_delete_request(update_verification(), (current_user.email,))
         return RedirectResponse(url=f"https://{SITE}/#/account-verified")
 
     raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User already verified")
@@ -63,117 +105,283 @@ async def email_verification(token: str):
 
 @router.get("/get_user", response_model=UserGet)
 async def get_user(
-    current_user: Annotated[SecureEndpointParams, Depends(protected_endpoints)]
+    current_user: Annotated[UserIdentity, Depends(protected_endpoints_identity)],
+    response: Response,
+    include_vault: bool = True,
+    if_none_match: Annotated[Optional[str], Header()] = None
 ):
     """
-    Get user's data
-    :param User current_user: User's data
+    Get user's data, with the ETag of the vault, the data sent without the vault having its own ETag
+    :param UserIdentity current_user: User's identity
+    :param Response response: Response, to send the ETag
+    :param bool include_vault: False to leave out the vault, which is then not read from the database
+    :param str if_none_match: ETags of the vault known by the client, nothing is sent and the vault is not read if
+    one of them is current
     :return: User's data for frontend
     """
 
+    revisions = etag_revisions(if_none_match, include_vault, current_user.has_two_factor_auth) or []
+    symmetric_key_encrypted, vault, vault_format, revision, content_hash = await select_request(
+        select_user_profile(), (include_vault, revisions, current_user.id))
+
+    etag = vault_etag(revision, content_hash, include_vault, current_user.has_two_factor_auth)
+    if revision in revisions:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+
     user_get = UserGet(
         id=current_user.id,
         email=current_user.email,
-        symmetric_key_encrypted=current_user.symmetric_key_encrypted,
+        symmetric_key_encrypted=symmetric_key_encrypted,
         has_two_factor_auth=current_user.has_two_factor_auth,
-        vault=current_user.vault.decode("utf-8") if current_user.vault else None
+        vault=decode_vault(vault, vault_format)
     )
 
     return user_get
 
 
+@router.get("/vault")
+async def get_vault(
+    current_user: Annotated[UserIdentity, Depends(protected_endpoints_identity)],
+    chunked: bool = False,
+    if_none_match: Annotated[Optional[str], Header()] = None
+):
+    """
+    Download the vault as stored in the database, without converting it to text
+    The format of the stored vault is sent in the X-Vault-Format header (0: UTF-8 text, 1: binary)
+    :param UserIdentity current_user: User's identity
+    :param bool chunked: True to send the vault in chunks of VAULT_CHUNK_SIZE bytes
+    :param str if_none_match: ETags of the vault known by the client, nothing is sent and the vault is not read if
+    one of them is current
+    :return: Stored vault
+    """
+
+    revisions = etag_revisions(if_none_match) or []
+    row = await select_request(select_vault(), (revisions, current_user.id))
+    if row is None or not row[0]:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Vault not found")
+
+    _, vault, vault_format, revision, content_hash = row
+    headers = {"X-Vault-Format": str(vault_format), "ETag": vault_etag(revision, content_hash, two_factor=current_user.has_two_factor_auth)}
+    if revision in revisions:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    if not chunked:
+        return Response(content=vault, media_type="application/octet-stream", headers=headers)
+
+    async def chunks():
+        for offset in range(0, len(vault), VAULT_CHUNK_SIZE):
+            yield vault[offset:offset + VAULT_CHUNK_SIZE]
+
+    return StreamingResponse(chunks(), media_type="application/octet-stream", headers=headers)
+
+
+@router.get("/vault/events")
+async def get_vault_events(
+    current_user: Annotated[UserIdentity, Depends(protected_endpoints_identity)]
+):
+    """
+    Stream the changes of the user's vault as Server-Sent Events, instead of polling get_user
+    Events: "vault" with the new ETag of the vault, "items" with the new revision of its items, "resync" when
+    changes may have been missed. The stream is closed when the access token expires or is revoked, the client
+    reconnects with a new one.
+    :param UserIdentity current_user: User's identity
+    :return: Stream of events
+    """
+
+    queue = vault_events.subscribe(current_user.id, current_user.token_digest, current_user.token_version)
+    deadline = time.monotonic() + current_user.token_expiration - time.time()
+
+    async def events():
+        try:
+            while (remaining := deadline - time.monotonic()) > 0:
+                try:
+                    event = await asyncio.wait_for(queue.get(), min(VAULT_EVENTS_KEEPALIVE, remaining))
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if event is None:
+                    break
+                yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+        finally:
+            vault_events.unsubscribe(current_user.id, queue)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 @router.put("/update_vault")
-def update_vault(
-    current_user: Annotated[SecureEndpointParams, Depends(protected_endpoints)],
-    vault: Optional[Vault] = None
+async def update_vault(
+    current_user: Annotated[UserIdentity, Depends(protected_endpoints_identity)],
+    response: Response,
+    vault: Optional[Vault] = None,
+    if_match: Annotated[Optional[str], Header()] = None
 ):
     """
     Update user's vault
     :param User current_user: User's data
+    :param Response response: Response, to send the new ETag of the vault
     :param Vault vault: Vault value
+    :param str if_match: ETags of the vault the client updated, the vault is not updated if none of them is current
     :return: Confirmation message
     """
 
-    vault_content = bytes(vault.vault, 'utf-8') if vault.vault else None
+    vault_content, vault_format = encode_vault(vault.vault)
+    revisions = etag_revisions(if_match)
+
+    # The vault is updated and its change notified to the other clients in the same transaction
+    async with db_cursor() as cur:
+        await cur.execute(vault_update(), (vault_content, vault_format, vault_hash(vault.vault), current_user.email, revisions, revisions))
+        row = await cur.fetchone()
+        if row is None:
+            raise HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED, detail="Vault modified by another client")
+        etag = vault_etag(*row, two_factor=current_user.has_two_factor_auth)
+        await notify_vault_change(cur, current_user.id, {"type": "vault", "etag": etag})
 
-    insert_update_delete_request(vault_update(), (vault_content, current_user.email))
+    response.headers["ETag"] = etag
     return {"message": "Vault updated successfully"}
 
 
 @router.put("/update_email")
 async def update_email(
-    current_user: Annotated[SecureEndpointParams, Depends(protected_endpoints)],
+    current_user: Annotated[UserIdentity, Depends(protected_endpoints_identity)],
     user_auth: UserAuth,
-    vault: Optional[Vault] = None
+    response: Response,
+    vault: Optional[Vault] = None,
+    items: Optional[VaultItemsBatch] = None,
+    if_match: Annotated[Optional[str], Header()] = None
 ):
     """
     Update user's email
     :param User current_user: User's data
     :param UserAuth user_auth: User's authentication data
+    :param Response response: Response, to send the new ETag of the vault
     :param UserUniqueId new_user_email: new user email
     :param Vault vault: User's vault
+    :param VaultItemsBatch items: Every item of the vault, encrypted with the new key
+    :param str if_match: ETags of the vault the client updated, nothing is updated if none of them is current
     :return: Confirmation message
     """
 
-    if check_user_exists(user_auth.email):
+    if await check_user_exists(user_auth.email):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User already exists")
-
-    insert_update_delete_request(update_user_email(), (user_auth.email, current_user.email))
+    if items:
+        check_vault_items(items, None)
 
     # Recalculate the hash of the new password and generate a new salt
-    salt, h = generate_master_key_hash(get_byte_from_base64(user_auth.key_hash))
-
-    # Update the vault to be encrypted with the new password
-    vault_content = bytes(vault.vault, 'utf-8') if vault.vault else None
-    insert_update_delete_request(password_update(), (b64encode(h).decode(), user_auth.symmetric_key_encrypted, b64encode(salt).decode(), vault_content, user_auth.email))
-
+    salt, h = await derive(get_byte_from_base64(user_auth.key_hash))
+
+    vault_content, vault_format = encode_vault(vault.vault)
+    revisions = etag_revisions(if_match)
+    # The email and the vault are updated in the same transaction, rolled back if the vault was modified
+    async with db_cursor() as cur:
+        await cur.execute(update_user_email(), (user_auth.email, current_user.email))
+        await cur.execute(delete_breach_cache(), (current_user.id,))
+
+        # Update the vault to be encrypted with the new password
+        await cur.execute(password_update(), (b64encode(h).decode(), user_auth.symmetric_key_encrypted, b64encode(salt).decode(), KDF_ALGORITHM, PBKDF_NUM_ITERATIONS, vault_content, vault_format, vault_hash(vault.vault), user_auth.email, revisions, revisions))
+        row = await cur.fetchone()
+        if row is None:
+            raise HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED, detail="Vault modified by another client")
+        etag = vault_etag(row[0], row[1], two_factor=current_user.has_two_factor_auth)
+        await reencrypt_vault_items(cur, current_user.id, items)
+        await notify_vault_change(cur, current_user.id, {"type": "vault", "etag": etag})
+        # The sessions opened with the previous password are revoked, their event streams are closed
+        await notify_vault_change(cur, current_user.id, {"type": "revoked", "version": row[2]})
+
+    response.headers["ETag"] = etag
     return {"message": "Email address changed successfully"}
 
 
 @router.put("/update_password")
 async def update_password(
-    current_user: Annotated[SecureEndpointParams, Depends(protected_endpoints)],
+    current_user: Annotated[UserIdentity, Depends(protected_endpoints_identity)],
     user_auth: UserAuth,
-    vault: Optional[Vault] = None
+    response: Response,
+    vault: Optional[Vault] = None,
+    items: Optional[VaultItemsBatch] = None,
+    if_match: Annotated[Optional[str], Header()] = None
 ):
     """
     Update user's password
     :param User current_user: User's data
     :param UserAuth user_auth: User's authentication data (email, password, password confirmation, symmetric key)
+    :param Response response: Response, to send the new ETag of the vault
     :param Vault vault: Vault value
+    :param VaultItemsBatch items: Every item of the vault, encrypted with the new key
+    :param str if_match: ETags of the vault the client updated, nothing is updated if none of them is current
     :return: Confirmation message
     """
 
     if not user_auth.key_hash == user_auth.key_hash_conf:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Passwords do not match")
+    if items:
+        check_vault_items(items, None)
 
     # Recalculate the hash of the new password and generate a new salt
-    salt, h = generate_master_key_hash(get_byte_from_base64(user_auth.key_hash))
+    salt, h = await derive(get_byte_from_base64(user_auth.key_hash))
 
     # Update the vault to be encrypted with the new password
-    vault_content = bytes(vault.vault, 'utf-8') if vault.vault else None
-    insert_update_delete_request(password_update(), (b64encode(h).decode(), user_auth.symmetric_key_encrypted, b64encode(salt).decode(), vault_content, current_user.email))
-
+    vault_content, vault_format = encode_vault(vault.vault)
+    revisions = etag_revisions(if_match)
+    async with db_cursor() as cur:
+        await cur.execute(password_update(), (b64encode(h).decode(), user_auth.symmetric_key_encrypted, b64encode(salt).decode(), KDF_ALGORITHM, PBKDF_NUM_ITERATIONS, vault_content, vault_format, vault_hash(vault.vault), current_user.email, revisions, revisions))
+        row = await cur.fetchone()
+        if row is None:
+            raise HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED, detail="Vault modified by another client")
+        etag = vault_etag(row[0], row[1], two_factor=current_user.has_two_factor_auth)
+        await reencrypt_vault_items(cur, current_user.id, items)
+        await notify_vault_change(cur, current_user.id, {"type": "vault", "etag": etag})
+        # The sessions opened with the previous password are revoked, their event streams are closed
+        await notify_vault_change(cur, current_user.id, {"type": "revoked", "version": row[2]})
+
+    response.headers["ETag"] = etag
     return {"message": "Password changed successfully"}
 
 
 @router.post("/logout")
 async def logout(
-    token: Annotated[SecureEndpointParams, Depends(protected_endpoints_token)]
+    token: Annotated[SecureEndpointParams, Depends(protected_endpoints_token)],
+    refresh: Optional[RefreshTokenParams] = None
 ):
     """
     Logout user
     :param str token: Token used for user's session
+    :param RefreshTokenParams refresh: Refresh token of the session, revoked with the access token
+    :return: Confirmation message
+    """
+
+    if refresh:
+        await revoke_refresh_token(refresh.refresh_token)
+
+    # The revocation is stored and notified to all the workers in the same transaction
+    async with db_cursor() as cur:
+        await revoke_token(cur, token)
+    # The notification is received asynchronously, the worker's own index is updated right away
+    revocation_index.on_notification(revocation_payload(token))
+
+    return {"message": "Logout successful"}
+
+
+@router.post("/logout_all")
+async def logout_all(
+    current_user: Annotated[UserIdentity, Depends(protected_endpoints_identity)]
+):
+    """
+    Logout user from all sessions
+    :param User current_user: User's data
     :return: Confirmation message
     """
 
-    insert_update_delete_request(add_revoked_token(), (token,))
+    async with db_cursor() as cur:
+        await cur.execute(revoke_user_tokens(), (current_user.id,))
+        token_version, = await cur.fetchone()
+        await notify_vault_change(cur, current_user.id, {"type": "revoked", "version": token_version})
     return {"message": "Logout successful"}
 
 
 @router.delete("/delete_account")
 async def delete_account(
-    current_user: Annotated[SecureEndpointParams, Depends(protected_endpoints)]
+    current_user: Annotated[UserIdentity, Depends(protected_endpoints_identity)]
 ):
     """
     Delete user's account
@@ -181,5 +389,5 @@ async def delete_account(
     :return: Confirmation message
     """
 
-    insert_update_delete_request(delete_user(), (current_user.email,))
+    await insert_update_delete_request(delete_user(), (current_user.email,))
     return {"message": "Account deleted successfully"}
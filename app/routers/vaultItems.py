@@ -0,0 +1,145 @@
+from fastapi import APIRouter
+from ..auth import *
+from ..events import notify_vault_change
+from ..model import *
+from ..vault import decode_vault, encode_vault
+
+router = APIRouter(
+    tags=["Vault Items"]
+)
+
+VAULT_ITEMS_MAX_BATCH = int(os.environ.get('VAULT_ITEMS_MAX_BATCH', 500))  # Items changed per request
+VAULT_ITEMS_PAGE = int(os.environ.get('VAULT_ITEMS_PAGE', 1000))  # Changes sent per request
+VAULT_ITEM_ID_LENGTH = 64  # Length of the ids generated by the clients
+
+
+def check_vault_items(batch: VaultItemsBatch, max_items: Optional[int] = VAULT_ITEMS_MAX_BATCH):
+    """
+    Check the items of a batch before applying it
+    :param VaultItemsBatch batch: Items changed, the deleted ones included
+    :param int max_items: Largest number of items in the batch, None for no limit
+    :return: None
+    """
+
+    ids = [item.id for item in batch.items]
+    if max_items is not None and len(ids) > max_items:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Too many vault items")
+    if len(set(ids)) != len(ids) or not all(0 < len(item_id) <= VAULT_ITEM_ID_LENGTH for item_id in ids):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid vault item id")
+    if not all(item.deleted or item.data for item in batch.items):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Missing vault item data")
+
+
+async def apply_vault_items(cur, user_id: int, batch: VaultItemsBatch) -> int:
+    """
+    Apply a checked batch of items in the transaction of the given cursor, under a new revision of the items
+    Nothing is applied if an item sent with a revision was changed since by another client
+    :param cur: Database cursor
+    :param int user_id: Id of the user
+    :param VaultItemsBatch batch: Items changed, the deleted ones included
+    :return: New revision of the items of the vault
+    """
+
+    ids = [item.id for item in batch.items]
+
+    # Locks the user until the end of the transaction, the batches of a user are applied one after the other
+    await cur.execute(increase_items_revision(), (user_id,))
+    revision, = await cur.fetchone()
+
+    await cur.execute(select_vault_item_revisions(), (user_id, ids))
+    revisions = dict(await cur.fetchall())
+    if any(item.revision is not None and revisions.get(item.id, 0) != item.revision for item in batch.items):
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Vault items modified by another client")
+
+    upserts = []
+    for item in batch.items:
+        if not item.deleted:
+            # Only the workers reading binary serve the items
+            data, item_format = encode_vault(item.data, binary=True)
+            upserts.append((user_id, item.id, data, item_format, revision))
+    if upserts:
+        await cur.executemany(upsert_vault_item(), upserts)
+
+    deleted = [item.id for item in batch.items if item.deleted]
+    if deleted:
+        await cur.execute(delete_vault_items(), (revision, user_id, deleted))
+
+    await notify_vault_change(cur, user_id, {"type": "items", "revision": revision})
+    return revision
+
+
+async def reencrypt_vault_items(cur, user_id: int, batch: Optional[VaultItemsBatch]):
+    """
+    Apply the items encrypted with the new key of a user, in the transaction changing the key
+    The user must be locked by the transaction, so no item is added meanwhile
+    :param cur: Database cursor
+    :param int user_id: Id of the user
+    :param VaultItemsBatch batch: Every item of the vault encrypted with the new key, the deleted ones included
+    :return: None
+    """
+
+    items = batch.items if batch else []
+    await cur.execute(select_vault_item_ids(), (user_id,))
+    if {item_id for item_id, in await cur.fetchall()} - {item.id for item in items}:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Vault items must be encrypted with the new key")
+    if items:
+        await apply_vault_items(cur, user_id, batch)
+
+
+@router.post("/vault/items")
+async def update_vault_items(
+    current_user: Annotated[UserIdentity, Depends(protected_endpoints_identity)],
+    batch: VaultItemsBatch
+):
+    """
+    Apply the items changed by a client in a single transaction, under a new revision of the items of the vault
+    Nothing is applied if an item sent with a revision was changed since by another client
+    :param UserIdentity current_user: User's identity
+    :param VaultItemsBatch batch: Items changed, the deleted ones included
+    :return: New revision of the items of the vault
+    """
+
+    check_vault_items(batch)
+    if not batch.items:
+        revision, _ = await select_request(select_items_revision(), (current_user.id,))
+        return {"revision": revision}
+
+    async with db_cursor() as cur:
+        revision = await apply_vault_items(cur, current_user.id, batch)
+
+    return {"revision": revision}
+
+
+@router.get("/vault/items", response_model=VaultItemChanges)
+async def get_vault_item_changes(
+    current_user: Annotated[UserIdentity, Depends(protected_endpoints_identity)],
+    since: int = 0,
+    after: Optional[str] = None
+):
+    """
+    Get the items of the vault changed after a revision, the deleted ones as tombstones without data
+    At most VAULT_ITEMS_PAGE items are sent, the client asks the next ones from the revision and the item received, as
+    a revision changing every item of the vault (a change of the key) may not fit in a page
+    The tombstones are purged after VAULT_TOMBSTONE_RETENTION days, a client synced before must sync from 0
+    :param UserIdentity current_user: User's identity
+    :param int since: Revision the client is synced to, 0 for all the items
+    :param str after: Last item of the revision received, None when the client has every item of the revision
+    :return: Items changed, revision the client is synced to with them, whether more items changed and the last item
+    """
+
+    # The revision is read first, the changes of the batches committed meanwhile are sent with the next sync
+    current_revision, purged_revision = await select_request(select_items_revision(), (current_user.id,))
+    if 0 < since < purged_revision:
+        raise HTTPException(status_code=status.HTTP_410_GONE, detail="Vault items deleted since, sync from revision 0")
+    rows = await select_many_request(select_vault_item_changes(), (current_user.id, since, since, after, current_revision, VAULT_ITEMS_PAGE + 1))
+
+    more = len(rows) > VAULT_ITEMS_PAGE
+    after = None
+    if more:
+        # The next page starts after the last item sent, in the same revision or a later one
+        rows = rows[:VAULT_ITEMS_PAGE]
+        current_revision, after = rows[-1][3], rows[-1][0]
+
+    items = [VaultItem(id=item_id, data=decode_vault(data, item_format), revision=revision, deleted=deleted)
+             for item_id, data, item_format, revision, deleted in rows]
+    return VaultItemChanges(revision=current_revision, items=items, more=more, after=after)
@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import time
+import zlib
+from typing import Awaitable, Callable, Optional
+from .database import advisory_lock, insert_update_delete_request, select_job_schedule, select_request, upsert_job_schedule
+from .metrics import register_metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Job:
+    """
+    Periodic task run by a single worker at a time, the one holding the advisory lock of the job
+    The function returns the seconds before its next run, or None to wait the interval of the job. The time of the next
+    run is shared by the workers, so the job runs once per interval whatever the number of workers.
+    """
+
+    def __init__(self, name: str, func: Callable[[], Awaitable[Optional[float]]], interval: float, lock: str):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.lock_key = zlib.crc32(lock.encode())  # Same key in every worker
+
+        self.runs = 0
+        self.skipped = 0
+        self.failures = 0
+        self.last_duration = 0.0
+
+    async def run_once(self) -> float:
+        """
+        Run the job if it is due and no other worker runs a job with the same lock
+        :return: Seconds before the next run
+        """
+
+        async with advisory_lock(self.lock_key) as locked:
+            if not locked:
+                self.skipped += 1
+                return self.interval
+
+            schedule = await select_request(select_job_schedule(), (self.name,))
+            if schedule is not None and schedule[0] > 0:
+                # Run by another worker less than its delay ago
+                self.skipped += 1
+                return min(float(schedule[0]), self.interval)
+
+            delay = self.interval
+            start = time.monotonic()
+            try:
+                result = await self.func()
+                if result is not None:
+                    delay = result
+            finally:
+                self.last_duration = time.monotonic() - start
+                await insert_update_delete_request(upsert_job_schedule(), (self.name, delay))
+            self.runs += 1
+            return delay
+
+    async def run(self):
+        """
+        Run the job periodically, until cancelled
+        :return: None
+        """
+
+        while True:
+            try:
+                delay = await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.failures += 1
+                logger.exception("Error while running the job %s", self.name)
+                delay = self.interval
+            await asyncio.sleep(delay)
+
+    def stats(self) -> dict:
+        """
+        Counters of the job
+        :return: Runs, runs skipped because another worker holds the lock or ran the job recently, failures and
+        duration of the last run
+        """
+
+        return {
+            "runs": self.runs,
+            "skipped": self.skipped,
+            "failures": self.failures,
+            "last_duration": self.last_duration,
+        }
+
+
+class Scheduler:
+    """
+    Runs the periodic jobs of the API in every worker, each job being run by a single worker at a time
+    """
+
+    def __init__(self):
+        self.jobs: dict[str, Job] = {}
+        self._tasks = []
+
+    def add(self, name: str, func: Callable[[], Awaitable[Optional[float]]], interval: float, lock: str = None):
+        """
+        Add a job, must be called before the scheduler starts
+        :param str name: Name of the job
+        :param Function func: Coroutine function running the job, returning the seconds before its next run or None
+        :param float interval: Seconds between two runs, and between two attempts of the workers not running it
+        :param str lock: Name of the lock of the job, jobs sharing a lock never run at the same time
+        :return: None
+        """
+
+        self.jobs[name] = Job(name, func, interval, lock or name)
+
+    def start(self):
+        """
+        Start running the jobs in background tasks
+        :return: None
+        """
+
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(job.run()) for job in self.jobs.values()]
+
+    async def stop(self):
+        """
+        Stop the jobs, the running ones are cancelled
+        :return: None
+        """
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self) -> dict:
+        """
+        Counters of the jobs
+        :return: Counters by job name
+        """
+
+        return {name: job.stats() for name, job in self.jobs.items()}
+
+
+scheduler = Scheduler()
+register_metrics("scheduler", scheduler.stats)
@@ -1,34 +1,140 @@
 import os
+import re
+from html import escape
+from pathlib import Path
+from typing import Optional
 
 SITE = os.environ.get('SITE')
 API = os.environ.get('API')
 
+MAIL_TEMPLATES_DIR = Path(__file__).parent / "mail"  # Templates named <name>.<locale>.html and <name>.<locale>.txt
+DEFAULT_LOCALE = "en"
+PLACEHOLDER = re.compile(r"\{\{\s*(\w+)\s*\}\}")  # {{ name }}, replaced by a value
 
-def confirmation_mail(token):
+
+class CompiledTemplate:
+    """
+    Template split once into static parts and placeholders, the values known at load are rendered in the static parts
+    """
+
+    def __init__(self, source: str, static_values: dict):
+        pieces = PLACEHOLDER.split(source)
+        self._static = [pieces[0]]
+        self._fields = []
+        for field, static in zip(pieces[1::2], pieces[2::2]):
+            if field in static_values:
+                self._static[-1] += static_values[field] + static
+            else:
+                self._fields.append(field)
+                self._static.append(static)
+
+    def render(self, values: dict) -> str:
+        """
+        Render the template, only the placeholders not known at load are replaced
+        :param dict values: Values of the placeholders
+        :return: Rendered template
+        """
+
+        parts = [self._static[0]]
+        for field, static in zip(self._fields, self._static[1:]):
+            parts.append(values[field])
+            parts.append(static)
+        return "".join(parts)
+
+
+class MailTemplate:
+    """
+    Email in a language, with an HTML body and its plain text alternative
+    The first line of the plain text file is the subject of the email ("Subject: ...")
+    """
+
+    def __init__(self, html: str, text: str, static_values: dict):
+        subject, _, text = text.partition("\n")
+        self.subject = subject.removeprefix("Subject:").strip()
+        self.html = CompiledTemplate(html, {field: escape(value) for field, value in static_values.items()})
+        self.text = CompiledTemplate(text.lstrip("\n"), static_values)
+
+    def render(self, html_values: dict, text_values: dict = None) -> tuple:
+        """
+        Render the email
+        :param dict html_values: Values of the placeholders of the HTML body, already escaped
+        :param dict text_values: Values of the placeholders of the plain text body, the HTML ones if None
+        :return: Subject, HTML body and plain text body of the email
+        """
+
+        return self.subject, self.html.render(html_values), self.text.render(text_values or html_values)
+
+
+class TemplateRegistry:
+    """
+    Mail templates loaded and compiled once, by name and language
+    """
+
+    def __init__(self, directory: Path, static_values: dict):
+        self._templates: dict[tuple[str, str], MailTemplate] = {}
+        for html_path in sorted(directory.glob("*.*.html")):
+            name, locale = html_path.name.split(".")[:2]
+            text = html_path.with_suffix(".txt").read_text(encoding="utf-8")
+            self._templates[(name, locale)] = MailTemplate(html_path.read_text(encoding="utf-8"), text, static_values)
+        self.locales = {locale for _, locale in self._templates}
+
+    def get(self, name: str, locale: str = DEFAULT_LOCALE) -> MailTemplate:
+        """
+        Get a template in a language, in the default language if it is not translated
+        :param str name: Name of the template
+        :param str locale: Language of the email
+        :return: Template
+        """
+
+        return self._templates.get((name, locale)) or self._templates[(name, DEFAULT_LOCALE)]
+
+
+templates = TemplateRegistry(MAIL_TEMPLATES_DIR, {"site": SITE or "", "api": API or ""})
+
+
+def preferred_locale(accept_language: Optional[str]) -> str:
+    """
+    Pick the language of the emails from the Accept-Language header of a request
+    :param str accept_language: Accept-Language header, e.g. "fr-CH,fr;q=0.9,en;q=0.8"
+    :return: First accepted language having templates, the default language otherwise
+    """
+
+    languages = []
+    for item in (accept_language or "").split(","):
+        language, _, quality = item.strip().partition(";q=")
+        try:
+            languages.append((-float(quality or 1), language.split("-")[0].strip().lower()))
+        except ValueError:
+            continue
+    for _, language in sorted(languages):
+        if language in templates.locales:
+            return language
+    return DEFAULT_LOCALE
+
+
+def confirmation_mail(token, locale=DEFAULT_LOCALE):
     """
-    Generates the HTML for the confirmation email
+    Generates the confirmation email
     :param str token: The token to be used for the confirmation
-    :return: Tuple with subject of the mail and the HTML for the confirmation email
-    """
-
-    return "DuckPass Account Verification", f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-        </head>
-        <body>
-            <div style="display: flex; align-items: center; justify-content: center; flex-direction: column; background-color: #f8f8f8; padding: 2rem;">
-                <img src="https://i.imgur.com/Xpk0PiT.png" alt="DuckPass Logo" style="width: 150px; height: auto; margin-bottom: 1rem;">
-                <h3 style="color: #333;"> Quack your way into seamless security with DuckPass </h3>
-                <br>
-                <p style="color: #555;">Thanks for choosing DuckPass! Quack on the link below to verify your account:</p>
-
-                <a style="margin-top: 1rem; padding: 1rem; border-radius: 0.5rem; font-size: 1rem; text-decoration: none; background: #022837; color: white;" href="http://{API}/verify/?token={token}">
-                    Verify your email
-                <a>
-
-                <p style="margin-top: 1rem; color: #555;">If you didn't sign up for DuckPass, please kindly ignore this email – nothing will happen. Thanks<p>
-            </div>
-        </body>
-        </html>
+    :param str locale: Language of the email
+    :return: Tuple with subject of the mail, the HTML and the plain text for the confirmation email
     """
+
+    return templates.get("confirmation", locale).render({"token": token})
+
+
+def breach_mail(breaches, locale=DEFAULT_LOCALE):
+    """
+    Generates the email warning a user about new breaches of their account
+    :param list breaches: The new breaches, with their name, domain, date and compromised data
+    :param str locale: Language of the email
+    :return: Tuple with subject of the mail, the HTML and the plain text for the breach email
+    """
+
+    html_rows = "".join(f"""
+            <li style="margin-bottom: 0.5rem;"><b>{escape(breach['Name'])}</b> ({escape(breach['Domain'] or '')}), {escape(breach['BreachDate'])}: {escape(', '.join(breach['DataClasses']))}</li>"""
+                        for breach in breaches)
+    text_rows = "\n".join(f"- {breach['Name']} ({breach['Domain'] or ''}), {breach['BreachDate']}: "
+                          f"{', '.join(breach['DataClasses'])}" for breach in breaches)
+
+    return templates.get("breach", locale).render({"breaches": html_rows}, {"breaches": text_rows})
@@ -0,0 +1,27 @@
+import asyncio
+import pytest
+import pytest_asyncio
+
+
+@pytest.fixture(scope="session")
+def event_loop():
+    """
+    Event loop shared by all the asynchronous tests, the database pool is bound to it
+    """
+
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest_asyncio.fixture(scope="session")
+async def database():
+    """
+    Opens the database pool for the tests that need it
+    """
+
+    from app.database import open_database, close_database
+
+    await open_database()
+    yield
+    await close_database()
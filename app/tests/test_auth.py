@@ -5,9 +5,11 @@ import random
 import string
 from app.auth import *
 from app.model import UserAuth
+from app.vault import VAULT_BINARY_WRITES, VAULT_FORMAT_BINARY, VAULT_FORMAT_TEXT
 
-# Token used by the test user
+# Tokens used by the test user
 pytest.token = None
+pytest.refresh_token = None
 
 # User's data used below to test user's endpoints
 MOCK_USER = UserAuth(
@@ -52,9 +54,26 @@ def login(username, password):
     if response.status_code == 200:
         response_data = response.json()
         pytest.token = response_data.get('access_token')
+        pytest.refresh_token = response_data.get('refresh_token')
     return response.status_code
 
 
+def refresh(refresh_token):
+    """
+    Function to refresh the session of a user
+    :param refresh_token: Refresh token received at login
+    :return: Response of the request
+    """
+    url = f"{pytest.API}/token/refresh"
+
+    headers = {
+        "accept": "application/json",
+        "Content-Type": "application/json"
+    }
+
+    return requests.post(url, data=json.dumps({"refresh_token": refresh_token}), headers=headers)
+
+
 def get_user(token):
     """
     Function to get the user's data
@@ -73,7 +92,8 @@ def get_user(token):
 
 
 @pytest.mark.run(order=8)
-def test_api_register():
+@pytest.mark.asyncio
+async def test_api_register(database):
     """
     Function to test the register endpoint with a new user
     """
@@ -94,7 +114,7 @@ def test_api_register():
     }
 
     response = requests.post(url, data=json_data, headers=headers)
-    insert_update_delete_request(update_verification(), (MOCK_USER.email,))
+    await insert_update_delete_request(update_verification(), (MOCK_USER.email,))
     assert response.status_code == 200
 
 
@@ -139,6 +159,23 @@ def test_api_login_with_bad_credentials():
     assert login(MOCK_USER2.email, MOCK_USER2.key_hash) == 404
 
 
+@pytest.mark.run(order=11)
+def test_refresh_token():
+    """
+    Function to test the refresh endpoint, and that a refresh token used twice revokes the session
+    """
+
+    first_refresh_token = pytest.refresh_token
+    response = refresh(first_refresh_token)
+    assert response.status_code == 200
+    second_refresh_token = response.json().get('refresh_token')
+    assert second_refresh_token != first_refresh_token
+    pytest.token = response.json().get('access_token')
+
+    assert refresh(first_refresh_token).status_code == 401
+    assert refresh(second_refresh_token).status_code == 401
+
+
 @pytest.mark.run(order=12)
 def test_get_user():
     """
@@ -180,6 +217,117 @@ def test_update_vault():
     assert response.status_code == 200
 
 
+@pytest.mark.run(order=17)
+def test_get_vault():
+    """
+    Function to test the vault download endpoint and the get_user endpoint without the vault
+    """
+    headers = {
+        "Authorization": "Bearer " + pytest.token
+    }
+
+    user = requests.get(f"{pytest.API}/get_user", headers=headers).json()
+    raw = requests.get(f"{pytest.API}/vault", headers=headers)
+    assert raw.status_code == 200
+    assert raw.headers["X-Vault-Format"] == str(VAULT_FORMAT_BINARY if VAULT_BINARY_WRITES else VAULT_FORMAT_TEXT)
+    assert decode_vault(raw.content, int(raw.headers["X-Vault-Format"])) == user["vault"]
+
+    chunked = requests.get(f"{pytest.API}/vault", params={"chunked": "true"}, headers=headers)
+    assert chunked.headers.get("Transfer-Encoding") == "chunked"
+    assert chunked.content == raw.content
+
+    user = requests.get(f"{pytest.API}/get_user", params={"include_vault": "false"}, headers=headers).json()
+    assert user["vault"] is None and user["symmetric_key_encrypted"]
+
+
+@pytest.mark.run(order=17)
+def test_conditional_vault_sync():
+    """
+    Function to test that an unchanged vault is not sent again and that a vault modified by another client is not overwritten
+    """
+    headers = {
+        "Authorization": "Bearer " + pytest.token
+    }
+
+    # The data sent without the vault has its own ETag, it does not spare the download of the vault
+    meta = requests.get(f"{pytest.API}/get_user", params={"include_vault": "false"}, headers=headers).headers["ETag"]
+    response = requests.get(f"{pytest.API}/get_user", headers={**headers, "If-None-Match": meta})
+    assert response.status_code == 200 and response.json()["vault"]
+    response = requests.get(f"{pytest.API}/get_user", params={"include_vault": "false"}, headers={**headers, "If-None-Match": meta})
+    assert response.status_code == 304
+
+    etag = requests.get(f"{pytest.API}/get_user", headers=headers).headers["ETag"]
+    assert etag != meta
+    response = requests.get(f"{pytest.API}/get_user", headers={**headers, "If-None-Match": etag})
+    assert response.status_code == 304 and response.headers["ETag"] == etag
+    assert requests.get(f"{pytest.API}/vault", headers={**headers, "If-None-Match": etag}).status_code == 304
+
+    data = json.dumps({"vault": "3q2+7w==|q83vEjRWeJA="})
+    response = requests.put(f"{pytest.API}/update_vault", data=data, headers={**headers, "If-Match": etag})
+    assert response.status_code == 200
+    new_etag = response.headers["ETag"]
+    assert new_etag != etag
+
+    # The client still having the previous revision cannot overwrite the vault
+    response = requests.put(f"{pytest.API}/update_vault", data=data, headers={**headers, "If-Match": etag})
+    assert response.status_code == 412
+    assert requests.get(f"{pytest.API}/get_user", headers={**headers, "If-None-Match": etag}).status_code == 200
+
+
+@pytest.mark.run(order=17)
+def test_vault_items():
+    """
+    Function to test that the items of a vault are changed by batches and synced from a revision
+    """
+    url = f"{pytest.API}/vault/items"
+    headers = {
+        "Authorization": "Bearer " + pytest.token
+    }
+
+    items = [{"id": "item-1", "data": "q83vEjRWeJA=|3q2+7w=="}, {"id": "item-2", "data": "not base64"}]
+    first = requests.post(url, data=json.dumps({"items": items}), headers=headers).json()["revision"]
+
+    changes = requests.get(url, params={"since": 0}, headers=headers).json()
+    assert changes["revision"] == first and not changes["more"]
+    assert [(item["id"], item["data"], item["revision"]) for item in changes["items"]] == [
+        ("item-1", items[0]["data"], first), ("item-2", items[1]["data"], first)]
+
+    # Only the changed items are sent, the deleted ones as tombstones
+    batch = {"items": [{"id": "item-2", "revision": first, "deleted": True}]}
+    second = requests.post(url, data=json.dumps(batch), headers=headers).json()["revision"]
+    changes = requests.get(url, params={"since": first}, headers=headers).json()
+    assert changes["revision"] == second
+    assert [(item["id"], item["data"], item["deleted"]) for item in changes["items"]] == [("item-2", None, True)]
+
+    # A client changing an item modified since its last sync changes nothing
+    batch = {"items": [{"id": "item-1", "data": "3q2+7w==", "revision": first}, {"id": "item-2", "revision": first, "deleted": True}]}
+    response = requests.post(url, data=json.dumps(batch), headers=headers)
+    assert response.status_code == 409
+    assert requests.get(url, params={"since": second}, headers=headers).json()["items"] == []
+
+    response = requests.post(url, data=json.dumps({"items": [{"id": "", "data": "x"}]}), headers=headers)
+    assert response.status_code == 400
+
+
+@pytest.mark.run(order=17)
+def test_vault_events():
+    """
+    Function to test that a change of the vault is pushed to the event stream of the user
+    """
+    headers = {
+        "Authorization": "Bearer " + pytest.token
+    }
+
+    with requests.get(f"{pytest.API}/vault/events", headers=headers, stream=True, timeout=10) as stream:
+        assert stream.headers["Content-Type"].startswith("text/event-stream")
+        response = requests.put(f"{pytest.API}/update_vault", data=json.dumps({"vault": "q83vEjRWeJA="}), headers=headers)
+        assert response.status_code == 200
+
+        lines = stream.iter_lines(decode_unicode=True)
+        assert next(line for line in lines if line.startswith("event:")) == "event: vault"
+        assert json.loads(next(lines).removeprefix("data: ")) == {"type": "vault", "etag": response.headers["ETag"]}
+
+
 @pytest.mark.run(order=18)
 def test_update_email():
     """
@@ -200,14 +348,17 @@ def test_update_email():
         }
     }
 
-    json_data = json.dumps(data)
-
     headers = {
         "Authorization": "Bearer " + pytest.token,
         "accept": "application/json"
     }
 
-    response = requests.put(url, data=json_data, headers=headers)
+    # The items of the vault must be encrypted with the new key in the same request
+    response = requests.put(url, data=json.dumps(data), headers=headers)
+    assert response.status_code == 409
+
+    data["items"] = {"items": [{"id": "item-1", "data": "3q2+7w=="}]}
+    response = requests.put(url, data=json.dumps(data), headers=headers)
     assert response.status_code == 200
     assert login(MOCK_USER2.email, MOCK_USER2.key_hash) == 200
 
@@ -229,6 +380,9 @@ def test_update_password():
         },
         "vault": {
             "vault": ""
+        },
+        "items": {
+            "items": [{"id": "item-1", "data": "q83vEjRWeJA=|3q2+7w=="}]
         }
     }
 
@@ -241,6 +395,9 @@ def test_update_password():
 
     response = requests.put(url, data=json_data, headers=headers)
     assert response.status_code == 200
+    # Changing the password revokes the sessions opened with the previous one
+    assert get_user(pytest.token) == 401
+    assert login(MOCK_USER2.email, MOCK_USER.key_hash) == 200
 
 
 # test logout
@@ -277,3 +434,44 @@ def test_delete_user():
     response = requests.delete(url, headers=headers)
     assert response.status_code == 200
 
+
+@pytest.mark.run(order=53)
+@pytest.mark.asyncio
+async def test_resend_verification(database):
+    """
+    Function to test that the resend verification endpoint answers the same whether the account exists or not, and
+    queues the confirmation email of an unverified account once per window
+    """
+
+    url = f"{pytest.API}/resend_verification"
+    headers = {
+        'Content-Type': 'application/json'
+    }
+    email = "unverified@duckpass.ch"
+    count_mails = """SELECT COUNT(*) FROM duckpass."MailQueue" WHERE dedupeKey = %s"""
+
+    data = {
+        "email": email,
+        "key_hash": MOCK_USER.key_hash,
+        "key_hash_conf": MOCK_USER.key_hash_conf,
+        "symmetric_key_encrypted": MOCK_USER.symmetric_key_encrypted
+    }
+    assert requests.post(f"{pytest.API}/register", data=json.dumps(data), headers=headers).status_code == 200
+    try:
+        # The email queued by the registration is dropped, so the first request queues a new one
+        await insert_update_delete_request("""DELETE FROM duckpass."MailQueue" WHERE recipient = %s""", (email,))
+
+        response = requests.post(url, data=json.dumps({"email": email}), headers=headers)
+        assert response.status_code == 200
+        assert await select_request(count_mails, (f"verification:{email}",)) == (1,)
+
+        # A second request inside the window queues nothing
+        again = requests.post(url, data=json.dumps({"email": email}), headers=headers)
+        assert again.json() == response.json()
+        assert await select_request(count_mails, (f"verification:{email}",)) == (1,)
+
+        unknown = requests.post(url, data=json.dumps({"email": "unknown@duckpass.ch"}), headers=headers)
+        assert unknown.json() == response.json()
+    finally:
+        await insert_update_delete_request("""DELETE FROM duckpass."MailQueue" WHERE recipient = %s""", (email,))
+        await insert_update_delete_request(delete_user(), (email,))
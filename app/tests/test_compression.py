@@ -0,0 +1,135 @@
+import gzip
+import json
+import pytest
+import zlib
+from fastapi import FastAPI, Request
+from starlette.responses import PlainTextResponse, StreamingResponse
+from starlette.testclient import TestClient
+from app.compression import *
+
+VAULT = "q83vEjRWeJA=|3q2+7w==|" * 200
+
+
+def compressed_app() -> FastAPI:
+    """
+    Function to build an application behind the compression middleware
+    :return: Application
+    """
+
+    app = FastAPI()
+    app.add_middleware(CompressionMiddleware, minimum_size=100, max_request_size=10000)
+
+    @app.get("/vault")
+    async def vault():
+        return {"vault": VAULT}
+
+    @app.get("/small")
+    async def small():
+        return {"vault": "abc"}
+
+    @app.get("/events")
+    async def events():
+        async def stream():
+            yield "event: vault\ndata: {}\n\n" * 100
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    @app.get("/stream")
+    async def stream():
+        async def lines():
+            for i in range(100):
+                yield json.dumps({"line": i}) + "\n"
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+    @app.put("/update_vault")
+    async def update_vault(request: Request):
+        return PlainTextResponse(str(len(await request.body())))
+
+    return app
+
+
+@pytest.fixture
+def client():
+    """
+    Client of the application behind the compression middleware
+    """
+
+    with TestClient(compressed_app()) as test_client:
+        yield test_client
+
+
+def decompress(encoding, data):
+    """
+    Function to decompress a response body with the optional libraries
+    :return: Decompressed body
+    """
+
+    if encoding == "zstd":
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    if encoding == "br":
+        return brotli.decompress(data)
+    return gzip.decompress(data)
+
+
+@pytest.mark.run(order=61)
+def test_negotiate_encoding():
+    """
+    Function to test that the encoding of the responses is picked from the qualities accepted by the client
+    """
+
+    assert negotiate_encoding("gzip") == "gzip"
+    assert negotiate_encoding("gzip;q=0, deflate") is None
+    assert negotiate_encoding("identity") is None
+    assert negotiate_encoding("") is None
+    assert negotiate_encoding("*") == ENCODINGS[0]
+    assert negotiate_encoding("gzip;q=1.0, br;q=0.5, zstd;q=0.5") == "gzip"
+
+
+@pytest.mark.run(order=62)
+def test_compressed_responses(client):
+    """
+    Function to test that the large responses are compressed, with every encoding available
+    """
+
+    for encoding in ENCODINGS:
+        with client.stream("GET", "/vault", headers={"Accept-Encoding": encoding}) as response:
+            body = b"".join(response.iter_raw())
+        assert response.headers["Content-Encoding"] == encoding
+        assert "Accept-Encoding" in response.headers["Vary"]
+        assert int(response.headers["Content-Length"]) == len(body) < len(VAULT)
+        assert json.loads(decompress(encoding, body)) == {"vault": VAULT}
+
+    # Small responses and event streams are sent as they are
+    assert "Content-Encoding" not in client.get("/small", headers={"Accept-Encoding": "gzip"}).headers
+    assert "Content-Encoding" not in client.get("/events", headers={"Accept-Encoding": "gzip"}).headers
+    assert "Content-Encoding" not in client.get("/vault", headers={"Accept-Encoding": "identity"}).headers
+
+
+@pytest.mark.run(order=63)
+def test_compressed_stream(client):
+    """
+    Function to test that a streamed response is compressed chunk by chunk, each chunk readable on its own
+    """
+
+    with client.stream("GET", "/stream", headers={"Accept-Encoding": "gzip"}) as response:
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert "Content-Length" not in response.headers
+        decompressor = zlib.decompressobj(31)
+        chunks = [decompressor.decompress(chunk) for chunk in response.iter_raw()]
+    assert all(chunk.endswith(b"\n") for chunk in chunks if chunk)
+    assert b"".join(chunks).splitlines()[-1] == b'{"line": 99}'
+
+
+@pytest.mark.run(order=64)
+def test_compressed_requests(client):
+    """
+    Function to test that the compressed request bodies are decompressed, up to the size limit
+    """
+
+    body = json.dumps({"vault": VAULT[:5000]}).encode()
+    response = client.put("/update_vault", content=gzip.compress(body), headers={"Content-Encoding": "gzip"})
+    assert response.status_code == 200 and response.text == str(len(body))
+
+    assert client.put("/update_vault", content=gzip.compress(b"a" * 10001), headers={"Content-Encoding": "gzip"}).status_code == 413
+    assert client.put("/update_vault", content=gzip.compress(body)[:50], headers={"Content-Encoding": "gzip"}).status_code == 400
+    assert client.put("/update_vault", content=b"not gzip", headers={"Content-Encoding": "gzip"}).status_code == 400
+    assert client.put("/update_vault", content=body, headers={"Content-Encoding": "compress"}).status_code == 415
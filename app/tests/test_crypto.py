@@ -1,6 +1,11 @@
+import asyncio
+import os
 import pytest
+import time
+from fastapi import HTTPException
 from pytest_mock import mocker
 from app.crypto import *
+from app.kdf import KdfExecutor
 
 MOCK_MASTER_KEY = "k0KvWBh+i/abeV2emfvXf/xn+zKyHLyVbyJ6wBzS6lQ="
 MOCK_SALT = "dCRMeUNqyS391itmSCclAw=="
@@ -23,3 +28,79 @@ def test_verify_master_key_valid():
 @pytest.mark.run(order=7)
 def test_verify_master_key_invalid():
     assert verify_master_key_hash(get_byte_from_base64(MOCK_MASTER_KEY), get_byte_from_base64(MOCK_SALT), b"") == False
+
+
+@pytest.mark.run(order=26)
+def test_kdf_executor_verify():
+    executor = KdfExecutor(pool_size=1, max_queue=1, queue_timeout=60)
+    try:
+        assert asyncio.run(executor.run(verify_master_key_hash, get_byte_from_base64(MOCK_MASTER_KEY), get_byte_from_base64(MOCK_SALT), get_byte_from_base64(MOCK_MASTER_KEY_RESULT))) == True
+        assert executor.stats()["completed"] == 1
+    finally:
+        executor.shutdown()
+
+
+@pytest.mark.run(order=27)
+def test_kdf_executor_saturated():
+    executor = KdfExecutor(pool_size=1, max_queue=0, queue_timeout=60)
+    try:
+        with pytest.raises(HTTPException) as exc:
+            asyncio.run(executor.run(verify_master_key_hash, b"", b"", b""))
+        assert exc.value.status_code == 503
+        assert executor.stats()["rejected"] == 1
+    finally:
+        executor.shutdown()
+
+
+@pytest.mark.run(order=27)
+def test_kdf_executor_queue_full():
+    executor = KdfExecutor(pool_size=1, max_queue=1, queue_timeout=60)
+
+    async def saturate():
+        running = asyncio.ensure_future(executor.run(time.sleep, 0.5))
+        while not executor.running:
+            await asyncio.sleep(0)
+        waiting = asyncio.ensure_future(executor.run(time.sleep, 0))
+        while not executor.waiting:
+            await asyncio.sleep(0)
+        # The process and the single place of the queue are taken
+        with pytest.raises(HTTPException) as exc:
+            await executor.run(time.sleep, 0)
+        assert exc.value.status_code == 503
+        await asyncio.gather(running, waiting)
+
+    try:
+        asyncio.run(saturate())
+        assert executor.stats()["rejected"] == 1
+        assert executor.stats()["completed"] == 2
+    finally:
+        executor.shutdown()
+
+
+@pytest.mark.run(order=27)
+def test_kdf_executor_broken_pool():
+    executor = KdfExecutor(pool_size=1, max_queue=1, queue_timeout=60)
+    try:
+        # The process dies, the derivation fails without counting as completed
+        with pytest.raises(HTTPException) as exc:
+            asyncio.run(executor.run(os._exit, 1))
+        assert exc.value.status_code == 503
+        assert executor.stats()["failures"] == 1
+        assert executor.stats()["completed"] == 0 and executor.stats()["run_seconds_total"] == 0
+    finally:
+        executor.shutdown()
+
+
+@pytest.mark.run(order=31)
+def test_needs_rehash():
+    assert needs_rehash(KDF_ALGORITHM, PBKDF_NUM_ITERATIONS) == False
+    assert needs_rehash(KDF_ALGORITHM, PBKDF_NUM_ITERATIONS - 1) == True
+    assert needs_rehash("unknown", PBKDF_NUM_ITERATIONS) == True
+
+
+@pytest.mark.run(order=32)
+def test_verify_master_key_with_stored_parameters():
+    salt = get_byte_from_base64(MOCK_SALT)
+    h = derive_key(get_byte_from_base64(MOCK_MASTER_KEY), salt, KDF_ALGORITHM, 1000)
+    assert verify_master_key_hash(get_byte_from_base64(MOCK_MASTER_KEY), salt, h, KDF_ALGORITHM, 1000) == True
+    assert verify_master_key_hash(get_byte_from_base64(MOCK_MASTER_KEY), salt, h, KDF_ALGORITHM, 1001) == False
@@ -1,5 +1,16 @@
+import asyncio
+import httpx
+import json
 import pytest
 import requests
+import time
+from fastapi import HTTPException
+from app.breaches import breach_stats, get_cached_breaches, new_breaches, refresh_job, refresh_stale_breaches, \
+    sweep_breaches
+from app.cache import LruCache
+from app.database import *
+from app.hibp import *
+from app.pwned_dataset import import_dataset
 
 
 @pytest.mark.run(order=14)
@@ -36,3 +47,328 @@ def test_get_breaches_without_email():
     response = requests.get(url, headers=headers)
 
     assert response.status_code == 404
+
+
+def mock_client(handler):
+    """
+    Function to create a HIBP client answered by the given handler instead of the HIBP servers
+    :param handler: Function receiving the request and returning the response
+    :return: HIBP client
+    """
+
+    return HibpClient("http://hibp.test/api/v3", "http://passwords.test", transport=httpx.MockTransport(handler))
+
+
+async def request_and_close(client, coroutine):
+    """
+    Function to run a request of the client and close it in the same event loop
+    """
+
+    try:
+        return await coroutine
+    finally:
+        await client.close()
+
+
+@pytest.mark.run(order=35)
+def test_password_range_retried_on_server_error(monkeypatch):
+    """
+    Function to test that a request failing with a server error is retried
+    """
+
+    monkeypatch.setattr("app.hibp.HIBP_BACKOFF", 0)
+    responses = iter([httpx.Response(503), httpx.Response(200, text="0018A45C4D1DEF81644B54AB7F969B88D65:1")])
+    client = mock_client(lambda request: next(responses))
+
+    assert asyncio.run(request_and_close(client, client.password_range("21BD1"))) == "0018A45C4D1DEF81644B54AB7F969B88D65:1"
+    assert client.stats()["retries"] == 1
+
+
+@pytest.mark.run(order=36)
+def test_breached_account_not_found():
+    """
+    Function to test that an account without breach has an empty list of breaches
+    """
+
+    client = mock_client(lambda request: httpx.Response(404))
+    assert asyncio.run(request_and_close(client, client.breached_account("test@duckpass.ch"))) == []
+
+
+@pytest.mark.run(order=37)
+def test_password_range_unavailable(monkeypatch):
+    """
+    Function to test that the API answers 502 once the retries are exhausted
+    """
+
+    monkeypatch.setattr("app.hibp.HIBP_BACKOFF", 0)
+    client = mock_client(lambda request: httpx.Response(500))
+
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(request_and_close(client, client.password_range("21BD1")))
+    assert exc.value.status_code == 502
+
+
+@pytest.mark.run(order=38)
+def test_range_cache_coalesces_concurrent_misses():
+    """
+    Function to test that concurrent requests for the same prefix are answered by a single fetch, then from memory
+    """
+
+    fetches = []
+
+    async def fetch(prefix):
+        fetches.append(prefix)
+        await asyncio.sleep(0.01)
+        return "0018A45C4D1DEF81644B54AB7F969B88D65:1"
+
+    async def get_ranges(cache):
+        bodies = await asyncio.gather(*(cache.get("21bd1", fetch) for _ in range(10)))
+        bodies.append(await cache.get("21BD1", fetch))
+        return bodies
+
+    cache = RangeCache(1024, 60, False)
+    bodies = asyncio.run(get_ranges(cache))
+
+    assert bodies == ["0018A45C4D1DEF81644B54AB7F969B88D65:1"] * 11
+    assert fetches == ["21BD1"]
+    assert cache.stats()["coalesced"] == 9
+    assert cache.stats()["hits"] == 1
+
+
+@pytest.mark.run(order=38)
+def test_range_cache_shared_age(monkeypatch):
+    """
+    Function to test that a response of the shared tier is kept in memory for the rest of its time to live only
+    """
+
+    async def get_shared(prefix):
+        return "0018A45C4D1DEF81644B54AB7F969B88D65:1", 50.0
+
+    async def fetch(prefix):
+        return "00D4F6E8FA6EECAD2A3AA415EEC418D38EC:2"
+
+    cache = RangeCache(1024, 60, True)
+    monkeypatch.setattr(cache, "_get_shared", get_shared)
+    assert asyncio.run(cache.get("21BD1", fetch)) == "0018A45C4D1DEF81644B54AB7F969B88D65:1"
+
+    now = time.monotonic()
+    monkeypatch.setattr("app.cache.time.monotonic", lambda: now + 11)
+    assert cache.local.get("21BD1") is None
+    assert cache.stats()["shared_hits"] == 1 and cache.stats()["expirations"] == 1
+
+
+@pytest.mark.run(order=39)
+def test_lru_cache_bounded_by_size():
+    """
+    Function to test that the least recently used entries are evicted to stay within the size bound
+    """
+
+    cache = LruCache(10, 60)
+    cache.set("a", "aaaa")
+    cache.set("b", "bbbb")
+    assert cache.get("a") == "aaaa"
+    cache.set("c", "cccc")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == "aaaa"
+    assert cache.get("c") == "cccc"
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["bytes"] == 8
+
+
+@pytest.mark.run(order=40)
+def test_lru_cache_expiration(monkeypatch):
+    """
+    Function to test that an entry is not returned once its time to live has elapsed
+    """
+
+    cache = LruCache(10, 60)
+    cache.set("a", "aaaa")
+    now = time.monotonic()
+    monkeypatch.setattr("app.cache.time.monotonic", lambda: now + 61)
+
+    assert cache.get("a") is None
+    assert cache.stats()["expirations"] == 1
+    assert cache.stats()["bytes"] == 0
+
+
+@pytest.mark.run(order=41)
+def test_pwned_dataset_range(tmp_path):
+    """
+    Function to test that the dataset answers a range query like the Pwned Passwords API
+    """
+
+    dump = tmp_path / "pwnedpasswords.txt"
+    dump.write_text("000000005AD76BD555C1D6D771DE417A4B87E4B4:10\r\n"
+                    "21BD10018A45C4D1DEF81644B54AB7F969B88D65:1\r\n"
+                    "21BD100D4F6E8FA6EECAD2A3AA415EEC418D38EC:2\r\n"
+                    "FFFFFFFEE791CBAC0F6305CAF0CEE06BBE131160:4\r\n")
+    assert import_dataset(str(dump), str(tmp_path / "pwnedpasswords.bin")) == 4
+
+    dataset = PwnedDataset(str(tmp_path / "pwnedpasswords.bin"))
+    try:
+        assert dataset.password_range("21bd1") == ("0018A45C4D1DEF81644B54AB7F969B88D65:1\r\n"
+                                                   "00D4F6E8FA6EECAD2A3AA415EEC418D38EC:2")
+        assert dataset.password_range("00000") == "0005AD76BD555C1D6D771DE417A4B87E4B4:10"
+        assert dataset.password_range("FFFFF") == "FFEE791CBAC0F6305CAF0CEE06BBE131160:4"
+        assert dataset.password_range("21BD2") == ""
+    finally:
+        dataset.close()
+
+
+@pytest.mark.run(order=42)
+def test_pwned_dataset_unordered_dump(tmp_path):
+    """
+    Function to test that a dump not ordered by hash is rejected
+    """
+
+    dump = tmp_path / "pwnedpasswords.txt"
+    dump.write_text("21BD10018A45C4D1DEF81644B54AB7F969B88D65:1\n"
+                    "000000005AD76BD555C1D6D771DE417A4B87E4B4:10\n")
+
+    with pytest.raises(ValueError):
+        import_dataset(str(dump), str(tmp_path / "pwnedpasswords.bin"))
+
+
+@pytest.mark.run(order=43)
+def test_breaches_for_passwords_bounded(monkeypatch):
+    """
+    Function to test that a batch fetches a bounded number of ranges at once and reports the failed ones
+    """
+
+    running = []
+    fetched = []
+
+    async def get_breach(email, hash_begin):
+        running.append(hash_begin)
+        fetched.append(len(running))
+        await asyncio.sleep(0.01)
+        running.remove(hash_begin)
+        if hash_begin == "FFFFF":
+            raise HTTPException(status_code=502, detail="HIBP service unavailable")
+        if hash_begin == "EEEEE":
+            raise ValueError("Invalid range")
+        return f"{hash_begin}:1"
+
+    async def get_batch(prefixes):
+        return [result async for result in get_breaches_for_passwords("test@duckpass.ch", prefixes)]
+
+    monkeypatch.setattr("app.hibp.HIBP_BATCH_CONCURRENCY", 4)
+    monkeypatch.setattr("app.hibp.get_breach_for_password", get_breach)
+    prefixes = [f"{i:05X}" for i in range(20)] + ["FFFFF", "EEEEE"]
+    results = asyncio.run(get_batch(prefixes))
+
+    assert max(fetched) == 4
+    assert sorted(prefix for prefix, _, _ in results) == sorted(prefixes)
+    assert ("FFFFF", None, "HIBP service unavailable") in results
+    assert ("EEEEE", None, "Unexpected error") in results
+    assert ("00001", "00001:1", None) in results
+
+
+@pytest.mark.run(order=44)
+@pytest.mark.asyncio
+async def test_refresh_stale_breaches(database, monkeypatch):
+    """
+    Function to test that the stale cached breaches are refreshed in batches and the fresh ones are served from the cache
+    """
+
+    async def get_breach(email):
+        return [{"Name": "Adobe", "Domain": "adobe.com", "BreachDate": "2013-10-04", "DataClasses": ["Passwords"]}]
+
+    monkeypatch.setattr("app.breaches.get_breach_for_user", get_breach)
+    monkeypatch.setattr("app.breaches.HIBP_REFRESH_PER_MINUTE", 60_000)
+    await insert_update_delete_request(insert_user(), ("breaches@duckpass.ch", "hash", "key", "salt", "pbkdf2-sha256", 600000))
+    user_id = (await select_request(select_user(), ("breaches@duckpass.ch",)))[0]
+    try:
+        await insert_update_delete_request("""INSERT INTO duckpass."BreachCache" VALUES (%s, '[]', CURRENT_TIMESTAMP - INTERVAL '2 days')""", (user_id,))
+        assert await get_cached_breaches(user_id, "breaches@duckpass.ch") == "[]"
+
+        assert await refresh_stale_breaches() >= 1
+        assert json.loads(await get_cached_breaches(user_id, "breaches@duckpass.ch"))[0]["Name"] == "Adobe"
+
+        # Stale breaches left or not, the next batch waits the interval for the sweep to get its turn
+        await insert_update_delete_request("""UPDATE duckpass."BreachCache" SET fetchedAt = CURRENT_TIMESTAMP - INTERVAL '2 days' WHERE userId = %s""", (user_id,))
+        assert await refresh_job() is None
+    finally:
+        await insert_update_delete_request(delete_user(), ("breaches@duckpass.ch",))
+
+
+@pytest.mark.run(order=45)
+def test_new_breaches():
+    """
+    Function to test that only the breaches not seen before are reported, and none the first time
+    """
+
+    adobe = {"Name": "Adobe", "Domain": "adobe.com", "BreachDate": "2013-10-04", "DataClasses": ["Passwords"]}
+    linkedin = {"Name": "LinkedIn", "Domain": "linkedin.com", "BreachDate": "2012-05-05", "DataClasses": ["Passwords"]}
+
+    assert new_breaches(None, [adobe, linkedin]) == []
+    assert new_breaches(json.dumps([adobe]), [adobe, linkedin]) == [linkedin]
+    assert new_breaches(json.dumps([adobe, linkedin]), [adobe]) == []
+
+
+@pytest.mark.run(order=46)
+@pytest.mark.asyncio
+async def test_sweep_breaches(database, monkeypatch):
+    """
+    Function to test that a sweep mails the users about their new breaches and resumes from its checkpoint
+    The breaches already cached by a refresh are mailed too, only the breaches notified are compared
+    """
+
+    mails = []
+
+    async def get_breach(email):
+        return [{"Name": "Adobe", "Domain": "adobe.com", "BreachDate": "2013-10-04", "DataClasses": ["Passwords"]}]
+
+    async def send(email, mail_template):
+        mails.append((email, mail_template("token")[0]))
+
+    monkeypatch.setattr("app.breaches.get_breach_for_user", get_breach)
+    monkeypatch.setattr("app.breaches.send_email", send)
+    monkeypatch.setattr("app.breaches.HIBP_REFRESH_PER_MINUTE", 60_000)
+    await insert_update_delete_request(insert_user(), ("sweep@duckpass.ch", "hash", "key", "salt", "pbkdf2-sha256", 600000))
+    user_id = (await select_request(select_user(), ("sweep@duckpass.ch",)))[0]
+    try:
+        await insert_update_delete_request(update_verification(), ("sweep@duckpass.ch",))
+        await insert_update_delete_request(upsert_notified_breaches(), (user_id, "[]", "[]"))
+        await insert_update_delete_request(upsert_breach_cache(), (user_id, json.dumps(await get_breach("sweep@duckpass.ch"))))
+        await insert_update_delete_request(upsert_job_checkpoint(), ("breach_sweep", user_id - 1))
+
+        assert await sweep_breaches() == 0
+        assert mails == [("sweep@duckpass.ch", "DuckPass Breach Alert")]
+        assert (await select_request(select_job_checkpoint(), ("breach_sweep",)))[0] == user_id
+
+        # The end of the users ends the sweep, the next one starts after the interval
+        assert await sweep_breaches() == 0
+        assert (await select_request(select_job_checkpoint(), ("breach_sweep",)))[0] == 0
+        assert await sweep_breaches() > 0
+        assert len(mails) == 1
+        assert json.loads((await select_request("""SELECT notifiedBreaches::text FROM duckpass."BreachCache" WHERE userId = %s""", (user_id,)))[0])[0]["Name"] == "Adobe"
+    finally:
+        await insert_update_delete_request(delete_user(), ("sweep@duckpass.ch",))
+
+
+@pytest.mark.run(order=66)
+@pytest.mark.asyncio
+async def test_sweep_breaches_failure(database, monkeypatch):
+    """
+    Function to test that an account failing to be checked does not hold the sweep back
+    """
+
+    async def get_breach(email):
+        raise ValueError("Unexpected response")
+
+    monkeypatch.setattr("app.breaches.get_breach_for_user", get_breach)
+    monkeypatch.setattr("app.breaches.HIBP_REFRESH_PER_MINUTE", 60_000)
+    await insert_update_delete_request(insert_user(), ("failure@duckpass.ch", "hash", "key", "salt", "pbkdf2-sha256", 600000))
+    user_id = (await select_request(select_user(), ("failure@duckpass.ch",)))[0]
+    try:
+        await insert_update_delete_request(update_verification(), ("failure@duckpass.ch",))
+        await insert_update_delete_request(upsert_job_checkpoint(), ("breach_sweep", user_id - 1))
+        failures = breach_stats.sweep_failures
+
+        assert await sweep_breaches() == 0
+        assert breach_stats.sweep_failures == failures + 1
+        assert (await select_request(select_job_checkpoint(), ("breach_sweep",)))[0] == user_id
+    finally:
+        await insert_update_delete_request(delete_user(), ("failure@duckpass.ch",))
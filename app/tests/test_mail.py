@@ -0,0 +1,220 @@
+import pytest
+from aiosmtpd.controller import Controller
+from app.mail import *
+from app.templates.mailTemplate import SITE, CompiledTemplate, breach_mail, confirmation_mail, preferred_locale
+
+SINK_PORT = 8025
+
+
+class SinkHandler:
+    """
+    Local SMTP server keeping the received emails
+    """
+
+    def __init__(self):
+        self.recipients = []
+
+    async def handle_DATA(self, server, session, envelope):
+        self.recipients.extend(envelope.rcpt_tos)
+        return "250 OK"
+
+
+@pytest.fixture
+def smtp_sink():
+    """
+    Starts a local SMTP server for the test
+    """
+
+    handler = SinkHandler()
+    controller = Controller(handler, hostname="127.0.0.1", port=SINK_PORT)
+    controller.start()
+    yield handler
+    controller.stop()
+
+
+async def queue_email(recipient, mail_template):
+    """
+    Function to queue an email claimed right away by the test, the workers of a running API do not see it
+    :return: Claimed email
+    """
+
+    async with db_cursor() as cur:
+        await enqueue_email(cur, recipient, mail_template)
+        await cur.execute("""UPDATE duckpass."MailQueue" SET nextAttemptAt = CURRENT_TIMESTAMP + INTERVAL '1 hour' WHERE recipient = %s RETURNING mailId, recipient, subject, body, bodyText, attempts""", (recipient,))
+        return await cur.fetchall()
+
+
+@pytest.mark.run(order=47)
+@pytest.mark.asyncio
+async def test_smtp_connection_reused(smtp_sink):
+    """
+    Function to test that the emails are sent over a single SMTP connection
+    """
+
+    connection = SmtpConnection("127.0.0.1", SINK_PORT, False, False)
+    try:
+        await connection.send(mail_message("first@duckpass.ch", "Test", "<p>First</p>"))
+        await connection.send(mail_message("second@duckpass.ch", "Test", "<p>Second</p>"))
+    finally:
+        await connection.close()
+
+    assert smtp_sink.recipients == ["first@duckpass.ch", "second@duckpass.ch"]
+    assert connection.connections == 1
+
+
+@pytest.mark.run(order=48)
+@pytest.mark.asyncio
+async def test_mail_queue_sends_queued_email(database, smtp_sink):
+    """
+    Function to test that a queued email is sent by the queue and removed from it
+    """
+
+    queue = MailQueue(1)
+    connection = SmtpConnection("127.0.0.1", SINK_PORT, False, False)
+    rows = await queue_email("queued@duckpass.ch", lambda token: ("Test", f"<p>{token}</p>", token))
+    try:
+        await queue.send_batch(connection, rows)
+    finally:
+        await connection.close()
+
+    assert "queued@duckpass.ch" in smtp_sink.recipients
+    assert queue.stats()["sent"] == 1
+    assert await select_request("""SELECT 1 FROM duckpass."MailQueue" WHERE recipient = %s""", ("queued@duckpass.ch",)) is None
+
+
+@pytest.mark.run(order=49)
+@pytest.mark.asyncio
+async def test_mail_queue_retries_failed_email(database):
+    """
+    Function to test that an email failing to be sent is scheduled again later
+    """
+
+    queue = MailQueue(1)
+    connection = SmtpConnection("127.0.0.1", SINK_PORT, False, False)
+    rows = await queue_email("retried@duckpass.ch", lambda token: ("Test", "<p>Test</p>", "Test"))
+    try:
+        await queue.send_batch(connection, rows)
+
+        attempts, delay = await select_request("""SELECT attempts, EXTRACT(EPOCH FROM nextAttemptAt - CURRENT_TIMESTAMP) FROM duckpass."MailQueue" WHERE recipient = %s""", ("retried@duckpass.ch",))
+        assert attempts == 1
+        assert delay >= MAIL_BACKOFF - 1
+        assert queue.stats()["failures"] == 1
+    finally:
+        await insert_update_delete_request("""DELETE FROM duckpass."MailQueue" WHERE recipient = %s""", ("retried@duckpass.ch",))
+
+
+@pytest.mark.run(order=49)
+@pytest.mark.asyncio
+async def test_mail_queue_unexpected_error(database):
+    """
+    Function to test that an unexpected error is recorded for its email only, the other emails being sent
+    """
+
+    class FailingConnection:
+        async def send(self, message):
+            if message["To"] == "broken@duckpass.ch":
+                raise ValueError("Invalid message")
+
+    queue = MailQueue(1)
+    rows = await queue_email("broken@duckpass.ch", lambda token: ("Test", "<p>Test</p>", "Test"))
+    rows += await queue_email("working@duckpass.ch", lambda token: ("Test", "<p>Test</p>", "Test"))
+    try:
+        await queue.send_batch(FailingConnection(), rows)
+
+        assert await select_request("""SELECT attempts, lastError FROM duckpass."MailQueue" WHERE recipient = %s""", ("broken@duckpass.ch",)) == (1, "Invalid message")
+        assert await select_request("""SELECT 1 FROM duckpass."MailQueue" WHERE recipient = %s""", ("working@duckpass.ch",)) is None
+        assert queue.stats()["sent"] == 1 and queue.stats()["failures"] == 1
+
+        # Abandoned emails are kept for the retention period only
+        await insert_update_delete_request("""UPDATE duckpass."MailQueue" SET nextAttemptAt = NULL, createdAt = CURRENT_TIMESTAMP - INTERVAL '2 days' WHERE recipient = %s""", ("broken@duckpass.ch",))
+        await insert_update_delete_request(purge_abandoned_mails(), (3,))
+        assert await select_request("""SELECT 1 FROM duckpass."MailQueue" WHERE recipient = %s""", ("broken@duckpass.ch",)) is not None
+        await insert_update_delete_request(purge_abandoned_mails(), (1,))
+        assert await select_request("""SELECT 1 FROM duckpass."MailQueue" WHERE recipient = %s""", ("broken@duckpass.ch",)) is None
+    finally:
+        await insert_update_delete_request("""DELETE FROM duckpass."MailQueue" WHERE recipient = %s""", ("broken@duckpass.ch",))
+
+
+@pytest.mark.run(order=50)
+def test_compiled_template():
+    """
+    Function to test that the values known at load are rendered once and the others at each rendering
+    """
+
+    template = CompiledTemplate("<a href='http://{{ api }}/verify/?token={{token}}'>{{ api }}</a>", {"api": "api.duckpass.ch"})
+
+    assert template.render({"token": "abc"}) == "<a href='http://api.duckpass.ch/verify/?token=abc'>api.duckpass.ch</a>"
+    assert template.render({"token": "def"}) == "<a href='http://api.duckpass.ch/verify/?token=def'>api.duckpass.ch</a>"
+
+
+@pytest.mark.run(order=51)
+def test_localized_mail_with_text_alternative():
+    """
+    Function to test that an email is rendered in the requested language, with a plain text alternative
+    """
+
+    subject, html, text = confirmation_mail("abc", locale="fr")
+    assert subject == "Vérification de votre compte DuckPass"
+    assert "/verify/?token=abc" in html and "/verify/?token=abc" in text
+    assert "<" not in text
+
+    # Languages without templates fall back on English
+    assert confirmation_mail("abc", locale="de")[0] == "DuckPass Account Verification"
+
+    message = mail_message("test@duckpass.ch", subject, html, text)
+    assert [part.get_content_type() for part in message.iter_parts()] == ["text/plain", "text/html"]
+
+
+@pytest.mark.run(order=51)
+def test_breach_mail():
+    """
+    Function to test that the breach email lists the breaches, escaped in HTML, and links to the website
+    """
+
+    breach = {"Name": "<Adobe>", "Domain": "adobe.com", "BreachDate": "2013-10-04", "DataClasses": ["Passwords"]}
+    for locale in ("en", "fr"):
+        subject, html, text = breach_mail([breach], locale=locale)
+        assert "&lt;Adobe&gt;" in html and "- <Adobe> (adobe.com), 2013-10-04: Passwords" in text
+        assert f'href="https://{SITE or ""}/"' in html and f": https://{SITE or ''}/" in text
+
+
+@pytest.mark.run(order=52)
+def test_preferred_locale():
+    """
+    Function to test that the language of the emails is picked from the Accept-Language header
+    """
+
+    assert preferred_locale("fr-CH,fr;q=0.9,en;q=0.8") == "fr"
+    assert preferred_locale("de-CH,en;q=0.5,fr;q=0.7") == "fr"
+    assert preferred_locale("de") == "en"
+    assert preferred_locale(None) == "en"
+
+
+@pytest.mark.run(order=54)
+@pytest.mark.asyncio
+async def test_deduplicated_email(database, smtp_sink):
+    """
+    Function to test that an email is not queued again while the previous one is pending or sent during its window
+    """
+
+    queue = MailQueue(1)
+    connection = SmtpConnection("127.0.0.1", SINK_PORT, False, False)
+    template = lambda token: ("Test", "<p>Test</p>", "Test")
+    try:
+        async with db_cursor() as cur:
+            assert await enqueue_email(cur, "dedupe@duckpass.ch", template, "test:dedupe@duckpass.ch", 600)
+            await cur.execute("""UPDATE duckpass."MailQueue" SET nextAttemptAt = CURRENT_TIMESTAMP + INTERVAL '1 hour' WHERE recipient = %s RETURNING mailId, recipient, subject, body, bodyText, attempts""", ("dedupe@duckpass.ch",))
+            rows = await cur.fetchall()
+        async with db_cursor() as cur:
+            assert not await enqueue_email(cur, "dedupe@duckpass.ch", template, "test:dedupe@duckpass.ch", 600)
+
+        # The sent email is kept until the end of its window
+        await queue.send_batch(connection, rows)
+        assert smtp_sink.recipients == ["dedupe@duckpass.ch"]
+        async with db_cursor() as cur:
+            assert not await enqueue_email(cur, "dedupe@duckpass.ch", template, "test:dedupe@duckpass.ch", 600)
+            assert await enqueue_email(cur, "dedupe@duckpass.ch", template, "test:other@duckpass.ch", 600)
+            await cur.execute("""UPDATE duckpass."MailQueue" SET nextAttemptAt = NULL WHERE dedupeKey = %s""", ("test:other@duckpass.ch",))
+    finally:
+        await connection.close()
+        await insert_update_delete_request("""DELETE FROM duckpass."MailQueue" WHERE recipient = %s""", ("dedupe@duckpass.ch",))
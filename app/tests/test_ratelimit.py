@@ -0,0 +1,58 @@
+import asyncio
+import pytest
+from app.ratelimit import *
+
+
+@pytest.mark.run(order=33)
+def test_memory_bucket_burst():
+    """
+    Function to test that a bucket allows its capacity at once, then rejects with the time until the next token
+    """
+
+    backend = MemoryBackend()
+    results = [asyncio.run(backend.take("ip:127.0.0.1", 3, 1 / 60)) for _ in range(4)]
+
+    assert results[:3] == [0, 0, 0]
+    assert 0 < results[3] <= 60
+
+
+@pytest.mark.run(order=34)
+def test_memory_bucket_keys_are_independent():
+    """
+    Function to test that exhausting a bucket does not limit the other keys
+    """
+
+    backend = MemoryBackend()
+    asyncio.run(backend.take("email:ducky@duckpass.ch", 1, 1 / 60))
+
+    assert asyncio.run(backend.take("email:ducky@duckpass.ch", 1, 1 / 60)) > 0
+    assert asyncio.run(backend.take("email:test@duckpass.ch", 1, 1 / 60)) == 0
+
+
+@pytest.mark.run(order=34)
+def test_memory_bucket_purge(monkeypatch):
+    """
+    Function to test that the purge drops the full buckets of every kind, each with its own parameters
+    """
+
+    monkeypatch.setattr("app.ratelimit.RATE_LIMIT_PURGE_EVERY", 3)
+    backend = MemoryBackend()
+    asyncio.run(backend.take("ip:127.0.0.1", 10, 1e9))
+    asyncio.run(backend.take("email:ducky@duckpass.ch", 1, 1 / 60))
+    asyncio.run(backend.take("email:test@duckpass.ch", 1, 1 / 60))
+
+    # The refilled IP bucket is dropped, the emptied email buckets are kept
+    assert asyncio.run(backend.take("email:ducky@duckpass.ch", 1, 1 / 60)) > 0
+    assert "ip:127.0.0.1" not in backend._buckets
+    assert len(backend._buckets) == 2
+
+
+@pytest.mark.run(order=34)
+def test_bucket_keys():
+    """
+    Function to test that the long values are hashed to fit the bucket keys
+    """
+
+    assert bucket_key("email", "ducky@duckpass.ch") == "email:ducky@duckpass.ch"
+    key = bucket_key("email", "a" * 10_000 + "@duckpass.ch")
+    assert len(key) <= 320 and key == bucket_key("email", "a" * 10_000 + "@duckpass.ch")
@@ -0,0 +1,44 @@
+import pytest
+import time
+from app.revocation import *
+
+
+@pytest.mark.run(order=28)
+def test_revocation_index_not_ready():
+    """
+    Function to test that the revocation is checked in the database while the index is not loaded
+    """
+
+    index = RevocationIndex(16)
+    assert index.is_revoked("token") is None
+
+
+@pytest.mark.run(order=29)
+def test_revocation_index_lookup():
+    """
+    Function to test the lookup of revoked and valid tokens in the index
+    """
+
+    index = RevocationIndex(16)
+    index.ready = True
+    index.add(token_digest("revoked"), time.time() + 60)
+    index.add(token_digest("expired"), time.time() - 60)
+
+    assert index.is_revoked("revoked")
+    assert not index.is_revoked("expired")
+    assert not index.is_revoked("valid")
+
+
+@pytest.mark.run(order=30)
+def test_revocation_index_grows():
+    """
+    Function to test that the filter grows when more tokens than its capacity are revoked
+    """
+
+    index = RevocationIndex(4)
+    index.ready = True
+    for i in range(10):
+        index.on_notification(f"{token_digest(str(i)).hex()}:{time.time() + 60}")
+
+    assert all(index.is_revoked(str(i)) for i in range(10))
+    assert index.stats()["bloom_capacity"] >= 10
@@ -0,0 +1,66 @@
+import asyncio
+import pytest
+from app.cleanup import cleanup_unverified_users
+from app.database import *
+from app.scheduler import Job
+
+
+@pytest.mark.run(order=55)
+@pytest.mark.asyncio
+async def test_jobs_sharing_a_lock(database):
+    """
+    Function to test that a job is skipped while another job holding the same lock runs, or until its next run
+    """
+
+    started = asyncio.Event()
+    release = asyncio.Event()
+
+    async def long_job():
+        started.set()
+        await release.wait()
+
+    async def short_job():
+        return 5
+
+    await insert_update_delete_request("""DELETE FROM duckpass."JobSchedule" WHERE jobName = ANY(%s)""", (["first", "second"],))
+    first = Job("first", long_job, 60, "test_lock")
+    second = Job("second", short_job, 30, "test_lock")
+
+    running = asyncio.create_task(first.run_once())
+    await started.wait()
+    assert await second.run_once() == 30
+    assert second.stats()["skipped"] == 1
+
+    release.set()
+    assert await running == 60
+    assert await second.run_once() == 5
+    assert second.stats()["runs"] == 1
+
+    # The same job in another worker waits for the delay returned by the last run
+    other = Job("second", short_job, 30, "test_lock")
+    assert 0 < await other.run_once() <= 5
+    assert other.stats() == {"runs": 0, "skipped": 1, "failures": 0, "last_duration": 0.0}
+
+
+@pytest.mark.run(order=56)
+@pytest.mark.asyncio
+async def test_cleanup_unverified_users(database, monkeypatch):
+    """
+    Function to test that the old unverified accounts are deleted in batches and the other accounts are kept
+    """
+
+    monkeypatch.setattr("app.cleanup.CLEANUP_BATCH", 2)
+    monkeypatch.setattr("app.cleanup.CLEANUP_PAUSE", 0)
+    emails = [f"cleanup{i}@duckpass.ch" for i in range(6)]
+    for email in emails:
+        await insert_update_delete_request(insert_user(), (email, "hash", "key", "salt", "pbkdf2-sha256", 600000))
+    await insert_update_delete_request("""UPDATE duckpass."User" SET created_at = CURRENT_TIMESTAMP - INTERVAL '2 days' WHERE email = ANY(%s)""", (emails[:5],))
+    await insert_update_delete_request(update_verification(), (emails[4],))
+    try:
+        assert await cleanup_unverified_users() >= 4
+
+        remaining = await select_many_request("""SELECT email FROM duckpass."User" WHERE email = ANY(%s) ORDER BY email""", (emails,))
+        assert [email for email, in remaining] == emails[4:]
+    finally:
+        for email in emails:
+            await insert_update_delete_request(delete_user(), (email,))
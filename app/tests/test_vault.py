@@ -0,0 +1,204 @@
+import asyncio
+import json
+import pytest
+from app.database import *
+from app.events import VaultEventHub
+from app.model import UserIdentity, VaultItem, VaultItemsBatch
+from app.routers.vaultItems import get_vault_item_changes, reencrypt_vault_items
+from app.vault import *
+
+VAULT = "q83vEjRWeJA=|3q2+7w==|AAECAwQFBgcICQoLDA0ODw=="
+
+
+@pytest.mark.run(order=57)
+def test_vault_formats(monkeypatch):
+    """
+    Function to test that the vaults are stored in binary when they round-trip and in text otherwise
+    """
+
+    # Until every worker reads binary, the vaults are written as text
+    monkeypatch.setattr("app.vault.VAULT_BINARY_WRITES", False)
+    assert encode_vault(VAULT) == (VAULT.encode("utf-8"), VAULT_FORMAT_TEXT)
+    assert encode_vault(None) == (None, VAULT_FORMAT_TEXT)
+    assert encode_vault(VAULT, binary=True)[1] == VAULT_FORMAT_BINARY
+
+    monkeypatch.setattr("app.vault.VAULT_BINARY_WRITES", True)
+    data, vault_format = encode_vault(VAULT)
+    assert vault_format == VAULT_FORMAT_BINARY
+    assert len(data) < len(VAULT)
+    assert decode_vault(data, vault_format) == VAULT
+
+    # Not canonical base64, kept as sent by the client
+    for vault in ("not a vault", "q83vEjRWeJA|3q2+7w==", "é|3q2+7w=="):
+        data, vault_format = encode_vault(vault)
+        assert vault_format == VAULT_FORMAT_TEXT
+        assert decode_vault(data, vault_format) == vault
+
+    assert encode_vault(None) == (None, VAULT_FORMAT_BINARY)
+    assert decode_vault(None, VAULT_FORMAT_TEXT) is None
+    assert decode_vault(VAULT.encode("utf-8"), VAULT_FORMAT_TEXT) == VAULT
+
+
+@pytest.mark.run(order=58)
+@pytest.mark.asyncio
+async def test_migrate_vaults(database, monkeypatch):
+    """
+    Function to test that the text vaults are converted to binary in batches and still read the same
+    """
+
+    monkeypatch.setattr("app.vault.VAULT_MIGRATION_BATCH", 2)
+    monkeypatch.setattr("app.vault.VAULT_BINARY_WRITES", True)
+    emails = [f"vault{i}@duckpass.ch" for i in range(3)]
+    vaults = [VAULT, "not a vault", VAULT]
+    await insert_update_delete_request(upsert_job_checkpoint(), (VAULT_MIGRATION_JOB, 0))
+    for email, vault in zip(emails, vaults):
+        await insert_update_delete_request(insert_user(), (email, "hash", "key", "salt", "pbkdf2-sha256", 600000))
+        await insert_update_delete_request(vault_update(), (vault.encode("utf-8"), VAULT_FORMAT_TEXT, vault_hash(vault), email, None, None))
+    try:
+        while await migrate_vaults() is not None:
+            pass
+
+        rows = await select_many_request("""SELECT vault, vaultFormat FROM duckpass."User" WHERE email = ANY(%s) ORDER BY userId""", (emails,))
+        assert [vault_format for _, vault_format in rows] == [VAULT_FORMAT_BINARY, VAULT_FORMAT_TEXT, VAULT_FORMAT_BINARY]
+        assert [decode_vault(vault, vault_format) for vault, vault_format in rows] == vaults
+    finally:
+        for email in emails:
+            await insert_update_delete_request(delete_user(), (email,))
+
+
+@pytest.mark.run(order=59)
+def test_vault_etags():
+    """
+    Function to test that the revisions are read from the ETags sent by the clients
+    """
+
+    etag = vault_etag(12, vault_hash(VAULT))
+    assert etag.startswith('"12-') and etag.endswith('"')
+    assert vault_etag(3, None) == '"3"'
+
+    assert etag_revisions(f'{etag}, W/"7", "x"') == [12, 7]
+
+    # The ETags of the data sent without the vault only match this representation
+    meta = vault_etag(12, vault_hash(VAULT), with_vault=False)
+    assert meta.endswith('-meta"')
+    assert etag_revisions(meta) == []
+    assert etag_revisions(f'{meta}, "7"', with_vault=False) == [12]
+
+    # The two-factor authentication is only compared for the user's data, the updates of the vault ignore it
+    two_factor = vault_etag(12, vault_hash(VAULT), two_factor=True)
+    assert two_factor != etag and etag_revisions(two_factor) == [12]
+    assert etag_revisions(two_factor, two_factor=False) == [] and etag_revisions(etag, two_factor=False) == [12]
+    assert etag_revisions(vault_etag(12, None, False, True), False, True) == [12]
+    assert etag_revisions("*") is None
+    assert etag_revisions(None) is None
+    assert etag_revisions("") == []
+
+
+@pytest.mark.run(order=60)
+@pytest.mark.asyncio
+async def test_vault_event_hub():
+    """
+    Function to test that the vault changes are sent to the subscribers of the user only, the oldest events dropped
+    """
+
+    hub = VaultEventHub(2)
+    first, second, other = hub.subscribe(1), hub.subscribe(1), hub.subscribe(2)
+
+    for revision in range(3):
+        hub.on_notification(json.dumps({"user": 1, "type": "items", "revision": revision}))
+    assert [first.get_nowait()["revision"] for _ in range(first.qsize())] == [1, 2]
+    assert second.qsize() == 2 and other.empty()
+    assert hub.stats()["dropped"] == 2
+
+    hub.unsubscribe(1, first)
+    hub.unsubscribe(1, second)
+    await hub.on_connect()
+    assert other.get_nowait() == {"type": "resync"}
+    assert hub.stats()["users"] == 1
+
+
+@pytest.mark.run(order=60)
+def test_vault_event_hub_revocation():
+    """
+    Function to test that the streams opened with a revoked token are ended, the other streams of the user kept
+    """
+
+    hub = VaultEventHub(2)
+    old, revoked, current = hub.subscribe(1, b"old", 0), hub.subscribe(1, b"revoked", 1), hub.subscribe(1, b"current", 1)
+
+    hub.on_token_revoked(b"revoked")
+    assert revoked.get_nowait() is None and old.empty() and current.empty()
+
+    hub.on_notification(json.dumps({"user": 1, "type": "revoked", "version": 1}))
+    assert old.get_nowait() is None and current.empty()
+    assert hub.stats()["closed"] == 2
+
+    for queue, digest in ((old, b"old"), (revoked, b"revoked"), (current, b"current")):
+        hub.unsubscribe(1, queue)
+        hub.on_token_revoked(digest)
+    assert current.empty() and hub.stats()["subscribers"] == 0
+
+
+@pytest.mark.run(order=65)
+@pytest.mark.asyncio
+async def test_two_factor_keeps_vault_revision(database):
+    """
+    Function to test that a change of the two-factor authentication changes the ETag of the user's data, not its revision
+    """
+
+    email = "revision@duckpass.ch"
+    await insert_update_delete_request(insert_user(), (email, "hash", "key", "salt", "pbkdf2-sha256", 600000))
+    try:
+        revision, = await select_request("""SELECT vaultRevision FROM duckpass."User" WHERE email = %s""", (email,))
+        await insert_update_delete_request(update_two_factor_auth(), ("secret", True, email))
+        assert await select_request("""SELECT vaultRevision FROM duckpass."User" WHERE email = %s""", (email,)) == (revision,)
+    finally:
+        await insert_update_delete_request(delete_user(), (email,))
+
+
+@pytest.mark.run(order=67)
+@pytest.mark.asyncio
+async def test_purge_tombstones(database):
+    """
+    Function to test that the old tombstones are purged and their last revision kept for the clients synced before
+    """
+
+    email = "tombstone@duckpass.ch"
+    await insert_update_delete_request(insert_user(), (email, "hash", "key", "salt", "pbkdf2-sha256", 600000))
+    user_id, = await select_request("""SELECT userId FROM duckpass."User" WHERE email = %s""", (email,))
+    try:
+        await insert_update_delete_request("""INSERT INTO duckpass."VaultItem" (userId, itemId, revision, deleted, updatedAt) VALUES (%s, 'old', 3, TRUE, CURRENT_TIMESTAMP - make_interval(days => %s)), (%s, 'recent', 4, TRUE, CURRENT_TIMESTAMP)""", (user_id, VAULT_TOMBSTONE_RETENTION + 1, user_id))
+
+        assert await purge_tombstones() >= 1
+        assert await select_many_request("""SELECT itemId FROM duckpass."VaultItem" WHERE userId = %s""", (user_id,)) == [("recent",)]
+        assert await select_request(select_items_revision(), (user_id,)) == (0, 3)
+    finally:
+        await insert_update_delete_request(delete_user(), (email,))
+
+
+@pytest.mark.run(order=67)
+@pytest.mark.asyncio
+async def test_vault_item_pages(database, monkeypatch):
+    """
+    Function to test that the items re-encrypted under a single revision are synced in several pages
+    """
+
+    monkeypatch.setattr("app.routers.vaultItems.VAULT_ITEMS_PAGE", 2)
+    email = "pages@duckpass.ch"
+    await insert_update_delete_request(insert_user(), (email, "hash", "key", "salt", "pbkdf2-sha256", 600000))
+    user_id, = await select_request("""SELECT userId FROM duckpass."User" WHERE email = %s""", (email,))
+    identity = UserIdentity(id=user_id, email=email, has_two_factor_auth=False, verified=True, token_version=0)
+    batch = VaultItemsBatch(items=[VaultItem(id=f"item-{i}", data=VAULT) for i in range(5)])
+    try:
+        async with db_cursor() as cur:
+            await reencrypt_vault_items(cur, user_id, batch)
+
+        ids, since, after, more = [], 0, None, True
+        while more:
+            changes = await get_vault_item_changes(identity, since, after)
+            ids += [item.id for item in changes.items]
+            since, after, more = changes.revision, changes.after, changes.more
+        assert ids == [item.id for item in batch.items]
+        assert changes.after is None and (await get_vault_item_changes(identity, since)).items == []
+    finally:
+        await insert_update_delete_request(delete_user(), (email,))
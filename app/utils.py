@@ -12,6 +12,16 @@ def is_valid_email(email):
         return False
 
 
+def is_valid_hash_prefix(hash_begin):
+    """
+    Check the given string is the 5 hexadecimal characters prefix of a SHA-1 hash
+    :param str hash_begin: Prefix to check
+    :return: True if the prefix is valid, False otherwise
+    """
+
+    return re.fullmatch(r'[0-9A-Fa-f]{5}', hash_begin) is not None
+
+
 def bytea_to_text(value):
     """
     Convert bytea PostgreSQL type to text
@@ -0,0 +1,247 @@
+import asyncio
+import binascii
+import hashlib
+import os
+import struct
+from base64 import b64decode, b64encode
+from typing import Optional
+from .database import *
+from .metrics import register_metrics
+from .scheduler import scheduler
+
+VAULT_FORMAT_TEXT = 0  # Vault sent by the client, encoded in UTF-8
+VAULT_FORMAT_BINARY = 1  # Base64 parts of the vault decoded, each prefixed with its length
+VAULT_BINARY_WRITES = os.environ.get('VAULT_BINARY_WRITES', 'false').lower() == 'true'  # Once every worker reads binary
+VAULT_MIGRATION_BATCH = int(os.environ.get('VAULT_MIGRATION_BATCH', 100))  # Vaults converted per transaction
+VAULT_MIGRATION_PAUSE = float(os.environ.get('VAULT_MIGRATION_PAUSE', 0.5))  # Seconds between two batches
+VAULT_MIGRATION_INTERVAL = 3600  # Seconds between two checks once every vault was converted
+VAULT_MIGRATION_JOB = "vault_migration"  # Name of the checkpoint of the migration
+VAULT_TOMBSTONE_RETENTION = int(os.environ.get('VAULT_TOMBSTONE_RETENTION', 90))  # Days the deleted items are kept
+VAULT_TOMBSTONE_PURGE_INTERVAL = 3600  # Seconds between two purges of the old tombstones
+VAULT_TOMBSTONE_PURGE_BATCH = 1000  # Tombstones deleted per batch
+PART_LENGTH = struct.Struct(">I")
+META_ETAG_SUFFIX = "meta"  # Suffix of the ETags of the user's data sent without the vault
+TWO_FACTOR_ETAG_PART = "2fa"  # Part of the ETags of the users having enabled the two-factor authentication
+
+
+def _encode_binary(vault: str) -> Optional[bytes]:
+    """
+    Decode the base64 parts of a vault ("iv|ciphertext|mac")
+    :param str vault: Vault sent by the client
+    :return: Binary vault, None if a part is not canonical base64
+    """
+
+    encoded = bytearray()
+    for part in vault.split("|"):
+        try:
+            data = b64decode(part, validate=True)
+        except (binascii.Error, ValueError):
+            return None
+        # Only the vaults sent back exactly as received are stored in binary
+        if b64encode(data).decode() != part:
+            return None
+        encoded += PART_LENGTH.pack(len(data))
+        encoded += data
+    return bytes(encoded)
+
+
+def _decode_binary(data: bytes) -> str:
+    """
+    Encode the parts of a binary vault in base64
+    :param bytes data: Binary vault
+    :return: Vault as sent by the client
+    """
+
+    parts = []
+    offset = 0
+    view = memoryview(data)
+    while offset < len(data):
+        length, = PART_LENGTH.unpack_from(view, offset)
+        offset += PART_LENGTH.size
+        parts.append(b64encode(view[offset:offset + length]).decode())
+        offset += length
+    return "|".join(parts)
+
+
+def encode_vault(vault: Optional[str], binary: Optional[bool] = None) -> tuple[Optional[bytes], int]:
+    """
+    Encode a vault for the database, in binary when it round-trips exactly, in UTF-8 otherwise
+    Binary is only written with VAULT_BINARY_WRITES, the workers of the previous release read the vaults as text
+    :param str vault: Vault sent by the client
+    :param bool binary: Whether binary may be written, VAULT_BINARY_WRITES if None
+    :return: Stored vault and its format
+    """
+
+    if binary is None:
+        binary = VAULT_BINARY_WRITES
+    if not binary:
+        return (vault.encode("utf-8") if vault else None), VAULT_FORMAT_TEXT
+    if not vault:
+        return None, VAULT_FORMAT_BINARY
+    data = _encode_binary(vault)
+    if data is None:
+        return vault.encode("utf-8"), VAULT_FORMAT_TEXT
+    return data, VAULT_FORMAT_BINARY
+
+
+def decode_vault(data: Optional[bytes], vault_format: int) -> Optional[str]:
+    """
+    Decode a vault stored in the database
+    :param bytes data: Stored vault
+    :param int vault_format: Format of the stored vault
+    :return: Vault as sent by the client
+    """
+
+    if data is None:
+        return None
+    if vault_format == VAULT_FORMAT_BINARY:
+        return _decode_binary(data)
+    return bytes(data).decode("utf-8")
+
+
+def vault_hash(vault: Optional[str]) -> Optional[bytes]:
+    """
+    Hash of a vault as sent by the client, unchanged when its storage format changes
+    :param str vault: Vault sent by the client
+    :return: SHA-256 of the vault, None if there is no vault
+    """
+
+    return hashlib.sha256(vault.encode("utf-8")).digest() if vault else None
+
+
+def vault_etag(revision: int, content_hash: Optional[bytes], with_vault: bool = True, two_factor: bool = False) -> str:
+    """
+    ETag of a vault, made of its revision and the beginning of its hash
+    The user's data sent without the vault is another representation, its ETag ends with META_ETAG_SUFFIX
+    The two-factor authentication is part of the user's data but not of the vault, it is marked in the ETag without
+    changing the revision, so the ETags held by the clients still match the vault for their updates
+    :param int revision: Revision of the vault, increased by each update of the vault or of the user's key
+    :param bytes content_hash: Hash of the vault
+    :param bool with_vault: False for the ETag of the user's data sent without the vault
+    :param bool two_factor: True if the user enabled the two-factor authentication
+    :return: ETag, with its quotes
+    """
+
+    parts = [str(revision)]
+    if content_hash is not None:
+        parts.append(content_hash[:8].hex())
+    if two_factor:
+        parts.append(TWO_FACTOR_ETAG_PART)
+    if not with_vault:
+        parts.append(META_ETAG_SUFFIX)
+    return f'"{"-".join(parts)}"'
+
+
+def etag_revisions(header: Optional[str], with_vault: bool = True, two_factor: Optional[bool] = None) -> Optional[list[int]]:
+    """
+    Revisions of the vault ETags of an If-Match or If-None-Match header
+    The revisions identify the vaults of a user, the hash of the ETags is not needed to compare them, but the ETags
+    of the other representation are ignored
+    :param str header: Value of the header
+    :param bool with_vault: False to read the ETags of the user's data sent without the vault
+    :param bool two_factor: Two-factor authentication of the user, the ETags marked otherwise are ignored, None to read
+    the ETags whatever their mark
+    :return: Revisions, None if the header is missing or "*", which match any vault
+    """
+
+    if header is None or header.strip() == "*":
+        return None
+    revisions = []
+    for etag in header.split(","):
+        parts = etag.strip().removeprefix("W/").strip('"').split("-")
+        if (parts[-1] == META_ETAG_SUFFIX) == with_vault:
+            continue
+        if two_factor is not None and (TWO_FACTOR_ETAG_PART in parts) != two_factor:
+            continue
+        if parts[0].isdigit():
+            revisions.append(int(parts[0]))
+    return revisions
+
+
+class VaultMigrationStats:
+    """
+    Counters of the conversion of the text vaults to binary
+    """
+
+    def __init__(self):
+        self.converted = 0
+        self.kept = 0
+
+    def stats(self) -> dict:
+        """
+        Counters of the migration
+        :return: Vaults converted, and kept in text because they do not round-trip
+        """
+
+        return {
+            "converted": self.converted,
+            "kept": self.kept,
+        }
+
+
+migration_stats = VaultMigrationStats()
+register_metrics("vault_migration", migration_stats.stats)
+
+
+async def migrate_vaults() -> Optional[float]:
+    """
+    Convert the next batch of text vaults to binary, resuming after the last user of the checkpoint
+    A vault updated meanwhile is not overwritten, it was written in the new format. Nothing is converted until
+    VAULT_BINARY_WRITES is enabled, once every worker runs the binary read path.
+    :return: Seconds before the next batch, None once every vault was converted
+    """
+
+    if not VAULT_BINARY_WRITES:
+        return None
+
+    checkpoint = await select_request(select_job_checkpoint(), (VAULT_MIGRATION_JOB,))
+    last_id = checkpoint[0] if checkpoint else 0
+
+    rows = await select_many_request(select_text_vaults(), (VAULT_FORMAT_TEXT, last_id, VAULT_MIGRATION_BATCH))
+    if not rows:
+        return None
+
+    updates = []
+    for user_id, vault in rows:
+        data, vault_format = encode_vault(decode_vault(vault, VAULT_FORMAT_TEXT))
+        if vault_format == VAULT_FORMAT_BINARY:
+            updates.append((data, VAULT_FORMAT_BINARY, user_id, VAULT_FORMAT_TEXT, vault))
+        else:
+            migration_stats.kept += 1
+
+    async with db_cursor() as cur:
+        if updates:
+            await cur.executemany(convert_vault(), updates)
+        await cur.execute(upsert_job_checkpoint(), (VAULT_MIGRATION_JOB, rows[-1][0]))
+    migration_stats.converted += len(updates)
+    return VAULT_MIGRATION_PAUSE
+
+
+async def purge_tombstones() -> int:
+    """
+    Delete the tombstones of the vault items older than the retention period in batches, so no statement holds
+    locks for long
+    :return: Number of deleted tombstones
+    """
+
+    deleted = 0
+    while True:
+        count, = await select_request(purge_vault_item_tombstones(), (VAULT_TOMBSTONE_RETENTION, VAULT_TOMBSTONE_PURGE_BATCH))
+        deleted += count
+        if count < VAULT_TOMBSTONE_PURGE_BATCH:
+            break
+        await asyncio.sleep(0)
+    return deleted
+
+
+async def purge_tombstones_job():
+    """
+    Scheduled job purging the old tombstones of the vault items
+    :return: None
+    """
+
+    await purge_tombstones()
+
+
+scheduler.add("vault_migration", migrate_vaults, VAULT_MIGRATION_INTERVAL)
+scheduler.add("vault_tombstone_purge", purge_tombstones_job, VAULT_TOMBSTONE_PURGE_INTERVAL)
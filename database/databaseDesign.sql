@@ -16,12 +16,121 @@
     verified BOOLEAN DEFAULT FALSE,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     vault bytea,
+    tokenVersion INTEGER NOT NULL DEFAULT 0,
+    kdfAlgorithm VARCHAR(32) NOT NULL DEFAULT 'pbkdf2-sha256',
+    kdfIterations INTEGER NOT NULL DEFAULT 600000,
+    vaultFormat SMALLINT NOT NULL DEFAULT 0,
+    vaultRevision BIGINT NOT NULL DEFAULT 0,
+    vaultHash BYTEA,
+    itemsRevision BIGINT NOT NULL DEFAULT 0,
+    itemsPurgedRevision BIGINT NOT NULL DEFAULT 0,
     PRIMARY KEY (userId)
  );
+ CREATE INDEX user_unverified_created_at ON "User" (created_at) WHERE verified = FALSE;
 
 DROP TABLE IF EXISTS "RevokedToken" CASCADE;
  CREATE TABLE "RevokedToken"
  (
-    token VARCHAR(2048) UNIQUE,
-    PRIMARY KEY (token)
+    tokenDigest BYTEA NOT NULL,
+    expiresAt TIMESTAMPTZ NOT NULL,
+    PRIMARY KEY (tokenDigest)
  );
+ CREATE INDEX revoked_token_expires_at ON "RevokedToken" (expiresAt);
+
+DROP TABLE IF EXISTS "RefreshToken" CASCADE;
+ CREATE TABLE "RefreshToken"
+ (
+    tokenHash BYTEA NOT NULL,
+    userId INTEGER NOT NULL REFERENCES "User" (userId) ON DELETE CASCADE,
+    familyId UUID NOT NULL,
+    tokenVersion INTEGER NOT NULL,
+    used BOOLEAN NOT NULL DEFAULT FALSE,
+    expiresAt TIMESTAMPTZ NOT NULL,
+    PRIMARY KEY (tokenHash)
+ );
+ CREATE INDEX refresh_token_family ON "RefreshToken" (familyId);
+ CREATE INDEX refresh_token_expires_at ON "RefreshToken" (expiresAt);
+
+DROP TABLE IF EXISTS "RateLimitBucket" CASCADE;
+ CREATE UNLOGGED TABLE "RateLimitBucket"
+ (
+    bucketKey VARCHAR(320) NOT NULL,
+    tokens DOUBLE PRECISION NOT NULL,
+    allowed BOOLEAN NOT NULL,
+    updatedAt TIMESTAMPTZ NOT NULL,
+    PRIMARY KEY (bucketKey)
+ );
+ CREATE INDEX rate_limit_bucket_updated_at ON "RateLimitBucket" (updatedAt);
+
+DROP TABLE IF EXISTS "HibpRangeCache" CASCADE;
+ CREATE UNLOGGED TABLE "HibpRangeCache"
+ (
+    prefix CHAR(5) NOT NULL,
+    body TEXT NOT NULL,
+    fetchedAt TIMESTAMPTZ NOT NULL,
+    PRIMARY KEY (prefix)
+ );
+ CREATE INDEX hibp_range_cache_fetched_at ON "HibpRangeCache" (fetchedAt);
+
+DROP TABLE IF EXISTS "BreachCache" CASCADE;
+ CREATE TABLE "BreachCache"
+ (
+    userId INTEGER NOT NULL REFERENCES "User" (userId) ON DELETE CASCADE,
+    breaches JSONB NOT NULL,
+    fetchedAt TIMESTAMPTZ NOT NULL,
+    notifiedBreaches JSONB,
+    PRIMARY KEY (userId)
+ );
+ CREATE INDEX breach_cache_fetched_at ON "BreachCache" (fetchedAt);
+
+DROP TABLE IF EXISTS "JobCheckpoint" CASCADE;
+ CREATE TABLE "JobCheckpoint"
+ (
+    jobName VARCHAR(64) NOT NULL,
+    lastId INTEGER NOT NULL,
+    updatedAt TIMESTAMPTZ NOT NULL,
+    PRIMARY KEY (jobName)
+ );
+
+DROP TABLE IF EXISTS "JobSchedule" CASCADE;
+ CREATE TABLE "JobSchedule"
+ (
+    jobName VARCHAR(64) NOT NULL,
+    nextRunAt TIMESTAMPTZ NOT NULL,
+    PRIMARY KEY (jobName)
+ );
+
+DROP TABLE IF EXISTS "MailQueue" CASCADE;
+ CREATE TABLE "MailQueue"
+ (
+    mailId BIGSERIAL,
+    recipient VARCHAR(256) NOT NULL,
+    subject TEXT NOT NULL,
+    body TEXT NOT NULL,
+    bodyText TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    nextAttemptAt TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+    lastError TEXT,
+    createdAt TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    dedupeKey VARCHAR(320),
+    dedupeUntil TIMESTAMPTZ,
+    sentAt TIMESTAMPTZ,
+    PRIMARY KEY (mailId)
+ );
+ CREATE INDEX mail_queue_next_attempt_at ON "MailQueue" (nextAttemptAt) WHERE nextAttemptAt IS NOT NULL;
+ CREATE INDEX mail_queue_dedupe_key ON "MailQueue" (dedupeKey) WHERE dedupeKey IS NOT NULL;
+
+DROP TABLE IF EXISTS "VaultItem" CASCADE;
+ CREATE TABLE "VaultItem"
+ (
+    userId INTEGER NOT NULL REFERENCES "User" (userId) ON DELETE CASCADE,
+    itemId VARCHAR(64) NOT NULL,
+    data BYTEA,
+    itemFormat SMALLINT NOT NULL DEFAULT 1,
+    revision BIGINT NOT NULL,
+    deleted BOOLEAN NOT NULL DEFAULT FALSE,
+    updatedAt TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (userId, itemId)
+ );
+ CREATE INDEX vault_item_revision ON "VaultItem" (userId, revision, itemId);
+ CREATE INDEX vault_item_tombstone ON "VaultItem" (updatedAt) WHERE deleted;
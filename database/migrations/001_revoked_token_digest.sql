@@ -0,0 +1,34 @@
+-- Store the SHA-256 digest of the revoked tokens with their expiration instead of the full token
+SET SEARCH_PATH TO duckpass;
+
+ALTER TABLE "RevokedToken" RENAME TO "RevokedTokenOld";
+
+CREATE TABLE "RevokedToken"
+(
+   tokenDigest BYTEA NOT NULL,
+   expiresAt TIMESTAMPTZ NOT NULL,
+   PRIMARY KEY (tokenDigest)
+);
+CREATE INDEX revoked_token_expires_at ON "RevokedToken" (expiresAt);
+
+-- The expiration of the old tokens is read from their "exp" claim, NULL if the token cannot be decoded
+CREATE FUNCTION pg_temp.token_expiration(token TEXT) RETURNS TIMESTAMPTZ AS $$
+DECLARE
+   payload TEXT := translate(split_part(token, '.', 2), '-_', '+/');
+BEGIN
+   RETURN to_timestamp((convert_from(decode(rpad(payload, (length(payload) + 3) / 4 * 4, '='), 'base64'), 'UTF8')::json->>'exp')::DOUBLE PRECISION);
+EXCEPTION WHEN OTHERS THEN
+   RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+-- The tokens already expired are rejected anyway and not kept
+-- Manual parameter: the tokens without a readable expiration are kept for an interval that must be longer than
+-- ACCESS_TOKEN_EXPIRE_MINUTES, adjust it if the access tokens live longer than a day
+INSERT INTO "RevokedToken" (tokenDigest, expiresAt)
+SELECT sha256(convert_to(token, 'UTF8')), COALESCE(pg_temp.token_expiration(token), CURRENT_TIMESTAMP + INTERVAL '1 day')
+FROM "RevokedTokenOld"
+WHERE COALESCE(pg_temp.token_expiration(token), CURRENT_TIMESTAMP + INTERVAL '1 day') > CURRENT_TIMESTAMP
+ON CONFLICT DO NOTHING;
+
+DROP TABLE "RevokedTokenOld";
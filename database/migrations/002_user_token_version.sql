@@ -0,0 +1,4 @@
+-- Version of the user's tokens, incremented to revoke all the sessions of the user
+SET SEARCH_PATH TO duckpass;
+
+ALTER TABLE "User" ADD COLUMN tokenVersion INTEGER NOT NULL DEFAULT 0;
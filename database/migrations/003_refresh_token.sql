@@ -0,0 +1,15 @@
+-- Refresh tokens, stored hashed, rotated at each use
+SET SEARCH_PATH TO duckpass;
+
+CREATE TABLE "RefreshToken"
+(
+   tokenHash BYTEA NOT NULL,
+   userId INTEGER NOT NULL REFERENCES "User" (userId) ON DELETE CASCADE,
+   familyId UUID NOT NULL,
+   tokenVersion INTEGER NOT NULL,
+   used BOOLEAN NOT NULL DEFAULT FALSE,
+   expiresAt TIMESTAMPTZ NOT NULL,
+   PRIMARY KEY (tokenHash)
+);
+CREATE INDEX refresh_token_family ON "RefreshToken" (familyId);
+CREATE INDEX refresh_token_expires_at ON "RefreshToken" (expiresAt);
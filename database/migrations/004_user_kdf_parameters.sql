@@ -0,0 +1,5 @@
+-- Parameters of the key derivation that produced each user's master key hash
+SET SEARCH_PATH TO duckpass;
+
+ALTER TABLE "User" ADD COLUMN kdfAlgorithm VARCHAR(32) NOT NULL DEFAULT 'pbkdf2-sha256';
+ALTER TABLE "User" ADD COLUMN kdfIterations INTEGER NOT NULL DEFAULT 600000;
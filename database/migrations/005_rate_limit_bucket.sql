@@ -0,0 +1,12 @@
+-- Token buckets of the rate limiter shared by the workers, losing them on a crash is harmless
+SET SEARCH_PATH TO duckpass;
+
+CREATE UNLOGGED TABLE "RateLimitBucket"
+(
+   bucketKey VARCHAR(320) NOT NULL,
+   tokens DOUBLE PRECISION NOT NULL,
+   allowed BOOLEAN NOT NULL,
+   updatedAt TIMESTAMPTZ NOT NULL,
+   PRIMARY KEY (bucketKey)
+);
+CREATE INDEX rate_limit_bucket_updated_at ON "RateLimitBucket" (updatedAt);
@@ -0,0 +1,11 @@
+-- Pwned Passwords range responses shared by the workers, losing them on a crash is harmless
+SET SEARCH_PATH TO duckpass;
+
+CREATE UNLOGGED TABLE "HibpRangeCache"
+(
+   prefix CHAR(5) NOT NULL,
+   body TEXT NOT NULL,
+   fetchedAt TIMESTAMPTZ NOT NULL,
+   PRIMARY KEY (prefix)
+);
+CREATE INDEX hibp_range_cache_fetched_at ON "HibpRangeCache" (fetchedAt);
@@ -0,0 +1,11 @@
+-- Breaches of each account, served to the clients and refreshed in the background
+SET SEARCH_PATH TO duckpass;
+
+CREATE TABLE "BreachCache"
+(
+   userId INTEGER NOT NULL REFERENCES "User" (userId) ON DELETE CASCADE,
+   breaches JSONB NOT NULL,
+   fetchedAt TIMESTAMPTZ NOT NULL,
+   PRIMARY KEY (userId)
+);
+CREATE INDEX breach_cache_fetched_at ON "BreachCache" (fetchedAt);
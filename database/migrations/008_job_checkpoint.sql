@@ -0,0 +1,10 @@
+-- Progress of the background jobs walking the users, to resume them after a restart
+SET SEARCH_PATH TO duckpass;
+
+CREATE TABLE "JobCheckpoint"
+(
+   jobName VARCHAR(64) NOT NULL,
+   lastId INTEGER NOT NULL,
+   updatedAt TIMESTAMPTZ NOT NULL,
+   PRIMARY KEY (jobName)
+);
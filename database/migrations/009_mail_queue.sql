@@ -0,0 +1,16 @@
+-- Emails waiting to be sent by the workers, abandoned emails have no next attempt
+SET SEARCH_PATH TO duckpass;
+
+CREATE TABLE "MailQueue"
+(
+   mailId BIGSERIAL,
+   recipient VARCHAR(256) NOT NULL,
+   subject TEXT NOT NULL,
+   body TEXT NOT NULL,
+   attempts INTEGER NOT NULL DEFAULT 0,
+   nextAttemptAt TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+   lastError TEXT,
+   createdAt TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+   PRIMARY KEY (mailId)
+);
+CREATE INDEX mail_queue_next_attempt_at ON "MailQueue" (nextAttemptAt) WHERE nextAttemptAt IS NOT NULL;
@@ -0,0 +1,4 @@
+-- Plain text alternative of the queued emails
+SET SEARCH_PATH TO duckpass;
+
+ALTER TABLE "MailQueue" ADD COLUMN bodyText TEXT;
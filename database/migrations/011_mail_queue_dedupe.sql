@@ -0,0 +1,7 @@
+-- Emails deduplicated by key, the sent ones are kept until the end of their deduplication window
+SET SEARCH_PATH TO duckpass;
+
+ALTER TABLE "MailQueue" ADD COLUMN dedupeKey VARCHAR(320);
+ALTER TABLE "MailQueue" ADD COLUMN dedupeUntil TIMESTAMPTZ;
+ALTER TABLE "MailQueue" ADD COLUMN sentAt TIMESTAMPTZ;
+CREATE INDEX mail_queue_dedupe_key ON "MailQueue" (dedupeKey) WHERE dedupeKey IS NOT NULL;
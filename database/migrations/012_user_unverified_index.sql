@@ -0,0 +1,5 @@
+-- Unverified accounts by creation date, each batch of the cleanup is an index scan
+-- Built without blocking the writes, run it outside of a transaction
+SET SEARCH_PATH TO duckpass;
+
+CREATE INDEX CONCURRENTLY user_unverified_created_at ON "User" (created_at) WHERE verified = FALSE;
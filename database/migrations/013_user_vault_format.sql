@@ -0,0 +1,5 @@
+-- Format of the stored vaults, in text until VAULT_BINARY_WRITES is enabled and the migration job converts them
+-- The default stays text, the workers of the previous release insert users without the format
+SET SEARCH_PATH TO duckpass;
+
+ALTER TABLE "User" ADD COLUMN vaultFormat SMALLINT NOT NULL DEFAULT 0;
@@ -0,0 +1,5 @@
+-- Revision and hash of the vaults, sent to the clients as an ETag
+SET SEARCH_PATH TO duckpass;
+
+ALTER TABLE "User" ADD COLUMN vaultRevision BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE "User" ADD COLUMN vaultHash BYTEA;
@@ -0,0 +1,16 @@
+-- Items of the vaults stored one by one, with the revision of their last change and tombstones for the deleted ones
+SET SEARCH_PATH TO duckpass;
+
+ALTER TABLE "User" ADD COLUMN itemsRevision BIGINT NOT NULL DEFAULT 0;
+
+CREATE TABLE "VaultItem"
+(
+   userId INTEGER NOT NULL REFERENCES "User" (userId) ON DELETE CASCADE,
+   itemId VARCHAR(64) NOT NULL,
+   data BYTEA,
+   itemFormat SMALLINT NOT NULL DEFAULT 1,
+   revision BIGINT NOT NULL,
+   deleted BOOLEAN NOT NULL DEFAULT FALSE,
+   PRIMARY KEY (userId, itemId)
+);
+CREATE INDEX vault_item_revision ON "VaultItem" (userId, revision);
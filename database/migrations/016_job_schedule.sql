@@ -0,0 +1,9 @@
+-- Next run of the periodic jobs, shared by the workers so each job runs once per interval
+SET SEARCH_PATH TO duckpass;
+
+CREATE TABLE "JobSchedule"
+(
+   jobName VARCHAR(64) NOT NULL,
+   nextRunAt TIMESTAMPTZ NOT NULL,
+   PRIMARY KEY (jobName)
+);
@@ -0,0 +1,6 @@
+-- Tombstones of the vault items purged after a retention period, the clients synced before must sync all the items
+SET SEARCH_PATH TO duckpass;
+
+ALTER TABLE "User" ADD COLUMN itemsPurgedRevision BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE "VaultItem" ADD COLUMN updatedAt TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP;
+CREATE INDEX vault_item_tombstone ON "VaultItem" (updatedAt) WHERE deleted;
@@ -0,0 +1,5 @@
+-- Breaches each user was notified of, written by the sweep only so the breaches cached by the other paths are still mailed
+SET SEARCH_PATH TO duckpass;
+
+ALTER TABLE "BreachCache" ADD COLUMN notifiedBreaches JSONB;
+UPDATE "BreachCache" SET notifiedBreaches = breaches;
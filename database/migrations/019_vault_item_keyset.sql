@@ -0,0 +1,5 @@
+-- Items of the vaults synced page by page from a revision and an item, a revision may span several pages
+SET SEARCH_PATH TO duckpass;
+
+DROP INDEX vault_item_revision;
+CREATE INDEX vault_item_revision ON "VaultItem" (userId, revision, itemId);